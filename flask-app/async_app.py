@@ -0,0 +1,90 @@
+import logging
+import os
+
+from aiohttp import web
+
+import async_rag
+import observability
+import rag
+from llm_scheduler import LlmOverloaded
+from singleflight import CoalesceTimeout
+
+logger = logging.getLogger(__name__)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    return response
+
+
+async def ready(request):
+    engine = request.app['engine']
+    if not engine.engine.ready:
+        return web.json_response({'status': 'warming_up'}, status=503)
+    return web.json_response({'status': 'ready'})
+
+
+async def search(request):
+    try:
+        data = await request.json()
+        query = data.get('query', '')
+        debug = bool(data.get('debug')) or request.query.get('debug') in ('1', 'true')
+        result = await request.app['engine'].rag(query, debug=debug)
+        headers = {'Retry-After': str(result['retry_after'])} if result.get('degraded') else None
+        return web.json_response(result, headers=headers)
+    except LlmOverloaded as e:
+        logger.warning(str(e))
+        return web.json_response({'error': str(e), 'retry_after': e.retry_after}, status=e.status,
+                                 headers={'Retry-After': str(e.retry_after)})
+    except CoalesceTimeout as e:
+        logger.warning(str(e))
+        return web.json_response({'error': str(e)}, status=504)
+    except Exception as e:
+        logger.exception(f'Error: {str(e)}')
+        observability.count_error('request')
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def metrics(request):
+    body, content_type = observability.metrics_response()
+    # aiohttp の content_type には charset などのパラメータを含められない
+    return web.Response(body=body, headers={'Content-Type': content_type})
+
+
+def create_app(async_engine):
+    """/api/search を asyncio で処理するアプリ。レスポンスは main.py と同じ形式"""
+    app = web.Application(middlewares=[cors_middleware])
+    app['engine'] = async_engine
+    app.router.add_get('/api/ready', ready)
+    app.router.add_post('/api/search', search)
+    app.router.add_get('/metrics', metrics)
+
+    async def warmup(app):
+        await app['engine'].encode_query('ウォームアップ')
+        app['engine'].engine.ready = True
+
+    async def close(app):
+        await app['engine'].close()
+
+    app.on_startup.append(warmup)
+    app.on_cleanup.append(close)
+    return app
+
+
+def main():
+    observability.configure_logging()
+    model = rag.create_encoder()
+    engine = rag.VectorSearchEngine(model=model, es_client=rag.create_es_client(), groq=rag.create_groq_client())
+    observability.register_engine(engine)
+    app = create_app(async_rag.AsyncVectorSearchEngine(engine))
+    web.run_app(app, host='0.0.0.0', port=int(os.getenv('PORT', '8080')))
+
+
+if __name__ == '__main__':
+    main()
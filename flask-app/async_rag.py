@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import httpx
+from elasticsearch import AsyncElasticsearch
+from groq import AsyncGroq, DefaultAioHttpClient, RateLimitError
+
+import rag
+from cache import normalize_query
+from observability import count_coalesced, request_timer, span
+from retrievers import ElasticsearchRetriever
+from llm_json import parse_answer
+from llm_scheduler import LlmOverloaded
+from singleflight import AsyncSingleFlight, CoalesceTimeout
+
+LLM_CONNECTIONS = int(os.getenv('LLM_CONNECTIONS', '64'))
+
+
+def create_async_es_client(hosts=None):
+    return AsyncElasticsearch(hosts or [rag.ES_HOST], connections_per_node=rag.ES_CONNECTIONS)
+
+
+def create_async_groq_client(base_url=None, api_key=None):
+    # httpxの既定トランスポートは同時接続数が多いと遅くなるため aiohttp を使う
+    limits = httpx.Limits(max_connections=LLM_CONNECTIONS, max_keepalive_connections=LLM_CONNECTIONS)
+    return AsyncGroq(
+        api_key=api_key or os.getenv('KEY_groq'),
+        base_url=base_url,
+        http_client=DefaultAioHttpClient(limits=limits),
+    )
+
+
+class AsyncVectorSearchEngine:
+    """VectorSearchEngine のasyncio版
+
+    プロンプト・キャッシュ・評価ワーカーは同期版のエンジンを共有し、
+    Elasticsearch と LLM への通信だけを非同期クライアントで行う。
+    """
+
+    def __init__(self, engine, es_client=None, groq=None, encode_executor=None):
+        self.engine = engine
+        self.es_client = es_client if es_client is not None else create_async_es_client()
+        self.groq = groq if groq is not None else create_async_groq_client()
+        # イベントループ上で model.encode を実行しない。エンコードは engine._encode_lock で
+        # 1件ずつしか進まないので、スレッドを増やしても待つ場所が変わるだけ
+        self.encode_executor = encode_executor if encode_executor is not None else ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='encode')
+        self.singleflight = AsyncSingleFlight(timeout=rag.COALESCE_TIMEOUT)
+
+    async def encode_query(self, query):
+        loop = asyncio.get_running_loop()
+        # エンコードの計測がこのリクエストのタイミングに入るよう、コンテキストごと渡す
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.encode_executor, context.run, self.engine.encode_query, query)
+
+    async def search(self, query, top_k=5):
+        try:
+            query_vector = await self.encode_query(query)
+            retriever = self.engine.retriever
+            if not isinstance(retriever, ElasticsearchRetriever):
+                # プロセス内の検索はI/Oを伴わないのでそのまま呼ぶ
+                with span('retrieve'):
+                    sources = retriever.search(query_vector, top_k, query_text=query)
+                return self.engine.format_sources(sources)
+            projection = retriever.projection
+            if projection is not None and projection.stale():
+                # _meta は同期クライアントで読むので、イベントループを止めないよう別スレッドで読み直す
+                await asyncio.get_running_loop().run_in_executor(None, projection.current)
+            with span('retrieve'):
+                results = await self.es_client.msearch(
+                    searches=retriever.build_msearch([query_vector], top_k, [query]))
+            result = retriever.parse_msearch(results['responses'], top_k)[0]
+            if isinstance(result, Exception):
+                raise result
+            return self.engine.format_sources(result)
+        except Exception as e:
+            return str(e)
+
+    async def llm(self, prompt):
+        # 同期版のエンジンと同じスケジューラーで、Groq の同時呼び出し数とトークン数を数える
+        scheduler = self.engine.llm_scheduler
+        async with scheduler.async_slot(self.engine.estimate_llm_tokens(prompt)) as ticket:
+            try:
+                response = await self.groq.chat.completions.create(
+                    messages=[{"role": "user", "content": prompt}],
+                    model=self.engine.llm_model,
+                )
+            except RateLimitError as e:
+                raise self.engine.upstream_limited(e)
+            answer = response.choices[0].message.content
+            token_stats = {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+                "total_tokens": response.usage.total_tokens
+            }
+            ticket.used = token_stats["total_tokens"]
+        return answer, token_stats
+
+    async def rag(self, query, debug=False):
+        with request_timer() as timer:
+            try:
+                answer_data, shared = await self.singleflight.do(
+                    normalize_query(query), lambda: self.run_rag(query))
+            except CoalesceTimeout:
+                count_coalesced('timeout')
+                raise
+            return self.engine.with_debug(self.engine.shared_answer(answer_data, shared), timer, debug)
+
+    async def run_rag(self, query):
+        t0 = time()
+
+        structured = self.engine.analyze_query(query)
+        if structured is not None:
+            return self.engine.structured_answer(structured, t0)
+
+        search_results = await self.search(query)
+
+        query_vector = await self.encode_query(query)
+        cached = self.engine.cached_answer(query_vector, search_results, t0)
+        if cached is not None:
+            return cached
+
+        prompt = self.engine.build_prompt(query, search_results)
+
+        try:
+            with span('llm'):
+                answer, token_stats = await self.llm(prompt)
+        except LlmOverloaded as e:
+            return self.engine.overloaded_answer(e, search_results, t0)
+
+        with span('parse'):
+            parser = parse_answer(answer)
+        answer_json = self.engine.parsed_answer(parser)
+
+        return self.engine.finish_answer(
+            query, query_vector, search_results, answer, answer_json, token_stats, t0)
+
+    async def close(self):
+        await self.es_client.close()
+        await self.groq.close()
+        self.encode_executor.shutdown(wait=False)
@@ -0,0 +1,116 @@
+"""エンコーダーのバックエンド (torch / onnx / onnx-int8) ごとの1クエリの処理時間とメモリ使用量を比べる
+
+    python encoders.py export --output onnx_model
+    python bench_encoder.py --onnx-dir onnx_model --threads 1 4 --output encoder.json
+
+バックエンドごとに別プロセスで計測するので、RSS はそのバックエンドだけを読み込んだ値になる。
+torch も計測した場合は、torch の埋め込みとのコサイン類似度 (最小・平均) も出す。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+import rag
+from bench_prompt import QUERIES
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def measure(args):
+    """子プロセス側: 1つのバックエンドを読み込んで計測し、結果を JSON で標準出力に書く"""
+    from benchmark import summarize
+    from encoders import create_encoder
+
+    before = rss_mb()
+    t0 = perf_counter()
+    encoder = create_encoder(args.backend, args.model, onnx_dir=args.onnx_dir, threads=args.threads)
+    encoder.encode('ウォームアップ')
+    load_seconds = perf_counter() - t0
+
+    queries = [f'{QUERIES[i % len(QUERIES)]} {i}' for i in range(args.queries)]
+    latencies = []
+    vectors = []
+    for query in queries:
+        start = perf_counter()
+        vectors.append(encoder.encode(query))
+        latencies.append(perf_counter() - start)
+    np.save(args.vectors, np.stack(vectors))
+
+    result = {
+        'backend': args.backend,
+        'threads': args.threads,
+        'load_seconds': round(load_seconds, 2),
+        'rss_before_mb': round(before, 1),
+        'rss_mb': round(rss_mb(), 1),
+        'query': summarize(latencies, sum(latencies)),
+    }
+    print(json.dumps(result))
+
+
+def min_mean_cosine(a, b):
+    cosine = (a * b).sum(1) / np.linalg.norm(a, axis=1) / np.linalg.norm(b, axis=1)
+    return round(float(cosine.min()), 5), round(float(cosine.mean()), 5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['torch', 'onnx', 'onnx-int8'])
+    parser.add_argument('--model', default=rag.MODEL_NAME)
+    parser.add_argument('--onnx-dir', default=rag.ENCODER_ONNX_DIR)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--output', help='結果をJSONで書き出すファイル')
+    parser.add_argument('--backend', help=argparse.SUPPRESS)
+    parser.add_argument('--vectors', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.backend:
+        args.threads = args.threads[0]
+        measure(args)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for threads in args.threads:
+            reference = None
+            for backend in args.backends:
+                vectors_path = os.path.join(tmp, f'{backend}-{threads}.npy')
+                output = subprocess.run(
+                    [sys.executable, __file__, '--backend', backend, '--model', args.model,
+                     '--onnx-dir', args.onnx_dir, '--threads', str(threads), '--queries', str(args.queries),
+                     '--vectors', vectors_path],
+                    capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                vectors = np.load(vectors_path)
+                if backend == 'torch':
+                    reference = vectors
+                elif reference is not None:
+                    result['cosine_min'], result['cosine_mean'] = min_mean_cosine(reference, vectors)
+                results.append(result)
+
+                query = result['query']
+                drift = f"  cosine min={result['cosine_min']:.4f} mean={result['cosine_mean']:.4f}" \
+                    if 'cosine_min' in result else ''
+                print(f"{backend:<10} threads={threads:<2} p50={query['p50_ms']:7.2f}ms  p95={query['p95_ms']:7.2f}ms  "
+                      f"p99={query['p99_ms']:7.2f}ms  rss={result['rss_mb']:7.1f}MB  "
+                      f"load={result['load_seconds']:5.1f}s{drift}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model': args.model, 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
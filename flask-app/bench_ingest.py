@@ -0,0 +1,65 @@
+"""PokemonIngest の埋め込み処理の速度 (rows/sec) を変更前後で比較する
+
+    python bench_ingest.py --db pokedex.db --batch-sizes 32 64 128 --processes 0 4
+
+変更前の1行ずつの encode は遅いので、--baseline-rows 件だけで計測する。
+Elasticsearch には接続しない。
+"""
+import argparse
+import logging
+from time import perf_counter
+
+from encoders import TorchEncoder
+from injest import PokemonIngest
+
+
+def build_ingest(model, batch_size, processes):
+    # Elasticsearch クライアントを作らずにエンコード部分だけを使う
+    ingest = object.__new__(PokemonIngest)
+    ingest.model = model
+    ingest.encode_batch_size = batch_size
+    ingest.encode_processes = processes
+    ingest._in_encode_session = False
+    ingest._encode_pool = None
+    return ingest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='pokedex.db')
+    parser.add_argument('--model', default='paraphrase-multilingual-mpnet-base-v2')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--processes', type=int, nargs='+', default=[0])
+    parser.add_argument('--baseline-rows', type=int, default=200)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    model = TorchEncoder(args.model)
+    ingest = build_ingest(model, args.batch_sizes[0], 0)
+    df = ingest.prepare_data(args.db)
+    texts = ingest.combine_texts(df).tolist()
+    print(f'rows={len(texts)}')
+
+    sample = texts[:args.baseline_rows]
+    t0 = perf_counter()
+    for text in sample:
+        ingest.generate_vector(text)
+    elapsed = perf_counter() - t0
+    baseline = len(sample) / elapsed
+    print(f'{"row-by-row (before)":<28} {baseline:8.1f} rows/sec')
+
+    for processes in args.processes:
+        for batch_size in args.batch_sizes:
+            ingest = build_ingest(model, batch_size, processes)
+            with ingest.encode_session():
+                t0 = perf_counter()
+                embeddings = ingest.generate_vectors(texts)
+                elapsed = perf_counter() - t0
+            rate = len(texts) / elapsed
+            label = f'batch={batch_size} processes={processes}'
+            print(f'{label:<28} {rate:8.1f} rows/sec  x{rate / baseline:.1f}  '
+                  f'matrix={embeddings.shape} {embeddings.dtype} {embeddings.nbytes / 1e6:.1f}MB')
+
+
+if __name__ == '__main__':
+    main()
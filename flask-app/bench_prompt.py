@@ -0,0 +1,85 @@
+"""従来の CONTEXT (entry_template を全件) と ContextBuilder の表形式のプロンプトトークン数を比較する
+
+    python bench_prompt.py --local-index local_index --top-k 5 10 --budget 1200
+
+固定のクエリ集合をローカルインデックス (RETRIEVER_BACKEND=numpy と同じもの) で検索し、
+プロンプト全体のトークン数を context_builder.estimate_tokens で見積もる。
+Elasticsearch と Groq には接続しない。--dummy-encoder ならモデルも読み込まない。
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+
+import rag
+from context_builder import ContextBuilder, estimate_tokens
+from evaluation import EvaluationStore, RelevanceEvaluator
+from retrievers import NumpyRetriever
+
+QUERIES = [
+    'ほのおタイプで一番速いポケモンは？',
+    'ピカチュウ',
+    '夜になると人の魂を奪うと言われるポケモン',
+    '海の底に住んでいる大きなポケモン',
+    'こおりタイプの伝説のポケモン',
+    '防御が高くて遅いはがねタイプ',
+    '森の中で子供を迷わせるゴーストポケモン',
+    'リザードン',
+    '毒を持つ虫ポケモン',
+    '空を飛ぶドラゴン',
+]
+
+
+def build_engine(model, local_index):
+    return rag.VectorSearchEngine(
+        model=model,
+        groq=object(),
+        retriever=NumpyRetriever(local_index),
+        evaluator=RelevanceEvaluator(None, EvaluationStore(os.path.join(tempfile.mkdtemp(), 'eval.db')),
+                                     workers=0, sample_rate=0.0),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--local-index', default=rag.LOCAL_INDEX_DIR)
+    parser.add_argument('--top-k', type=int, nargs='+', default=[5, 10])
+    parser.add_argument('--budget', type=int, default=rag.PROMPT_TOKEN_BUDGET)
+    parser.add_argument('--dummy-encoder', action='store_true', help='SentenceTransformerを読み込まない')
+    args = parser.parse_args()
+
+    if args.dummy_encoder:
+        from loadtest import DummyEncoder
+        model = DummyEncoder()
+    else:
+        model = rag.create_encoder()
+
+    engine = build_engine(model, args.local_index)
+    engine.context_builder = ContextBuilder(token_budget=args.budget)
+
+    for top_k in args.top_k:
+        full_tokens = []
+        compact_tokens = []
+        full_context = []
+        compact_context = []
+        kept = []
+        for query in QUERIES:
+            results = engine.search(query, top_k)
+            engine.context_format = 'full'
+            full_tokens.append(estimate_tokens(engine.build_prompt(query, results)))
+            engine.context_format = 'compact'
+            compact_tokens.append(estimate_tokens(engine.build_prompt(query, results)))
+            context, entries = engine.context_builder.build(results)
+            full_context.append(estimate_tokens(engine.full_context(results)))
+            compact_context.append(estimate_tokens(context))
+            kept.append(entries)
+
+        full, compact = np.mean(full_tokens), np.mean(compact_tokens)
+        print(f'top_k={top_k:<3} prompt: full={full:6.0f} compact={compact:6.0f} saved={1 - compact / full:6.1%}  '
+              f'context: full={np.mean(full_context):6.0f} compact={np.mean(compact_context):6.0f} '
+              f'max={max(compact_context)}  entries_kept={np.mean(kept):.1f}/{top_k}')
+
+
+if __name__ == '__main__':
+    main()
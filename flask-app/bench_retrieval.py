@@ -0,0 +1,95 @@
+"""kNN のみの検索とハイブリッド検索 (BM25 + kNN の RRF) の recall@5 とレイテンシを比較する
+
+    python bench_retrieval.py --es-host http://localhost:9200 --samples 200 \
+        --knn-candidates 100 --hybrid-candidates 20 50
+
+injest.py で登録済みのインデックスに対して実行する。クエリは pokedex.db から作り、
+正解はそのポケモンの global_no とする。
+- name: 日本語名そのもの (完全一致の名前検索)
+- description: 最初のゲームの図鑑説明の先頭の一文
+"""
+import argparse
+import logging
+import random
+from time import perf_counter
+
+import numpy as np
+from elasticsearch import Elasticsearch
+
+import rag
+from injest import PokemonIngest
+from retrievers import ElasticsearchRetriever, HybridElasticsearchRetriever
+
+
+def build_queries(db_path, samples, seed):
+    ingest = object.__new__(PokemonIngest)
+    df = ingest.prepare_data(db_path).drop_duplicates(subset=['global_no', 'form', 'name_english'])
+    rows = df.sample(n=min(samples, len(df)), random_state=seed)
+    queries = []
+    description_cols = [col for col in df.columns if col.startswith('description_')]
+    for _, row in rows.iterrows():
+        queries.append(('name', row['name_japanese'], row['global_no']))
+        descriptions = [row[col] for col in description_cols if isinstance(row[col], str)]
+        if descriptions:
+            queries.append(('description', descriptions[0].split('。')[0], row['global_no']))
+    return queries
+
+
+def run(retriever, queries, vectors, top_k):
+    hits = {}
+    latencies = []
+    for (kind, text, expected), vector in zip(queries, vectors):
+        t0 = perf_counter()
+        results = retriever.search(vector, top_k, query_text=text)
+        latencies.append(perf_counter() - t0)
+        found = any(str(doc.get('global_no')) == str(expected) for doc in results)
+        hits.setdefault(kind, []).append(found)
+    recall = {kind: float(np.mean(values)) for kind, values in hits.items()}
+    recall['all'] = float(np.mean([v for values in hits.values() for v in values]))
+    return recall, np.array(latencies) * 1000
+
+
+def report(label, recall, latencies):
+    print(f'{label:<24} recall@5 all={recall["all"]:.3f} name={recall.get("name", 0):.3f} '
+          f'description={recall.get("description", 0):.3f}  '
+          f'mean={latencies.mean():6.1f}ms p95={np.percentile(latencies, 95):6.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--es-host', default=rag.ES_HOST)
+    parser.add_argument('--index', default=rag.INDEX_NAME)
+    parser.add_argument('--db', default='pokedex.db')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--knn-candidates', type=int, nargs='+', default=[100])
+    parser.add_argument('--hybrid-candidates', type=int, nargs='+', default=[20, 50])
+    parser.add_argument('--window-size', type=int, default=rag.HYBRID_WINDOW_SIZE)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    queries = build_queries(args.db, args.samples, args.seed)
+    random.Random(args.seed).shuffle(queries)
+    model = rag.create_encoder()
+    vectors = model.encode([text for _, text, _ in queries], batch_size=64)
+    es_client = Elasticsearch([args.es_host])
+    print(f'queries={len(queries)} top_k={args.top_k}')
+
+    for candidates in args.knn_candidates:
+        retriever = ElasticsearchRetriever(es_client, index_name=args.index, num_candidates=candidates)
+        # 最初の数件は接続確立などを含むので捨てる
+        run(retriever, queries[:10], vectors[:10], args.top_k)
+        report(f'knn candidates={candidates}', *run(retriever, queries, vectors, args.top_k))
+
+    for candidates in args.hybrid_candidates:
+        retriever = HybridElasticsearchRetriever(
+            es_client, index_name=args.index, num_candidates=candidates, window_size=args.window_size,
+            bm25_weight=rag.HYBRID_BM25_WEIGHT, knn_weight=rag.HYBRID_KNN_WEIGHT,
+            rank_constant=rag.HYBRID_RANK_CONSTANT)
+        run(retriever, queries[:10], vectors[:10], args.top_k)
+        report(f'hybrid candidates={candidates}', *run(retriever, queries, vectors, args.top_k))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""開発サーバー (flask run) と gunicorn (preload + 複数ワーカー) のスループットとメモリを比べる
+
+    python bench_server.py --workers 2 4 --requests 300 --concurrency 16 --output server.json
+
+Elasticsearch と Groq は fakeservers.py のスタブに向ける。サーバーは別プロセスで起動し、
+ウォームアップ後と負荷をかけた後に、各プロセスの RSS と PSS (共有ページを共有数で割った値) を
+/proc/<pid>/smaps_rollup から読む。preload で重みを共有できていれば、ワーカーの PSS は RSS より小さくなる。
+MODEL_NAME を変えれば (--model) 別のモデルでも計測できる。
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+import rag
+from benchmark import load_test
+from fakeservers import FakeElasticsearch, FakeGroq, FakeServers
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def memory(pid):
+    """smaps_rollup の Rss / Pss / Private を MB で返す"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'rss_mb': round(values.get('Rss', 0.0), 1),
+        'pss_mb': round(values.get('Pss', 0.0), 1),
+        'private_mb': round(values.get('Private_Clean', 0.0) + values.get('Private_Dirty', 0.0), 1),
+    }
+
+
+def children(pid):
+    result = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # comm に空白が入ることがあるので、最後の ')' の後ろを読む
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                result.append(int(entry))
+    return sorted(result)
+
+
+def processes(proc, mode):
+    if mode == 'dev':
+        return {'server': proc.pid}
+    return {'master': proc.pid, **{f'worker-{i}': pid for i, pid in enumerate(children(proc.pid))}}
+
+
+def snapshot(proc, mode):
+    usage = {name: memory(pid) for name, pid in processes(proc, mode).items()}
+    usage['total'] = {key: round(sum(m[key] for m in usage.values()), 1) for key in ('rss_mb', 'pss_mb', 'private_mb')}
+    return usage
+
+
+def wait_ready(url, proc, expected_workers, mode, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'サーバーが終了しました (exit={proc.returncode})')
+        try:
+            with urllib.request.urlopen(f'{url}/api/ready', timeout=5) as response:
+                ready = response.status == 200
+        except (urllib.error.URLError, OSError):
+            ready = False
+        if ready and (mode == 'dev' or len(children(proc.pid)) >= expected_workers):
+            return
+        time.sleep(0.5)
+    raise TimeoutError('サーバーの起動を待ちきれませんでした')
+
+
+def server_command(mode, port, workers, threads):
+    if mode == 'dev':
+        return [sys.executable, '-m', 'flask', '--app', 'main', 'run', '--port', str(port), '--no-reload']
+    return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+            '--workers', str(workers), '--threads', str(threads), 'wsgi:app']
+
+
+def run_server(mode, workers, servers, args, tmp):
+    port = free_port()
+    env = {
+        **os.environ,
+        'ES_HOST': servers.es_url,
+        'GROQ_BASE_URL': servers.llm_url,
+        'KEY_groq': 'fake',
+        'MODEL_NAME': args.model,
+        'EVAL_SAMPLE_RATE': '0',
+        'EVAL_DB_PATH': os.path.join(tmp, f'eval-{mode}-{workers}.db'),
+        'ANSWER_CACHE_SIZE': '0',
+        'INDEX_STAMP_PATH': os.path.join(tmp, '.index_version'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(tmp, f'prometheus-{mode}-{workers}'),
+        'LOG_LEVEL': 'WARNING',
+    }
+    if mode == 'dev':
+        env.pop('PROMETHEUS_MULTIPROC_DIR')
+    proc = subprocess.Popen(server_command(mode, port, workers, args.threads), cwd=HERE, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        url = f'http://127.0.0.1:{port}'
+        t0 = time.monotonic()
+        wait_ready(url, proc, workers, mode)
+        startup = time.monotonic() - t0
+        idle = snapshot(proc, mode)
+        load = load_test(url, SimpleNamespace(concurrency=args.concurrency, warmup=args.warmup,
+                                              requests=args.requests))
+        return {'mode': mode, 'workers': workers if mode != 'dev' else 1, 'startup_seconds': round(startup, 1),
+                'memory_idle': idle, 'memory_after_load': snapshot(proc, mode), 'load': load}
+    finally:
+        proc.terminate()
+        proc.wait(timeout=60)
+
+
+def print_result(result):
+    request = result['load']['load.request']
+    label = 'flask run' if result['mode'] == 'dev' else f'gunicorn x{result["workers"]}'
+    print(f'\n{label}: {request.get("throughput", 0):.1f} req/s  p50={request.get("p50_ms", 0):.1f}ms  '
+          f'p95={request.get("p95_ms", 0):.1f}ms  errors={request["errors"]}  startup={result["startup_seconds"]}s')
+    for name, usage in result['memory_after_load'].items():
+        print(f'  {name:<10} rss={usage["rss_mb"]:8.1f}MB  pss={usage["pss_mb"]:8.1f}MB  '
+              f'private={usage["private_mb"]:8.1f}MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn のワーカーごとのスレッド数')
+    parser.add_argument('--model', default=rag.MODEL_NAME)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--es-latency', type=float, default=0.01)
+    parser.add_argument('--llm-latency', type=float, default=0.2)
+    parser.add_argument('--skip-dev', action='store_true', help='開発サーバーを計測しない')
+    parser.add_argument('--output', help='結果をJSONで書き出すファイル')
+    args = parser.parse_args()
+
+    runs = ([('dev', 1)] if not args.skip_dev else []) + [('gunicorn', n) for n in args.workers]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, \
+            FakeServers(FakeElasticsearch(latency=args.es_latency), FakeGroq(latency=args.llm_latency),
+                        process=True) as servers:
+        for mode, workers in runs:
+            result = run_server(mode, workers, servers, args, tmp)
+            print_result(result)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'model': args.model, 'cpu_count': os.cpu_count(), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""検索条件だけの質問 (query_analyzer.py) がどれだけ RAG を通らずに答えられるかと、その速さを測る
+
+    python bench_structured.py --iterations 200
+    python bench_structured.py --end-to-end --llm-latency 1.0
+
+サンプルの質問集合のうち、図鑑の表 (pokemon_table.py) で答えた割合と、
+解析 + 絞り込みにかかった時間 (RAG に回した質問は解析だけの時間) を表示する。
+--end-to-end では fakeservers.py のスタブに向けたエンジンで rag() 全体の時間も比べる
+(RAG 側の時間はスタブの遅延の設定で決まる)。
+"""
+import argparse
+from time import perf_counter
+
+import rag
+from benchmark import print_stats, summarize
+from fakeservers import FakeElasticsearch, FakeGroq, FakeServers
+from loadtest import DummyEncoder, build_engine
+from pokemon_table import load_pokemon_table
+from query_analyzer import QueryAnalyzer
+
+SAMPLE_QUERIES = [
+    # 検索条件として読める質問
+    '素早さ120以上のほのおタイプ',
+    'fastest electric',
+    'HP over 100',
+    'ほのおタイプで一番速いポケモンは？',
+    'HPが100以上のみずタイプ',
+    '攻撃が一番高いドラゴンタイプ',
+    '最速のゴーストタイプ',
+    'slowest steel type',
+    'highest special attack psychic',
+    '特防が低いエスパー',
+    'いかくを持つポケモン',
+    'すいすいのみずタイプ',
+    '合計600以上のドラゴン',
+    'top 5 strongest fairy',
+    'fire type pokemon with speed over 100',
+    '防御150以上',
+    'でんきタイプで素早さ順',
+    '上位3匹の最速むしタイプ',
+    # 条件の語が入っているが、それだけでは答えられない質問
+    '防御が高くて遅いはがねタイプ',
+    'こおりタイプの伝説のポケモン',
+    'ピカチュウより速いポケモン',
+    'ほのおタイプのポケモン',
+    'strongest legendary dragon',
+    # 説明文や名前で探す質問
+    'ピカチュウ',
+    'リザードン',
+    '夜になると人の魂を奪うと言われるポケモン',
+    '海の底に住んでいる大きなポケモン',
+    '森の中で子供を迷わせるゴーストポケモン',
+    '毒を持つ虫ポケモン',
+    '空を飛ぶドラゴン',
+    'a pokemon that looks like a cat',
+    '尻尾の炎が消えると死んでしまうポケモン',
+    'ゲームで最初にもらえる草タイプ',
+    'pokemon that evolves with a moon stone',
+]
+
+
+def run_analyzer(analyzer, table, iterations):
+    routed = {}
+    latencies = {'structured': [], 'rag': []}
+    for query in SAMPLE_QUERIES:
+        for _ in range(iterations):
+            t0 = perf_counter()
+            structured = analyzer.analyze(query)
+            if structured is not None:
+                table.query(structured, rag.STRUCTURED_QUERY_LIMIT)
+            latencies['structured' if structured is not None else 'rag'].append(perf_counter() - t0)
+        routed[query] = structured
+    return routed, latencies
+
+
+def run_end_to_end(args):
+    latencies = {'structured': [], 'rag': []}
+    servers = FakeServers(FakeElasticsearch(latency=args.es_latency), FakeGroq(latency=args.llm_latency))
+    with servers:
+        engine = build_engine(DummyEncoder(), servers)
+        for query in SAMPLE_QUERIES:
+            t0 = perf_counter()
+            result = engine.rag(query)
+            latencies['structured' if result['structured'] else 'rag'].append(perf_counter() - t0)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=rag.POKEDEX_DB_PATH)
+    parser.add_argument('--iterations', type=int, default=200, help='1つの質問を解析する回数')
+    parser.add_argument('--end-to-end', action='store_true', help='スタブに向けたエンジンで rag() 全体も測る')
+    parser.add_argument('--es-latency', type=float, default=0.01, help='スタブESの応答遅延(秒)')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='スタブLLMの応答遅延(秒)')
+    args = parser.parse_args()
+
+    table = load_pokemon_table(args.db)
+    analyzer = QueryAnalyzer(table.abilities)
+    routed, latencies = run_analyzer(analyzer, table, args.iterations)
+
+    for query, structured in routed.items():
+        print(f'{"structured" if structured else "rag":<10} {query}  {structured.describe() if structured else ""}')
+    fast = sum(structured is not None for structured in routed.values())
+    print(f'\n検索条件で答えた質問: {fast}/{len(routed)} ({fast / len(routed):.0%})')
+    print_stats('structured.analyze+query', summarize(latencies['structured']))
+    print_stats('rag.analyze', summarize(latencies['rag']))
+
+    if args.end_to_end:
+        for route, values in run_end_to_end(args).items():
+            print_stats(f'{route}.rag()', summarize(values))
+
+
+if __name__ == '__main__':
+    main()
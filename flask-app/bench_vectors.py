@@ -0,0 +1,161 @@
+"""ベクトルの格納設定 (index_options.type × PCA の次元数) ごとの recall@k・レイテンシ・サイズを比べる
+
+    python bench_vectors.py --local-index local_index --types hnsw int8_hnsw --dims 0 256 128 \
+        --es-host http://localhost:9200 --output vectors.json
+
+文書ベクトルは injest.py が書き出したローカルインデックス (削減なしの 768 次元) から読む。
+一部の文書を取り置いてクエリにし、残りを登録する。正解は 768 次元の float での厳密な上位 k 件。
+
+- exact:  PCA だけの影響。削減後の空間で numpy の厳密検索をしたときの recall と、ベクトルの推定サイズ
+- es:     --es-host を指定したとき。設定ごとに一時インデックス (pk_bench_*) を作って kNN 検索し、
+          recall・レイテンシ・ディスク上のサイズ (_stats と _disk_usage のベクトル分) を測る
+量子化した型は ES 8.12 以降 (int4_* は 8.15 以降) が必要。
+"""
+import argparse
+import json
+from time import perf_counter
+
+import numpy as np
+
+import rag
+from benchmark import summarize
+from injest import VECTOR_INDEX_TYPES
+from projection import PcaProjection
+from retrievers import NumpyRetriever
+
+# 1次元あたりのバイト数 (HNSW が検索時にメモリに載せる分)
+BYTES_PER_DIM = {'hnsw': 4, 'flat': 4, 'int8_hnsw': 1, 'int8_flat': 1, 'int4_hnsw': 0.5, 'int4_flat': 0.5}
+
+
+def split_queries(vectors, queries, seed):
+    order = np.random.default_rng(seed).permutation(len(vectors))
+    return vectors[order[queries:]], vectors[order[:queries]]
+
+
+def exact_top_k(corpus, queries, top_k):
+    scores = queries @ corpus.T
+    top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    return [set(row) for row in top]
+
+
+def recall(truth, found):
+    return float(np.mean([len(t & f) / len(t) for t, f in zip(truth, found)]))
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def reduce(projection, corpus, queries):
+    if projection is None:
+        return corpus, queries
+    return normalize(projection.transform(corpus)), normalize(projection.transform(queries))
+
+
+def bench_es(es, index_type, corpus, queries, truth, top_k, num_candidates, keep):
+    from elasticsearch import helpers
+
+    index_name = f'pk_bench_{index_type}_{corpus.shape[1]}'
+    if es.indices.exists(index=index_name):
+        es.indices.delete(index=index_name)
+    vector = {'type': 'dense_vector', 'dims': corpus.shape[1], 'index': True, 'similarity': 'cosine'}
+    if index_type != 'hnsw':
+        vector['index_options'] = {'type': index_type}
+    es.indices.create(index=index_name, mappings={'properties': {'combined_text_vector': vector}},
+                      settings={'number_of_shards': 1, 'number_of_replicas': 0, 'refresh_interval': '-1'})
+    try:
+        helpers.bulk(es, ({'_index': index_name, '_id': str(i), 'combined_text_vector': v.tolist()}
+                          for i, v in enumerate(corpus)), chunk_size=500)
+        es.indices.refresh(index=index_name)
+        es.indices.forcemerge(index=index_name, max_num_segments=1)
+
+        found = []
+        latencies = []
+        for query in queries:
+            t0 = perf_counter()
+            response = es.search(index=index_name, knn={
+                'field': 'combined_text_vector', 'query_vector': query.tolist(), 'k': top_k,
+                'num_candidates': num_candidates}, source=False, size=top_k)
+            latencies.append(perf_counter() - t0)
+            found.append({int(hit['_id']) for hit in response['hits']['hits']})
+
+        stats = es.indices.stats(index=index_name, metric='store')
+        result = {
+            'recall': recall(truth, found),
+            'latency': summarize(latencies, sum(latencies)),
+            'store_bytes': stats['indices'][index_name]['primaries']['store']['size_in_bytes'],
+        }
+        try:
+            usage = es.indices.disk_usage(index=index_name, run_expensive_tasks=True)[index_name]
+            result['vector_bytes'] = usage['fields']['combined_text_vector']['total_in_bytes']
+        except Exception:
+            # _disk_usage は技術プレビューの API なので、使えなければ _stats のサイズだけにする
+            pass
+        return result
+    finally:
+        if not keep:
+            es.indices.delete(index=index_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--local-index', default=rag.LOCAL_INDEX_DIR)
+    parser.add_argument('--types', nargs='+', default=['hnsw', 'int8_hnsw'], choices=VECTOR_INDEX_TYPES)
+    parser.add_argument('--dims', type=int, nargs='+', default=[0, 256, 128, 64], help='0 は削減なし')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--num-candidates', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=200, help='クエリとして取り置く文書の数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--es-host', help='指定すると Elasticsearch でも計測する')
+    parser.add_argument('--keep', action='store_true', help='計測用のインデックスを削除しない')
+    parser.add_argument('--output', help='結果をJSONで書き出すファイル')
+    args = parser.parse_args()
+
+    vectors = np.asarray(NumpyRetriever(args.local_index).vectors, dtype=np.float32)
+    corpus, queries = split_queries(vectors, args.queries, args.seed)
+    truth = exact_top_k(corpus, queries, args.top_k)
+    print(f'documents={len(corpus)} queries={len(queries)} dim={corpus.shape[1]} top_k={args.top_k}')
+
+    es = None
+    if args.es_host:
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch([args.es_host], request_timeout=300)
+
+    results = []
+    for dims in args.dims:
+        projection = PcaProjection.fit(corpus, dims) if dims else None
+        reduced_corpus, reduced_queries = reduce(projection, corpus, queries)
+        t0 = perf_counter()
+        exact_recall = recall(truth, exact_top_k(reduced_corpus, reduced_queries, args.top_k))
+        exact_ms = (perf_counter() - t0) / len(queries) * 1000
+        for index_type in args.types:
+            result = {
+                'type': index_type,
+                'dims': reduced_corpus.shape[1],
+                'explained_variance': projection.explained_variance_ratio if projection else 1.0,
+                'exact_recall': exact_recall,
+                'exact_ms_per_query': exact_ms,
+                'estimated_vector_bytes': int(len(corpus) * reduced_corpus.shape[1] * BYTES_PER_DIM[index_type]),
+            }
+            line = (f'{index_type:<10} dims={result["dims"]:<4} variance={result["explained_variance"]:6.1%}  '
+                    f'exact recall@{args.top_k}={exact_recall:.3f}  '
+                    f'vectors~{result["estimated_vector_bytes"] / 1e6:6.2f}MB')
+            if es is not None:
+                result['es'] = bench_es(es, index_type, reduced_corpus, reduced_queries, truth, args.top_k,
+                                        args.num_candidates, args.keep)
+                latency = result['es']['latency']
+                line += (f'  es recall@{args.top_k}={result["es"]["recall"]:.3f} '
+                         f'p50={latency["p50_ms"]:6.2f}ms p95={latency["p95_ms"]:6.2f}ms '
+                         f'store={result["es"]["store_bytes"] / 1e6:6.2f}MB')
+            print(line)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'documents': len(corpus), 'queries': len(queries), 'top_k': args.top_k,
+                       'num_candidates': args.num_candidates, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
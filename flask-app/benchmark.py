@@ -0,0 +1,374 @@
+"""RAG パイプラインのベンチマークスイート (外部サービスなしで実行できる)
+
+Elasticsearch と Groq は fakeservers.py のスタブに向け、遅延と LLM の出力量は引数で変えられる。
+
+    python benchmark.py micro --dummy-encoder --output micro.json
+    python benchmark.py load --dummy-encoder --requests 300 --concurrency 16 --output load.json
+    python benchmark.py all --dummy-encoder --output after.json
+    python benchmark.py compare before.json after.json --threshold 0.1
+
+micro は search / build_prompt / parse_answer を1件ずつ計測する (parse_stream は回答を4文字ずつ渡したとき)。
+suggest は pokedex.db の名前の先頭1〜3文字で入力補完の索引を引く。
+load は /api/search に HTTP で負荷をかけ、{"debug": true} で返る段階ごとの処理時間も集計する。
+--url を省略すると、スタブに向けた Flask アプリ (main.create_app) を子プロセスで起動する。
+compare は2つの結果ファイルを比べ、閾値を超えて悪化した項目があれば終了コード 1 を返す。
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import perf_counter
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import numpy as np
+
+import rag
+from bench_prompt import QUERIES
+from fakeservers import FakeElasticsearch, FakeGroq, FakeServers, fake_answer
+from llm_json import AnswerParser, parse_answer
+from loadtest import DummyEncoder, build_engine
+from suggest import NAME_FIELDS, load_name_index
+
+# compare で比べる指標と、値が大きいほど悪いかどうか
+METRICS = {'p50_ms': True, 'p95_ms': True, 'p99_ms': True, 'throughput': False}
+
+
+def load_model(dummy_encoder):
+    if dummy_encoder:
+        return DummyEncoder()
+    return rag.create_encoder()
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    """latencies は秒。elapsed を渡すとスループット (件/秒) も入れる"""
+    ms = np.asarray(latencies, dtype=np.float64) * 1000
+    stats = {'count': len(latencies), 'errors': errors}
+    if len(ms):
+        stats.update({
+            'mean_ms': round(float(ms.mean()), 3),
+            'p50_ms': round(float(np.percentile(ms, 50)), 3),
+            'p95_ms': round(float(np.percentile(ms, 95)), 3),
+            'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        })
+    if elapsed:
+        stats['throughput'] = round(len(latencies) / elapsed, 2)
+    return stats
+
+
+def timed_loop(fn, inputs, warmup):
+    for item in inputs[:warmup]:
+        fn(item)
+    latencies = []
+    errors = 0
+    t0 = perf_counter()
+    for item in inputs:
+        start = perf_counter()
+        ok = fn(item)
+        if ok is False:
+            errors += 1
+        else:
+            latencies.append(perf_counter() - start)
+    return summarize(latencies, perf_counter() - t0, errors)
+
+
+def parse_stream(text, token_chars=4):
+    # ストリーミングと同じく、トークンごとに feed する
+    parser = AnswerParser()
+    for i in range(0, len(text), token_chars):
+        parser.feed(text[i:i + token_chars])
+    parser.close()
+    return bool(parser.entries)
+
+
+def suggest_names(names, n):
+    # 日本語・英語・中国語の名前を順に混ぜる
+    labels = [entry[field] for entry in names.entries for field, _ in NAME_FIELDS if entry[field]]
+    return [labels[i * 7919 % len(labels)] for i in range(n)]
+
+
+def queries(n):
+    # 埋め込みキャッシュが効かないよう、すべて異なるクエリにする
+    return [f'{QUERIES[i % len(QUERIES)]} {i}' for i in range(n)]
+
+
+def fake_servers(args):
+    return FakeServers(FakeElasticsearch(latency=args.es_latency),
+                       FakeGroq(latency=args.llm_latency, entries=args.llm_entries,
+                                completion_tokens=args.completion_tokens),
+                       process=True)
+
+
+def run_micro(args):
+    model = load_model(args.dummy_encoder)
+    results = {}
+    with fake_servers(args) as servers:
+        engine = build_engine(model, servers)
+        inputs = queries(args.iterations)
+
+        results['micro.search'] = timed_loop(
+            lambda q: isinstance(engine.search(q, args.top_k), list), inputs, args.warmup)
+
+        searched = [(q, engine.search(q, args.top_k)) for q in QUERIES]
+        prompts = [searched[i % len(searched)] for i in range(args.iterations)]
+        results['micro.build_prompt'] = timed_loop(
+            lambda item: bool(engine.build_prompt(*item)), prompts, args.warmup)
+
+    answers = [fake_answer(args.llm_entries)] * args.iterations
+    results['micro.parse_answer'] = timed_loop(
+        lambda text: bool(parse_answer(text).entries), answers, args.warmup)
+    results['micro.parse_stream'] = timed_loop(parse_stream, answers, args.warmup)
+
+    names = load_name_index(rag.POKEDEX_DB_PATH)
+    if names is not None:
+        prefixes = [name[:1 + i % 3] for i, name in enumerate(suggest_names(names, args.iterations))]
+        results['micro.suggest'] = timed_loop(lambda q: bool(names.search(q)), prefixes, args.warmup)
+
+    for name, stats in results.items():
+        print_stats(name, stats)
+    return results
+
+
+def _serve_app(es_url, llm_url, dummy_encoder, ports):
+    import observability
+    from werkzeug.serving import make_server
+    from main import create_app
+
+    engine = build_engine(load_model(dummy_encoder), SimpleNamespace(es_url=es_url, llm_url=llm_url))
+    observability.register_engine(engine)
+    server = make_server('127.0.0.1', 0, create_app(engine), threaded=True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+class AppServer:
+    """スタブに向けた Flask アプリを子プロセスで起動する (負荷生成側と GIL を奪い合わないように)"""
+
+    def __init__(self, servers, dummy_encoder):
+        self.servers = servers
+        self.dummy_encoder = dummy_encoder
+        self._proc = None
+        self.url = None
+
+    def __enter__(self):
+        ports = multiprocessing.Queue()
+        self._proc = multiprocessing.Process(
+            target=_serve_app, args=(self.servers.es_url, self.servers.llm_url, self.dummy_encoder, ports),
+            daemon=True)
+        self._proc.start()
+        self.url = f'http://127.0.0.1:{ports.get(timeout=300)}'
+        return self
+
+    def __exit__(self, *exc):
+        self._proc.terminate()
+        self._proc.join()
+
+
+class SearchClient:
+    """スレッドごとに HTTP 接続を持ち、/api/search を呼ぶ"""
+
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def search(self, query):
+        """(経過秒, 段階ごとの処理時間 ms または None)。失敗したら経過秒は None"""
+        body = json.dumps({'query': query, 'debug': True}, ensure_ascii=False).encode()
+        start = perf_counter()
+        try:
+            conn = self._connection()
+            conn.request('POST', '/api/search', body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self._local.conn = None
+            return None, None
+        elapsed = perf_counter() - start
+        if response.status != 200:
+            return None, None
+        result = json.loads(data)
+        if not isinstance(result.get('search_results'), list):
+            return None, None
+        return elapsed, result.get('debug', {}).get('timings_ms')
+
+
+def run_load(args):
+    if args.url:
+        return load_test(args.url, args)
+    with fake_servers(args) as servers, AppServer(servers, args.dummy_encoder) as app:
+        return load_test(app.url, args)
+
+
+def load_test(url, args):
+    client = SearchClient(url)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(client.search, queries(args.warmup)))
+        t0 = perf_counter()
+        responses = list(pool.map(client.search, [f'load {q}' for q in queries(args.requests)]))
+        elapsed = perf_counter() - t0
+
+    latencies = [seconds for seconds, _ in responses if seconds is not None]
+    stages = {}
+    for _, timings in responses:
+        for stage, ms in (timings or {}).items():
+            stages.setdefault(stage, []).append(ms / 1000)
+
+    results = {'load.request': summarize(latencies, elapsed, errors=len(responses) - len(latencies))}
+    for stage, values in sorted(stages.items()):
+        results[f'load.stage.{stage}'] = summarize(values)
+    for name, stats in results.items():
+        print_stats(name, stats)
+    return results
+
+
+def print_stats(name, stats):
+    if not stats['count']:
+        print(f'{name:<28} no successful samples  errors={stats["errors"]}')
+        return
+    throughput = f'{stats["throughput"]:9.1f}/s' if 'throughput' in stats else ' ' * 11
+    print(f'{name:<28}{throughput}  p50={stats["p50_ms"]:8.2f}ms  p95={stats["p95_ms"]:8.2f}ms  '
+          f'p99={stats["p99_ms"]:8.2f}ms  n={stats["count"]}  errors={stats["errors"]}')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, args, results):
+    meta = {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('command', 'func', 'output')},
+    }
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f'結果を {path} に書き出しました')
+
+
+def compare(baseline, current, threshold=0.1, min_delta_ms=1.0):
+    """悪化率が threshold を超えた指標の一覧 (name, metric, before, after, change)
+
+    1 ms 程度の揺れで誤検知しないよう、差が min_delta_ms 未満の項目は無視する。
+    """
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        for metric, higher_is_worse in METRICS.items():
+            before = baseline[name].get(metric)
+            after = current[name].get(metric)
+            if not before or not after:
+                continue
+            change = (after - before) / before
+            worse = change if higher_is_worse else -change
+            # スループットは1件あたりの時間に直して比べる
+            delta_ms = abs(after - before) if metric.endswith('_ms') else abs(1000 / after - 1000 / before)
+            if delta_ms < min_delta_ms:
+                continue
+            if worse > threshold:
+                regressions.append((name, metric, before, after, change))
+    return regressions
+
+
+def run_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(args.current) as f:
+        current = json.load(f)['results']
+
+    print(f'{"name":<28}{"metric":<12}{"before":>12}{"after":>12}{"change":>9}')
+    for name in sorted(set(baseline) & set(current)):
+        for metric in METRICS:
+            if metric in baseline[name] and metric in current[name]:
+                before, after = baseline[name][metric], current[name][metric]
+                change = (after - before) / before if before else 0.0
+                print(f'{name:<28}{metric:<12}{before:12.2f}{after:12.2f}{change:+9.1%}')
+
+    regressions = compare(baseline, current, args.threshold, args.min_delta_ms)
+    if regressions:
+        print(f'\n閾値 {args.threshold:.0%} を超えて悪化した項目:')
+        for name, metric, before, after, change in regressions:
+            print(f'  {name} {metric}: {before:.2f} -> {after:.2f} ({change:+.1%})')
+        return 1
+    print('\n悪化した項目はありません')
+    return 0
+
+
+def add_common(parser):
+    parser.add_argument('--dummy-encoder', action='store_true', help='SentenceTransformerを読み込まない')
+    parser.add_argument('--es-latency', type=float, default=0.01, help='スタブESの応答遅延(秒)')
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='スタブLLMの応答遅延(秒)')
+    parser.add_argument('--llm-entries', type=int, default=5, help='スタブLLMが返すpokemon_entriesの件数')
+    parser.add_argument('--completion-tokens', type=int, default=400, help='スタブLLMが報告する出力トークン数')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--output', help='結果をJSONで書き出すファイル')
+
+
+def add_micro(parser):
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--top-k', type=int, default=5)
+
+
+def add_load(parser):
+    parser.add_argument('--url', help='負荷をかける起動済みのサーバー (省略時はスタブで起動する)')
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    micro = commands.add_parser('micro', help='search / build_prompt / parse_answer / suggest')
+    add_common(micro)
+    add_micro(micro)
+    micro.set_defaults(func=run_micro)
+
+    load = commands.add_parser('load', help='/api/search への HTTP 負荷試験')
+    add_common(load)
+    add_load(load)
+    load.set_defaults(func=run_load)
+
+    both = commands.add_parser('all', help='micro と load の両方')
+    add_common(both)
+    add_micro(both)
+    add_load(both)
+    both.set_defaults(func=lambda args: {**run_micro(args), **run_load(args)})
+
+    diff = commands.add_parser('compare', help='2つの結果ファイルを比較する')
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument('--threshold', type=float, default=0.1, help='悪化とみなす変化率')
+    diff.add_argument('--min-delta-ms', type=float, default=1.0, help='これ未満の遅延の差は無視する')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        sys.exit(run_compare(args))
+
+    results = args.func(args)
+    if args.output:
+        write_results(args.output, args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter, sleep
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from elasticsearch import ApiError, ConnectionError, ConnectionTimeout
+
+logger = logging.getLogger(__name__)
+
+# 混雑 (429) と一時的な障害はバックオフして再送する
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class BulkResult:
+    def __init__(self):
+        self.succeeded = 0
+        self.failed: List[Dict] = []
+        self.seconds = 0.0
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.succeeded / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f"成功: {self.succeeded}件, 失敗: {len(self.failed)}件, "
+                f"{self.seconds:.1f}秒 ({self.docs_per_sec:.0f} docs/sec)")
+
+
+class _Operation:
+    __slots__ = ('op_type', 'doc_id', 'lines', 'size', 'status', 'reason')
+
+    def __init__(self, op_type, doc_id, lines):
+        self.op_type = op_type
+        self.doc_id = doc_id
+        self.lines = lines
+        self.size = sum(len(line) + 1 for line in lines)
+        self.status = None
+        self.reason = None
+
+
+class BulkIndexer:
+    """_bulk リクエストを件数とバイト数で区切り、複数スレッドで並行に送る
+
+    ドキュメントは1件ずつシリアライズしながらチャンクにまとめるので、
+    メモリに載るのは送信中・送信待ちのチャンクだけ。
+    失敗したドキュメントは _id と理由をログに出し、BulkResult.failed に返す。
+    """
+
+    def __init__(self, es, threads: int = 4, chunk_size: int = 200, max_chunk_bytes: int = 10 * 1024 * 1024,
+                 max_retries: int = 5, initial_backoff: float = 1.0, max_backoff: float = 30.0):
+        self.es = es
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.serializer = es.transport.serializers.get_serializer("application/json")
+
+    def operation(self, header: Dict, source: Optional[Dict]) -> _Operation:
+        op_type, meta = next(iter(header.items()))
+        lines = [self.serializer.dumps(header)]
+        if source is not None:
+            lines.append(self.serializer.dumps(source))
+        return _Operation(op_type, meta.get('_id'), lines)
+
+    def chunks(self, actions: Iterable[Tuple[Dict, Optional[Dict]]]) -> Iterator[List[_Operation]]:
+        chunk: List[_Operation] = []
+        size = 0
+        for header, source in actions:
+            op = self.operation(header, source)
+            if chunk and (len(chunk) >= self.chunk_size or size + op.size > self.max_chunk_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(op)
+            size += op.size
+        if chunk:
+            yield chunk
+
+    def send(self, chunk: List[_Operation]) -> BulkResult:
+        """1チャンクを送り、再送可能なエラーのドキュメントだけをバックオフして送り直す"""
+        result = BulkResult()
+        pending = chunk
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                sleep(min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1)))
+            retry = []
+            try:
+                response = self.es.bulk(operations=[line for op in pending for line in op.lines])
+            except (ConnectionError, ConnectionTimeout) as e:
+                retry = self._mark(pending, None, str(e))
+            except ApiError as e:
+                if e.status_code not in RETRY_STATUSES:
+                    result.failed.extend(self._mark(pending, e.status_code, str(e)))
+                    return result
+                retry = self._mark(pending, e.status_code, str(e))
+            else:
+                for op, item in zip(pending, response['items']):
+                    info = next(iter(item.values()))
+                    if 'error' not in info:
+                        result.succeeded += 1
+                        continue
+                    error = info['error']
+                    reason = f"{error.get('type')}: {error.get('reason')}" if isinstance(error, dict) else str(error)
+                    op.status, op.reason = info.get('status'), reason
+                    (retry if op.status in RETRY_STATUSES else result.failed).append(op)
+            if not retry:
+                break
+            pending = retry
+        else:
+            result.failed.extend(retry)
+        return result
+
+    @staticmethod
+    def _mark(ops: List[_Operation], status, reason) -> List[_Operation]:
+        for op in ops:
+            op.status, op.reason = status, reason
+        return ops
+
+    def run(self, actions: Iterable[Tuple[Dict, Optional[Dict]]]) -> BulkResult:
+        """(アクション行, ドキュメント) の列を送り、全体の結果を返す (delete はドキュメントが None)"""
+        total = BulkResult()
+        t0 = perf_counter()
+
+        def collect(futures):
+            for future in futures:
+                result = future.result()
+                total.succeeded += result.succeeded
+                for op in result.failed:
+                    logger.error(f"ドキュメント {op.doc_id} の{op.op_type}に失敗しました (status={op.status}): {op.reason}")
+                    total.failed.append({'_id': op.doc_id, 'op_type': op.op_type,
+                                         'status': op.status, 'reason': op.reason})
+
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='bulk') as pool:
+            in_flight = set()
+            for chunk in self.chunks(actions):
+                # 送信待ちのチャンクがたまりすぎないよう、スレッド数の2倍で待つ
+                if len(in_flight) >= self.threads * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(pool.submit(self.send, chunk))
+            collect(wait(in_flight).done)
+
+        total.seconds = perf_counter() - t0
+        return total
@@ -0,0 +1,212 @@
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from time import monotonic, time
+
+import numpy as np
+
+# injest.py がインデックスを作り直すたびに更新するファイル
+INDEX_STAMP_PATH = os.getenv('INDEX_STAMP_PATH', '.index_version')
+
+
+def touch_index_stamp(path=INDEX_STAMP_PATH):
+    with open(path, 'w') as f:
+        f.write(str(time()))
+
+
+def read_index_stamp(path=INDEX_STAMP_PATH):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def normalize_query(text):
+    # 全角/半角の揺れ・大文字小文字・空白の違いを同じキーにまとめる
+    text = unicodedata.normalize('NFKC', text or '')
+    return ' '.join(text.casefold().split())
+
+
+class EmbeddingCache:
+    """正規化したクエリ文字列をキーにしたLRU + TTLの埋め込みキャッシュ"""
+
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def after_fork(self):
+        # 親プロセスで持たれたままのロックを引き継がないよう作り直す
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            vector, expires_at = entry
+            if expires_at <= monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        if self.max_size <= 0:
+            return
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        with self._lock:
+            self._entries[key] = (vector, monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, text, compute):
+        key = normalize_query(text)
+        vector = self.get(key)
+        if vector is None:
+            vector = np.asarray(compute(key), dtype=np.float32)
+            self.put(key, vector)
+        return vector
+
+    def get_or_compute_many(self, texts, compute_batch):
+        """未キャッシュのものだけをまとめて compute_batch に渡す"""
+        keys = [normalize_query(text) for text in texts]
+        vectors = [self.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, np.asarray(compute_batch(missing), dtype=np.float32)))
+            for key, vector in computed.items():
+                self.put(key, vector)
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return vectors
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class SemanticAnswerCache:
+    """質問の埋め込みが近く、検索結果の集合が同じ場合にRAGの回答を再利用するキャッシュ"""
+
+    def __init__(self, max_size=256, threshold=0.95, stamp_path=INDEX_STAMP_PATH):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.stamp_path = stamp_path
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._keys = []
+        self._stamp = read_index_stamp(stamp_path)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def result_key(search_results):
+        if not isinstance(search_results, list):
+            return None
+        return frozenset((doc.get('no'), doc.get('form')) for doc in search_results)
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_stamp(self):
+        stamp = read_index_stamp(self.stamp_path)
+        if stamp != self._stamp:
+            self._stamp = stamp
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._matrix = None
+
+    def _rebuild_matrix(self):
+        self._keys = list(self._entries)
+        if self._keys:
+            self._matrix = np.stack([self._entries[k][0] for k in self._keys])
+        else:
+            self._matrix = np.empty((0, 0), dtype=np.float32)
+
+    def lookup(self, query_vector, search_results):
+        result_key = self.result_key(search_results)
+        if result_key is None:
+            return None
+        query_vector = self._unit(query_vector)
+        with self._lock:
+            self._check_stamp()
+            if self._entries:
+                if self._matrix is None:
+                    self._rebuild_matrix()
+                scores = self._matrix @ query_vector
+                for idx in np.argsort(-scores):
+                    if scores[idx] < self.threshold:
+                        break
+                    key = self._keys[idx]
+                    _, cached_key, answer_data = self._entries[key]
+                    if cached_key == result_key:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return answer_data
+            self.misses += 1
+            return None
+
+    def put(self, query_vector, search_results, answer_data):
+        result_key = self.result_key(search_results)
+        if result_key is None or self.max_size <= 0:
+            return
+        query_vector = self._unit(query_vector)
+        key = (query_vector.tobytes(), result_key)
+        with self._lock:
+            self._check_stamp()
+            self._entries[key] = (query_vector, result_key, answer_data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,76 @@
+"""build_prompt の CONTEXT をトークン予算内で組み立てる
+
+1件を1行の表形式にまとめ、種族値は H/A/B/C/D/S の数字だけにする。
+フォーム違いで同じ図鑑説明は2件目以降を省き、予算を超える場合は順位の低い件から落とす。
+"""
+import math
+import re
+
+# 1件目の前に1回だけ置く列の説明
+HEADER = "no|名前|タイプ|特性|H/A/B/C/D/S|説明"
+
+_ASCII_RUN = re.compile(r'[\x00-\x7f]+')
+
+
+def estimate_tokens(text):
+    """トークナイザーを使わない概算。ASCIIは4文字で1トークン、それ以外(かな・漢字)は1文字1トークンとみなす"""
+    ascii_chars = 0
+    tokens = 0
+    for run in _ASCII_RUN.findall(text):
+        ascii_chars += len(run)
+        tokens += math.ceil(len(run) / 4)
+    return tokens + len(text) - ascii_chars
+
+
+def _join(values):
+    return "/".join(str(v) for v in values or [] if v not in (None, ""))
+
+
+class ContextBuilder:
+    def __init__(self, token_budget=1200, max_descriptions=1, max_description_chars=120):
+        self.token_budget = token_budget
+        self.max_descriptions = max_descriptions
+        self.max_description_chars = max_description_chars
+
+    def descriptions(self, doc):
+        descriptions = doc.get('descriptions')
+        if descriptions:
+            return list(descriptions.values())
+        return [doc[key] for key in ('description', 'descriptionViolet') if doc.get(key)]
+
+    def entry(self, doc, seen_descriptions):
+        name = doc.get('nameJa') or doc.get('nameEn') or ''
+        if doc.get('form'):
+            name = f"{name}({doc['form']})"
+        stats = doc.get('stats') or {}
+        stat_values = [stats.get(key) for key in ('hp', 'attack', 'defense', 'specialAttack',
+                                                  'specialDefense', 'speed')]
+
+        # 上位の件 (同じポケモンの別フォームなど) のいずれかのゲームと同じ説明は載せない
+        candidates = [" ".join(str(text).split())[:self.max_description_chars] for text in self.descriptions(doc)]
+        texts = [text for text in candidates if text and text not in seen_descriptions][:self.max_descriptions]
+        seen_descriptions.update(candidates)
+
+        return "|".join([
+            str(doc.get('no', '')),
+            name,
+            _join(doc.get('types')),
+            _join(doc.get('abilities')),
+            "/".join("" if v is None else str(v) for v in stat_values) if stats else "",
+            " ".join(texts),
+        ])
+
+    def build(self, search_results):
+        """(CONTEXT の文字列, 入れた件数) を返す。1件目は予算を超えても必ず入れる"""
+        seen_descriptions = set()
+        lines = [HEADER]
+        tokens = estimate_tokens(HEADER)
+        for doc in search_results:
+            line = self.entry(doc, seen_descriptions)
+            cost = estimate_tokens(line) + 1
+            if len(lines) > 1 and tokens + cost > self.token_budget:
+                # 結果は順位順なので、ここから後ろ (順位の低い件) はすべて落とす
+                break
+            lines.append(line)
+            tokens += cost
+        return "\n".join(lines), len(lines) - 1
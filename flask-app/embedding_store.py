@@ -0,0 +1,76 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """combined_text のハッシュをキーにした、ディスク上の埋め込みキャッシュ
+
+    ベクトルは vectors.f32 に float32 の行として追記し、読み出しはメモリマップで行う。
+    keys.json はハッシュから行番号への対応表。モデルごとに別ディレクトリを使うこと。
+    """
+
+    def __init__(self, directory: str, dim: int = 768):
+        self.directory = directory
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.keys_path = os.path.join(directory, 'keys.json')
+        os.makedirs(directory, exist_ok=True)
+
+        self.keys: Dict[str, int] = {}
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path) as f:
+                self.keys = json.load(f)
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        rows = size // (4 * dim)
+        if size != rows * 4 * dim:
+            # 途中まで書いた行が残っていると、次の追記から行の位置がずれるので切り詰める
+            logger.warning(f"埋め込みキャッシュの末尾に書きかけの行があるため切り詰めます ({size - rows * 4 * dim} バイト)")
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(rows * 4 * dim)
+        if rows < len(self.keys):
+            # 書き込み途中で止まった場合は行が揃っているものだけを使う
+            logger.warning(f"埋め込みキャッシュが壊れています。{rows}行のみ使用します")
+            self.keys = {k: i for k, i in self.keys.items() if i < rows}
+        self._rows = rows
+        self._matrix = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _mmap(self) -> np.ndarray:
+        if self._matrix is None or self._matrix.shape[0] != self._rows:
+            if self._rows == 0:
+                return np.empty((0, self.dim), dtype=np.float32)
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self._rows, self.dim))
+        return self._matrix
+
+    def get_many(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        matrix = self._mmap()
+        return {h: np.asarray(matrix[self.keys[h]]) for h in hashes if h in self.keys}
+
+    def add(self, hashes: List[str], vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        new = {h: v for h, v in zip(hashes, vectors) if h not in self.keys}
+        if not new:
+            return
+        with open(self.vectors_path, 'ab') as f:
+            f.write(np.stack(list(new.values())).tobytes())
+        for h in new:
+            self.keys[h] = self._rows
+            self._rows += 1
+
+        tmp_path = self.keys_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.keys, f)
+        os.replace(tmp_path, self.keys_path)
@@ -0,0 +1,210 @@
+"""クエリ・文書のエンコーダー
+
+どのエンコーダーも SentenceTransformer.encode と同じく、文字列1つなら (次元,)、
+リストなら (件数, 次元) の float32 配列を返す。
+
+    torch      SentenceTransformer をそのまま使う
+    onnx       export_onnx() で書き出したモデルを ONNX Runtime で実行する (torch を読み込まない)
+    onnx-int8  上の重みを動的量子化 (int8) したもの
+
+    python encoders.py export --output onnx_model
+"""
+import argparse
+import inspect
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = 'encoder.json'
+MODEL_FILE = 'model.onnx'
+INT8_MODEL_FILE = 'model.int8.onnx'
+TOKENIZER_FILE = 'tokenizer.json'
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+
+class TorchEncoder:
+    def __init__(self, model_name, threads=0):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            # torch のスレッド数はプロセス全体の設定
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.name = encoder_name('torch', model_name)
+
+    def after_fork(self, threads=0):
+        # fork 前の親プロセスでは推論しないので、OpenMP のスレッドプールはここで初めて作られる
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, **kwargs):
+        return self.model.encode(sentences, batch_size=batch_size, show_progress_bar=show_progress_bar,
+                                 convert_to_numpy=True)
+
+    def start_pool(self, processes):
+        """encode_multi_process に渡すプロセスプール。起動のたびに各プロセスがモデルを読み込むので使い回す"""
+        return self.model.start_multi_process_pool(target_devices=['cpu'] * processes)
+
+    def stop_pool(self, pool):
+        self.model.stop_multi_process_pool(pool)
+
+    def encode_multi_process(self, sentences, processes, batch_size=32, pool=None):
+        """pool を渡せばそれを使う。渡さなければこの呼び出しの間だけプールを起動する"""
+        if pool is not None:
+            return self.model.encode_multi_process(sentences, pool, batch_size=batch_size)
+        pool = self.start_pool(processes)
+        try:
+            return self.model.encode_multi_process(sentences, pool, batch_size=batch_size)
+        finally:
+            self.stop_pool(pool)
+
+
+class OnnxEncoder:
+    """export_onnx() で書き出したディレクトリを読む。平均プーリングはグラフの中で済ませてある"""
+
+    def __init__(self, model_dir, threads=0, quantized=False):
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=self.config['max_seq_length'])
+        self.tokenizer.enable_padding(pad_id=self.config['pad_token_id'], pad_token=self.config['pad_token'])
+
+        self.path = os.path.join(model_dir, INT8_MODEL_FILE if quantized else MODEL_FILE)
+        self.session = self._session(threads)
+        self.name = encoder_name('onnx-int8' if quantized else 'onnx', self.config['model_name'])
+
+    def _session(self, threads):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        return onnxruntime.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+
+    def after_fork(self, threads=0):
+        # ONNX Runtime のセッションは fork 後に使えない (スレッドプールが子プロセスに引き継がれない)
+        self.session = self._session(threads)
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            feeds = {
+                'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            }
+            batches.append(self.session.run(['sentence_embedding'], feeds)[0])
+        if not batches:
+            return np.empty((0, self.config['dim']), dtype=np.float32)
+        vectors = np.concatenate(batches).astype(np.float32, copy=False)
+        if self.config.get('normalize'):
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors[0] if single else vectors
+
+
+def encoder_name(backend, model_name):
+    """モデルを読み込まずに、埋め込みキャッシュのディレクトリ名などに使う名前を返す"""
+    name = os.path.basename(model_name.rstrip('/'))
+    return name if backend == 'torch' else f'{name}-{backend}'
+
+
+def create_encoder(backend, model_name, onnx_dir='onnx_model', threads=0):
+    if backend == 'torch':
+        return TorchEncoder(model_name, threads=threads)
+    if backend in ('onnx', 'onnx-int8'):
+        return OnnxEncoder(onnx_dir, threads=threads, quantized=backend == 'onnx-int8')
+    raise ValueError(f'unknown encoder backend: {backend}')
+
+
+def is_mean_pooling(config):
+    # sentence-transformers のバージョンで設定の持ち方が違う
+    if 'pooling_mode' in config:
+        return config['pooling_mode'] == 'mean'
+    modes = {k for k, v in config.items() if k.startswith('pooling_mode_') and v}
+    return modes == {'pooling_mode_mean_tokens'}
+
+
+def export_onnx(model_name, output_dir, quantize=True, opset=14):
+    """SentenceTransformer (Transformer + 平均プーリング) を ONNX に書き出す
+
+    quantize=True なら重みを int8 に動的量子化したモデルも一緒に書き出す。
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device='cpu')
+    transformer, pooling = model[0], model[1]
+    if not is_mean_pooling(pooling.get_config_dict()) or type(model[-1]).__name__ not in ('Pooling', 'Normalize'):
+        raise ValueError('平均プーリングのモデルのみ書き出せます')
+
+    class MeanPooled(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            hidden = self.auto_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+            return (hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+
+    os.makedirs(output_dir, exist_ok=True)
+    sample = model.tokenizer(['ウォームアップ', 'ピカチュウ'], padding=True, return_tensors='pt')
+    options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # 新しい torch では既定が dynamo 版の exporter になるので、従来の exporter を使う
+        options['dynamo'] = False
+    module = MeanPooled(transformer.auto_model).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            module, (sample['input_ids'], sample['attention_mask']), os.path.join(output_dir, MODEL_FILE),
+            input_names=['input_ids', 'attention_mask'], output_names=['sentence_embedding'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                          'sentence_embedding': {0: 'batch'}},
+            opset_version=opset, **options)
+
+    model.tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, CONFIG_FILE), 'w') as f:
+        json.dump({
+            'model_name': model_name,
+            'max_seq_length': model.max_seq_length,
+            'dim': model.get_sentence_embedding_dimension(),
+            'normalize': type(model[-1]).__name__ == 'Normalize',
+            'pad_token': model.tokenizer.pad_token,
+            'pad_token_id': model.tokenizer.pad_token_id,
+        }, f, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(os.path.join(output_dir, MODEL_FILE), os.path.join(output_dir, INT8_MODEL_FILE),
+                         weight_type=QuantType.QInt8)
+    logger.info(f'{model_name} を {output_dir} に書き出しました')
+    return output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='SentenceTransformer を ONNX に書き出す')
+    export.add_argument('--model', default='paraphrase-multilingual-mpnet-base-v2')
+    export.add_argument('--output', default=os.getenv('ENCODER_ONNX_DIR', 'onnx_model'))
+    export.add_argument('--no-quantize', action='store_true', help='int8 のモデルを書き出さない')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    export_onnx(args.model, args.output, quantize=not args.no_quantize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import logging
+import queue
+import random
+import sqlite3
+import threading
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class EvaluationStore:
+    """関連性評価の状態と結果を保存するSQLiteストア
+
+    status は 'pending' (評価待ち) / 'done' / 'failed'。複数のワーカープロセスで同じDBを共有するので、
+    どのプロセスが受けた評価でも参照できる。
+    """
+
+    def __init__(self, db_path='evaluations.db'):
+        self.db_path = db_path
+        self.reopen()
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS evaluations (
+                request_id TEXT PRIMARY KEY,
+                question TEXT,
+                relevance TEXT,
+                relevance_explanation TEXT,
+                eval_prompt_tokens INTEGER,
+                eval_completion_tokens INTEGER,
+                eval_total_tokens INTEGER,
+                created_at REAL,
+                completed_at REAL,
+                status TEXT NOT NULL DEFAULT 'done'
+            )
+        """)
+        columns = {row['name'] for row in self._conn.execute('PRAGMA table_info(evaluations)')}
+        if 'status' not in columns:
+            # status 列がない古いDBには完了した評価しか入っていない
+            self._conn.execute("ALTER TABLE evaluations ADD COLUMN status TEXT NOT NULL DEFAULT 'done'")
+        self._conn.commit()
+
+    def reopen(self):
+        # SQLite の接続は fork をまたいで使えないので、ワーカープロセスで開き直す
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+
+    def add_pending(self, request_id, question, created_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO evaluations (request_id, question, created_at, status)"
+                " VALUES (?, ?, ?, 'pending')",
+                (request_id, question, created_at),
+            )
+            self._conn.commit()
+
+    def save(self, request_id, question, relevance, token_stats, created_at):
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO evaluations (
+                       request_id, question, relevance, relevance_explanation, eval_prompt_tokens,
+                       eval_completion_tokens, eval_total_tokens, created_at, completed_at, status
+                   ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'done')""",
+                (
+                    request_id,
+                    question,
+                    relevance.get("Relevance", "UNKNOWN"),
+                    relevance.get("relevance_explanation", "Failed to parse evaluation"),
+                    token_stats["prompt_tokens"],
+                    token_stats["completion_tokens"],
+                    token_stats["total_tokens"],
+                    created_at,
+                    time(),
+                ),
+            )
+            self._conn.commit()
+
+    def mark_failed(self, request_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE evaluations SET status = 'failed', completed_at = ? WHERE request_id = ?",
+                (time(), request_id))
+            self._conn.commit()
+
+    def delete(self, request_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM evaluations WHERE request_id = ?', (request_id,))
+            self._conn.commit()
+
+    def get(self, request_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM evaluations WHERE request_id = ?', (request_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+
+class RelevanceEvaluator:
+    """evaluate_relevance をリクエスト処理の外で実行するバックグラウンドワーカー
+
+    キューが一杯のときは評価を捨て、ユーザーのリクエストを待たせない。
+    ワーカースレッドは最初の submit() (gunicorn では after_fork()) で起動するので、
+    fork 前の親プロセスではスレッドを作らない。
+    """
+
+    def __init__(self, evaluate_fn, store, workers=2, queue_size=100, sample_rate=1.0):
+        self.evaluate_fn = evaluate_fn
+        self.store = store
+        self.sample_rate = sample_rate
+        self.queue_size = queue_size
+        self._reset(workers)
+
+    def _reset(self, workers):
+        self.workers = workers
+        self._started = False
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'relevance-eval-{i}', daemon=True).start()
+
+    def after_fork(self, workers):
+        """fork したワーカープロセスで、キューを作り直してワーカースレッドを起動する"""
+        self.store.reopen()
+        self._reset(workers)
+        self.start()
+
+    def submit(self, request_id, question, answer):
+        """評価を予約し、'PENDING' / 'SKIPPED' / 'DROPPED' のいずれかを返す"""
+        if random.random() >= self.sample_rate:
+            with self._lock:
+                self.skipped += 1
+            return 'SKIPPED'
+        if not self._started:
+            self.start()
+        created_at = time()
+        # 他のワーカープロセスからも評価待ちと分かるよう、キューに入れる前にストアへ記録する
+        self.store.add_pending(request_id, question, created_at)
+        try:
+            self._queue.put_nowait((request_id, question, answer, created_at))
+        except queue.Full:
+            self.store.delete(request_id)
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f'評価キューが一杯のため破棄しました: {request_id}')
+            return 'DROPPED'
+        with self._lock:
+            self.submitted += 1
+        return 'PENDING'
+
+    def lookup(self, request_id):
+        row = self.store.get(request_id)
+        if row is not None and row["status"] == "pending":
+            return {"request_id": request_id, "status": "pending"}
+        return row
+
+    def _worker(self):
+        while True:
+            request_id, question, answer, created_at = self._queue.get()
+            try:
+                relevance, token_stats = self.evaluate_fn(question, answer)
+                self.store.save(request_id, question, relevance, token_stats, created_at)
+                with self._lock:
+                    self.completed += 1
+            except Exception as e:
+                logger.error(f'関連性評価に失敗しました {request_id}: {e}')
+                try:
+                    self.store.mark_failed(request_id)
+                except sqlite3.Error as e:
+                    logger.error(f'評価の失敗を記録できませんでした {request_id}: {e}')
+                with self._lock:
+                    self.failed += 1
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "sample_rate": self.sample_rate,
+                "submitted": self.submitted,
+                "skipped": self.skipped,
+                "dropped": self.dropped,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
@@ -0,0 +1,214 @@
+"""負荷試験・ベンチマーク用の Elasticsearch / Groq 互換スタブサーバー
+
+どちらも aiohttp で動き、応答までの遅延とLLMの出力トークン数を指定できる。
+"""
+import asyncio
+import json
+import multiprocessing
+import threading
+
+from aiohttp import web
+
+ES_HEADERS = {'X-Elastic-Product': 'Elasticsearch'}
+
+
+def fake_source(no):
+    return {
+        'name_japanese': f'ポケモン{no}',
+        'name_english': f'Pokemon{no}',
+        'name_chinese': f'宝可梦{no}',
+        'global_no': str(no),
+        'form': '',
+        'types': ['ほのお'],
+        'abilities': ['もうか'],
+        'stats_hp': 50 + no % 50,
+        'stats_attack': 60 + no % 40,
+        'stats_defense': 55,
+        'stats_special_attack': 70,
+        'stats_special_defense': 65,
+        'stats_speed': 80 + no % 30,
+        'description_scarlet': f'ポケモン{no}の説明文。' * 3,
+        'description_violet': f'ポケモン{no}の別の説明文。' * 3,
+    }
+
+
+def fake_answer(entries=5):
+    return json.dumps({
+        "pokemon_entries": [{
+            "no": no,
+            "name": f"ポケモン{no}",
+            "relevance_score": 90 - no,
+            "power_rating": "B",
+            "relevance_analysis": "ほのおタイプで質問に合致する。",
+            "background_story": "夜になると誰もいない部屋から炎の音が聞こえるという。",
+        } for no in range(1, entries + 1)],
+        "summary": {"most_relevant_pokemon": {"no": "1", "name": "ポケモン1", "explanation": "最も関連が高い。"}},
+    }, ensure_ascii=False)
+
+
+class FakeElasticsearch:
+    def __init__(self, latency=0.01, docs=1000, msearch_errors=()):
+        self.latency = latency
+        self.docs = docs
+        # _msearch でエラーを返す検索の位置 (1回のリクエストの中での 0 始まりの番号)
+        self.msearch_errors = set(msearch_errors)
+        self.requests = 0
+
+    def _search_response(self, body):
+        size = body.get('knn', {}).get('k') or body.get('size') or 10
+        hits = [{'_id': str(no), '_score': 1.0 / no, '_source': fake_source(no)}
+                for no in range(1, min(size, self.docs) + 1)]
+        return {'took': int(self.latency * 1000), 'timed_out': False,
+                'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'hits': hits}}
+
+    @staticmethod
+    def _error_response():
+        return {'status': 400, 'error': {'type': 'search_phase_execution_exception',
+                                         'reason': 'all shards failed'}}
+
+    async def info(self, request):
+        return web.json_response({'version': {'number': '8.14.0'}, 'tagline': 'You Know, for Search'},
+                                 headers=ES_HEADERS)
+
+    async def mapping(self, request):
+        index = request.match_info['index']
+        return web.json_response({index: {'mappings': {}}}, headers=ES_HEADERS)
+
+    async def search(self, request):
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(self.latency)
+        return web.json_response(self._search_response(body), headers=ES_HEADERS)
+
+    async def msearch(self, request):
+        self.requests += 1
+        lines = [json.loads(line) for line in (await request.text()).splitlines() if line.strip()]
+        await asyncio.sleep(self.latency)
+        responses = [self._error_response() if i in self.msearch_errors else {**self._search_response(body), 'status': 200}
+                     for i, body in enumerate(lines[1::2])]
+        return web.json_response({'took': 1, 'responses': responses}, headers=ES_HEADERS)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/', self.info)
+        app.router.add_get('/{index}/_mapping', self.mapping)
+        app.router.add_post('/{index}/_search', self.search)
+        app.router.add_post('/_msearch', self.msearch)
+        app.router.add_post('/{index}/_msearch', self.msearch)
+        return app
+
+
+class FakeGroq:
+    def __init__(self, latency=0.5, completion_tokens=400, entries=5, stream_chunks=50):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.entries = entries
+        self.stream_chunks = stream_chunks
+        self.requests = 0
+
+    def _usage(self, messages):
+        prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 2
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': self.completion_tokens,
+                'total_tokens': prompt_tokens + self.completion_tokens}
+
+    async def chat_completions(self, request):
+        self.requests += 1
+        body = await request.json()
+        content = fake_answer(self.entries)
+        usage = self._usage(body.get('messages', []))
+        if body.get('stream'):
+            return await self._stream(request, body, content, usage)
+        await asyncio.sleep(self.latency)
+        return web.json_response({
+            'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': 0, 'model': body.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': usage,
+        })
+
+    async def _stream(self, request, body, content, usage):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        step = max(1, len(content) // self.stream_chunks)
+        delay = self.latency / max(1, len(content) // step)
+        for i in range(0, len(content), step):
+            await asyncio.sleep(delay)
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0,
+                     'model': body.get('model'),
+                     'choices': [{'index': 0, 'delta': {'content': content[i:i + step]}, 'finish_reason': None}]}
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        final = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0,
+                 'model': body.get('model'), 'choices': [], 'usage': usage}
+        await response.write(f'data: {json.dumps(final)}\n\ndata: [DONE]\n\n'.encode())
+        await response.write_eof()
+        return response
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/openai/v1/chat/completions', self.chat_completions)
+        return app
+
+
+def _serve_forever(es, llm, host, urls):
+    servers = FakeServers(es, llm, host).start()
+    urls.put((servers.es_url, servers.llm_url))
+    threading.Event().wait()
+
+
+class FakeServers:
+    """スタブサーバーを別スレッドのイベントループで起動する
+
+    process=True の場合は子プロセスで動かし、計測対象とGILを奪い合わないようにする。
+    """
+
+    def __init__(self, es=None, llm=None, host='127.0.0.1', process=False):
+        self.es = es or FakeElasticsearch()
+        self.llm = llm or FakeGroq()
+        self.host = host
+        self.process = process
+        self._loop = None
+        self._proc = None
+        self._runners = []
+        self.es_url = None
+        self.llm_url = None
+
+    async def _serve(self, app):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, 0)
+        await site.start()
+        self._runners.append(runner)
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{self.host}:{port}'
+
+    def start(self):
+        if self.process:
+            urls = multiprocessing.Queue()
+            self._proc = multiprocessing.Process(
+                target=_serve_forever, args=(self.es, self.llm, self.host, urls), daemon=True)
+            self._proc.start()
+            self.es_url, self.llm_url = urls.get(timeout=30)
+            return self
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self.es_url = asyncio.run_coroutine_threadsafe(self._serve(self.es.app()), self._loop).result()
+        self.llm_url = asyncio.run_coroutine_threadsafe(self._serve(self.llm.app()), self._loop).result()
+        return self
+
+    def stop(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.join()
+            return
+
+        async def cleanup():
+            for runner in self._runners:
+                await runner.cleanup()
+        asyncio.run_coroutine_threadsafe(cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,60 @@
+"""本番用の gunicorn の設定
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+preload_app で親プロセスがモデルを1度だけ読み込み、fork したワーカーはその重みをコピーオンライトで共有する。
+ワーカーは max_requests 件ごとに入れ替え、処理中のリクエストは graceful_timeout まで待ってから終了する。
+入れ替えたワーカーも読み込み済みの親から fork するので、モデルを読み直さない。
+"""
+import gc
+import os
+import shutil
+import tempfile
+
+bind = os.getenv('WEB_BIND', '0.0.0.0:8080')
+workers = int(os.getenv('WEB_WORKERS', '2'))
+# リクエストの大半は LLM の応答待ちなので、ワーカーごとにスレッドで並行に処理する
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))
+preload_app = True
+timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '2000'))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', '200'))
+
+# ワーカーごとの torch / BLAS の計算スレッド数。ワーカー数 × この値が CPU 数を超えないようにする
+compute_threads = int(os.getenv('WORKER_COMPUTE_THREADS', str(max(1, (os.cpu_count() or 1) // workers))))
+
+# この設定ファイルはアプリ (torch / numpy / prometheus_client) より先に読み込まれるので、ここで環境変数を決める
+for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(name, str(compute_threads))
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+# /metrics で全ワーカーの値を合算する
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'rag-prometheus'))
+
+
+def on_starting(server):
+    # 前回の起動で残ったワーカーのメトリクスを消す
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def when_ready(server):
+    # 読み込み済みのオブジェクトを GC の対象から外し、ワーカーの GC が共有ページに書き込まないようにする
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import wsgi
+
+    wsgi.engine.after_fork(encoder_threads=compute_threads)
+    # リクエストを受ける前にワーカーごとにウォームアップする (入れ替えたワーカーも最初から温まっている)
+    wsgi.engine.warmup()
+    server.log.info(f'worker {worker.pid} ready (compute_threads={compute_threads})')
+
+
+def child_exit(server, worker):
+    import observability
+
+    observability.mark_process_dead(worker.pid)
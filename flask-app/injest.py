@@ -1,11 +1,24 @@
 import sqlite3
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from elasticsearch import Elasticsearch
-from typing import List, Dict, Any
+import numpy as np
+from elasticsearch import Elasticsearch, NotFoundError, helpers
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple, Union
+import argparse
 import ast
+import contextlib
+import itertools
 import logging
-from tqdm import tqdm
+import os
+import queue
+import threading
+import time
+from bulk_indexer import BulkIndexer, BulkResult
+from cache import touch_index_stamp
+from embedding_store import EmbeddingStore, content_hash
+from encoders import create_encoder, encoder_name
+from projection import PcaProjection, index_meta
+from regions import REGION_GAMES
+from retrievers import LocalIndexWriter
 
 # ログ設定
 logging.basicConfig(
@@ -14,31 +27,197 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_DONE = object()
+
+
+def iter_pipeline(source: Iterable, stage: Callable, depth: int = 2) -> Iterator:
+    """source の読み出しと stage をそれぞれ別スレッドで並行に動かし、stage の結果を順に返す
+
+    段の間のキューは depth 件で頭打ちになるので、全体の件数が増えてもメモリに載るのは数チャンク分だけ。
+    どこかで例外が出たら全体を止めて送出する。途中で close() すれば読み出しも止まる。
+    """
+    read_queue = queue.Queue(maxsize=depth)
+    stage_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def fail(e):
+        errors.append(e)
+        stop.set()
+
+    def reader():
+        try:
+            for item in source:
+                if not put(read_queue, item):
+                    return
+        except BaseException as e:
+            fail(e)
+        finally:
+            put(read_queue, _DONE)
+
+    def worker():
+        try:
+            while True:
+                item = get(read_queue)
+                if item is _DONE or not put(stage_queue, stage(item)):
+                    return
+        except BaseException as e:
+            fail(e)
+        finally:
+            put(stage_queue, _DONE)
+
+    threads = [threading.Thread(target=reader, name='ingest-read', daemon=True),
+               threading.Thread(target=worker, name='ingest-stage', daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = get(stage_queue)
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+# dense_vector の index_options.type
+VECTOR_INDEX_TYPES = ("hnsw", "int8_hnsw", "int4_hnsw", "flat", "int8_flat", "int4_flat")
+# hnsw 以外の型が使える最初の ES のバージョン
+VECTOR_INDEX_MIN_VERSIONS = {
+    "int8_hnsw": (8, 12),
+    "flat": (8, 13),
+    "int8_flat": (8, 13),
+    "int4_hnsw": (8, 15),
+    "int4_flat": (8, 15),
+}
+
+
 class PokemonIngest:
-    def __init__(self, model_path: str = "paraphrase-multilingual-mpnet-base-v2", es_host: str = "http://localhost:9200"):
+    def __init__(self, model_path: str = "paraphrase-multilingual-mpnet-base-v2", es_host: str = "http://localhost:9200",
+                 encode_batch_size: int = 64, encode_processes: int = 0,
+                 embedding_cache_dir: str = "embeddings", embedding_dim: int = 768,
+                 replicas: int = 0, retention: int = 3, bulk_threads: int = 4, bulk_chunk_size: int = 200,
+                 bulk_max_bytes: int = 10 * 1024 * 1024, bulk_max_retries: int = 5,
+                 encoder_backend: str = 'torch', onnx_dir: str = 'onnx_model', encoder_threads: int = 0,
+                 vector_index_type: str = 'hnsw', vector_dims: int = 0, projection_dir: str = 'projections',
+                 projection_samples: int = 20000, forcemerge_timeout: float = 3600):
         """
         イニシャライザー
         Args:
             model_path: sentence-transformerモデルのパス
             es_host: Elasticsearchホストアドレス
+            encode_batch_size: 1回のエンコードに渡す文の数
+            encode_processes: エンコードに使うプロセス数 (0ならこのプロセスのみ)
+            embedding_cache_dir: 埋め込みキャッシュの保存先
+            embedding_dim: 埋め込みの次元数
+            replicas: 登録完了後のレプリカ数
+            retention: 残しておくインデックスのバージョン数 (ロールバック用)
+            bulk_threads: 並行に送る _bulk リクエストの数
+            bulk_chunk_size: 1回の _bulk に入れる最大件数
+            bulk_max_bytes: 1回の _bulk の最大バイト数
+            bulk_max_retries: 429 や一時的な障害のときに再送する回数
+            encoder_backend: エンコーダーの実装 (torch / onnx / onnx-int8)
+            onnx_dir: encoders.py export で書き出した ONNX モデルのディレクトリ
+            encoder_threads: エンコードに使うスレッド数 (0ならライブラリの既定値)
+            vector_index_type: combined_text_vector の index_options.type (VECTOR_INDEX_TYPES のいずれか)
+            vector_dims: PCA で削減する次元数 (0なら削減しない)
+            projection_dir: PCA の射影行列の保存先 (検索側の VECTOR_PROJECTION_DIR と同じ場所)
+            projection_samples: PCA の学習に使う最大件数
+            forcemerge_timeout: 登録後の forcemerge を待つ秒数 (クライアントの既定の10秒では足りない)
         """
-        self.model = SentenceTransformer(model_path)
+        # モデルはエンコードが必要になるまで読み込まない (差分がなければ読み込まずに終わる)
+        self.model_path = model_path
+        self._model = None
+        self.encoder_backend = encoder_backend
+        self.onnx_dir = onnx_dir
+        self.encoder_threads = encoder_threads
+        if vector_index_type not in VECTOR_INDEX_TYPES:
+            raise ValueError(f"unknown vector index type: {vector_index_type}")
+        self.vector_index_type = vector_index_type
+        self._vector_index_checked = False
+        self.vector_dims = vector_dims
+        self.projection_dir = projection_dir
+        self.projection_samples = projection_samples
+        self.forcemerge_timeout = forcemerge_timeout
+        self.projection: Optional[PcaProjection] = None
         self.es = Elasticsearch([es_host])
-        
-    def prepare_data(self, db_path: str = 'pokedex.db') -> pd.DataFrame:
+        self.encode_batch_size = encode_batch_size
+        self.encode_processes = encode_processes
+        # encode_session() の間だけ使い回すエンコード用のプロセスプール
+        self._in_encode_session = False
+        self._encode_pool = None
+        self.replicas = replicas
+        self.retention = retention
+        self.bulk_indexer = BulkIndexer(self.es, threads=bulk_threads, chunk_size=bulk_chunk_size,
+                                        max_chunk_bytes=bulk_max_bytes, max_retries=bulk_max_retries)
+        # 量子化したモデルの埋め込みは元のモデルと少し違うので、バックエンドごとに分けてキャッシュする
+        self.embedding_store = EmbeddingStore(
+            os.path.join(embedding_cache_dir, encoder_name(encoder_backend, model_path)), dim=embedding_dim)
+
+    @property
+    def model(self):
+        if self._model is None:
+            logger.info(f"モデル {self.model_path} ({self.encoder_backend}) を読み込み中...")
+            self._model = create_encoder(self.encoder_backend, self.model_path, onnx_dir=self.onnx_dir,
+                                         threads=self.encoder_threads)
+        return self._model
 
-        logger.info("loading...")
+    @model.setter
+    def model(self, model) -> None:
+        self._model = model
         
+    def prepare_data(self, db_path: str = 'pokedex.db', tables: Optional[List[str]] = None) -> pd.DataFrame:
+        """全テーブルを1つの DataFrame に読み込む (テーブルにない説明の列は欠損になる)"""
+        result_df = pd.concat(list(self.iter_data(db_path, tables=tables)), ignore_index=True)
+        logger.info(f"{len(result_df)} records load complete")
+        return result_df
+
+    def iter_data(self, db_path: str = 'pokedex.db', tables: Optional[List[str]] = None,
+                  chunksize: int = 500) -> Iterator[pd.DataFrame]:
+        """地方図鑑テーブルを chunksize 行ずつ読み、prepare_data と同じ列の DataFrame を返す
+
+        テーブル全体はメモリに載せない。pokedex は名前の対応表なので最初に全件読む。
+        """
+        tables = list(REGION_GAMES) if tables is None else tables
+        unknown = [table for table in tables if table not in REGION_GAMES]
+        if unknown:
+            raise ValueError(f"未対応のテーブルです: {unknown}")
+
         with sqlite3.connect(db_path) as conn:
-            # 读取数据
-            df_paldea = pd.read_sql_query("SELECT * FROM paldea", conn)
-            df_pokedex = pd.read_sql_query("SELECT * FROM pokedex", conn).drop('form', axis=1)
-            
-            # 合并数据
-            merged_df = pd.merge(df_paldea, df_pokedex, 
-                            left_on='globalNo', right_on='id', 
-                            how='left')
-        
+            df_pokedex = pd.read_sql_query("SELECT * FROM pokedex", conn).drop(['form', 'region'], axis=1)
+            for table in tables:
+                logger.info(f"loading {table}...")
+                for chunk in pd.read_sql_query(f"SELECT * FROM {table}", conn, chunksize=chunksize):
+                    yield self.normalize_table(chunk, df_pokedex, table)
+
+    def normalize_table(self, df_region: pd.DataFrame, df_pokedex: pd.DataFrame, region: str) -> pd.DataFrame:
+        """地方図鑑の行に名前を結合し、ゲームごとの説明を description_<ゲーム> の列にする"""
+        # 合并数据
+        merged_df = pd.merge(df_region, df_pokedex,
+                        left_on='globalNo', right_on='id',
+                        how='left')
+
         # 使用pandas的矢量化操作处理数据
         result_df = pd.DataFrame({
             'name_japanese': merged_df['jpn'].astype(str).replace('nan', ''),
@@ -46,6 +225,7 @@ class PokemonIngest:
             'name_chinese': merged_df['chs'].astype(str).replace('nan', ''),
             'global_no': merged_df['globalNo'].astype(str).where(merged_df['globalNo'].notna(), None),
             'form': merged_df['form'].astype(str).replace('nan', ''),
+            'region': region,
             'types': merged_df.apply(lambda x: [t for t in [x['type1'], x['type2']] if pd.notna(t)], axis=1),
             'abilities': merged_df.apply(lambda x: [a for a in [x['ability1'], x['ability2'], x['dream_ability']] 
                                                 if pd.notna(a)], axis=1),
@@ -55,11 +235,11 @@ class PokemonIngest:
             'stats_special_attack': merged_df['special_attack'].where(merged_df['special_attack'].notna(), None).astype('Int64'),
             'stats_special_defense': merged_df['special_defense'].where(merged_df['special_defense'].notna(), None).astype('Int64'),
             'stats_speed': merged_df['speed'].where(merged_df['speed'].notna(), None).astype('Int64'),
-            'description_scarlet': merged_df['scarlet'].astype(str).where(merged_df['scarlet'].notna(), None),
-            'description_violet': merged_df['violet'].astype(str).where(merged_df['violet'].notna(), None)
+            **{
+                f'description_{game}': merged_df[game].astype(str).where(merged_df[game].notna(), None)
+                for game in REGION_GAMES[region]
+            }
         })
-
-        logger.info(f"{len(result_df)} records load complete")
         return result_df
 
     def safe_process(self, value: Any, field_type: str) -> str:
@@ -88,40 +268,362 @@ class PokemonIngest:
             value = df[col]
             text_fields.append(f"{value}")
         
-        print('text_fields:', text_fields)
         return " ".join(text_fields)
 
+    def combine_texts(self, df: pd.DataFrame) -> pd.Series:
+        """create_combined_text と同じ形の文字列を列単位でまとめて作る
+
+        region は含めない。説明文は欠損しているものと、同じ行の別のゲームと同じ文は除く。
+        """
+        text_cols = [col for col in df.columns if not col.startswith('stats_') and col != 'region']
+        is_description = [col.startswith('description_') for col in text_cols]
+
+        def join(values):
+            seen = set()
+            parts = []
+            for description, value in zip(is_description, values):
+                if description:
+                    if not isinstance(value, str) or value in seen:
+                        continue
+                    seen.add(value)
+                parts.append(str(value))
+            return " ".join(parts)
+
+        return pd.Series([join(values) for values in zip(*(df[col] for col in text_cols))], index=df.index)
 
     def generate_vector(self, text: str) -> List[float]:
         return self.model.encode(text, show_progress_bar=False).tolist()
 
-    def process_dataframe(self, df: pd.DataFrame) -> List[Dict]:
+    @contextlib.contextmanager
+    def encode_session(self):
+        """with の間、複数プロセスでのエンコードに1つのプロセスプールを使い回す
+
+        チャンクごとにプールを起動し直すと、そのたびに各プロセスがモデルを読み込み直す。
+        プールは最初にエンコードが必要になったときに起動する (差分がなければ起動しない)。
+        """
+        self._in_encode_session = True
+        try:
+            yield self
+        finally:
+            self._in_encode_session = False
+            if self._encode_pool is not None:
+                pool, self._encode_pool = self._encode_pool, None
+                self.model.stop_pool(pool)
+
+    def generate_vectors(self, texts: List[str]) -> np.ndarray:
+        """テキストをバッチでエンコードし、(件数, 次元) の連続したfloat32行列を返す"""
+        # ONNX Runtime は1プロセスの中でスレッド並列に計算するので、複数プロセスは torch のみ
+        if self.encode_processes > 1 and hasattr(self.model, 'encode_multi_process'):
+            if self._in_encode_session and self._encode_pool is None:
+                logger.info(f"エンコード用に {self.encode_processes} プロセスを起動します")
+                self._encode_pool = self.model.start_pool(self.encode_processes)
+            vectors = self.model.encode_multi_process(texts, self.encode_processes, batch_size=self.encode_batch_size,
+                                                      pool=self._encode_pool)
+        else:
+            vectors = self.model.encode(texts, batch_size=self.encode_batch_size,
+                                        convert_to_numpy=True, show_progress_bar=True)
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+
+    def embed_dataframe(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, np.ndarray]:
         logger.info("データ処理開始...")
         df = df.copy()
         
         logger.info("テキスト結合中...")
-        df['combined_text'] = df.apply(self.create_combined_text, axis=1)
+        df['combined_text'] = self.combine_texts(df)
         
-        logger.info("ベクトル生成中...")
-        tqdm.pandas(desc="データ処理", bar_format='{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}')
-        df['combined_text_vector'] = df['combined_text'].progress_apply(self.generate_vector)
+        logger.info(f"ベクトル生成中 (batch_size={self.encode_batch_size}, processes={self.encode_processes})...")
+        embeddings = self.generate_vectors(df['combined_text'].tolist())
         
         logger.info("データ処理完了")
-        return df.to_dict('records')
-    
-    def create_index(self, index_name: str = "") -> None:
+        return df, embeddings
+
+    @staticmethod
+    def compact_document(row: Dict) -> Dict:
+        # 他の地方のゲームの説明列 (欠損) は送らない
+        return {k: v for k, v in row.items() if not k.startswith('description_') or isinstance(v, str)}
+
+    def iter_documents(self, df: pd.DataFrame, embeddings: np.ndarray) -> Iterator[Dict]:
+        # 行の dict とベクトルのリストへの変換は1件ずつ、送信直前まで遅らせる
+        if self.projection is not None:
+            embeddings = self.projection.transform(embeddings)
+        columns = list(df.columns)
+        for values, vector in zip(zip(*(df[col] for col in columns)), embeddings):
+            row = self.compact_document(dict(zip(columns, values)))
+            row['combined_text_vector'] = vector.tolist()
+            yield row
+
+    def process_dataframe(self, df: pd.DataFrame) -> List[Dict]:
+        df, embeddings = self.embed_dataframe(df)
+        return list(self.iter_documents(df, embeddings))
+
+    @staticmethod
+    def document_id(row: pd.Series) -> str:
+        # 同じ図鑑番号・フォームでもメガシンカ等は名前が異なるので名前も含める
+        # 同じポケモンが複数の地方図鑑に載るので地方も含める
+        region = row.get('region')
+        prefix = f"{region}-" if region else ""
+        return f"{prefix}{row['global_no']}-{row['form']}-{row['name_english']}"
+
+    def prepare_documents(self, df: pd.DataFrame) -> pd.DataFrame:
+        """_id と combined_text のハッシュを付け、同じ _id の重複行を除く"""
+        df = df.copy()
+        df['combined_text'] = self.combine_texts(df)
+        df['_id'] = df.apply(self.document_id, axis=1)
+        df['content_hash'] = df['combined_text'].map(content_hash)
+        return df.drop_duplicates(subset='_id', keep='first').reset_index(drop=True)
+
+    def iter_prepared(self, data: Union[pd.DataFrame, Iterable[pd.DataFrame]]) -> Iterator[pd.DataFrame]:
+        """DataFrame または DataFrame のチャンク列に prepare_documents を適用し、チャンクをまたぐ _id の重複も除く"""
+        chunks = [data] if isinstance(data, pd.DataFrame) else data
+        seen = set()
+        for chunk in chunks:
+            chunk = self.prepare_documents(chunk)
+            chunk = chunk.loc[~chunk['_id'].isin(seen)].reset_index(drop=True)
+            seen.update(chunk['_id'])
+            if len(chunk):
+                yield chunk
+
+    def embed_with_cache(self, df: pd.DataFrame) -> np.ndarray:
+        """ディスクの埋め込みキャッシュにないテキストだけをエンコードする"""
+        hashes = df['content_hash'].tolist()
+        cached = self.embedding_store.get_many(hashes)
+        missing = df.loc[~df['content_hash'].isin(cached.keys())].drop_duplicates(subset='content_hash')
+        logger.info(f"埋め込みキャッシュ: {len(cached)}件ヒット / {len(missing)}件をエンコード")
+        if len(missing):
+            vectors = self.generate_vectors(missing['combined_text'].tolist())
+            self.embedding_store.add(missing['content_hash'].tolist(), vectors)
+            cached.update(zip(missing['content_hash'], vectors))
+        if not hashes:
+            return np.empty((0, self.embedding_store.dim), dtype=np.float32)
+        return np.stack([cached[h] for h in hashes]).astype(np.float32, copy=False)
+
+    def fetch_index_hashes(self, index_name: str) -> Dict[str, str]:
+        """インデックス済みドキュメントの _id -> content_hash"""
+        if not self.es.indices.exists(index=index_name):
+            return {}
+        return {
+            hit['_id']: hit['_source'].get('content_hash')
+            for hit in helpers.scan(self.es, index=index_name, _source=['content_hash'],
+                                    query={"query": {"match_all": {}}})
+        }
+
+    def sync_index(self, data: Union[pd.DataFrame, Iterable[pd.DataFrame]], index_name: str,
+                   full: bool = False) -> bool:
+        """新規・変更された行だけを再エンコードして登録し、元データから消えた行を削除する
+
+        data はチャンクの列でもよい。読み出し・エンコード・登録はチャンク単位で並行に進める。
+
+        Returns:
+            インデックスに変更があったかどうか
+        """
+        chunks = self.iter_prepared(data)
+
+        if full or not self.es.indices.exists_alias(name=index_name):
+            self.rebuild_index(chunks, alias=index_name)
+            return True
+        if self.current_index_meta(index_name) != self.index_meta():
+            logger.info("ベクトルの格納設定が変わったので、インデックスを作り直します")
+            self.rebuild_index(chunks, alias=index_name)
+            return True
+
+        indexed = self.fetch_index_hashes(index_name)
+        seen = set()
+        total = 0
+        changed_count = 0
+
+        def embed_changed(chunk):
+            nonlocal total, changed_count
+            seen.update(chunk['_id'])
+            changed = chunk.loc[[indexed.get(doc_id) != h for doc_id, h in zip(chunk['_id'], chunk['content_hash'])]]
+            total += len(chunk)
+            changed_count += len(changed)
+            return changed, self.embed_with_cache(changed) if len(changed) else None
+
+        # 変更のあったチャンクをまとめて1回の一括登録に流す (チャンクごとにスレッドプールを作り直さない)
+        staged = iter_pipeline(chunks, embed_changed)
+        try:
+            result = self.bulk_index_stream(
+                (doc for changed, embeddings in staged if len(changed)
+                 for doc in self.iter_documents(changed, embeddings)),
+                index_name=index_name)
+        finally:
+            staged.close()
+
+        deleted = sorted(set(indexed) - seen)
+        logger.info(f"{total}件中 変更/新規: {changed_count}件, 削除: {len(deleted)}件")
+        if deleted:
+            self.bulk_delete_documents(deleted, index_name=index_name)
+        if result is not None and result.failed:
+            # 失敗したドキュメントは古い content_hash のままなので、次回の実行で登録し直される
+            raise RuntimeError(f"{len(result.failed)}件のドキュメントをインデックス {index_name} に登録できませんでした")
+        return bool(changed_count or deleted)
+
+    def check_vector_index_type(self) -> None:
+        """クラスタが vector_index_type に対応していなければ、警告して hnsw に戻す (確かめるのは1回だけ)"""
+        if self._vector_index_checked:
+            return
+        self._vector_index_checked = True
+        required = VECTOR_INDEX_MIN_VERSIONS.get(self.vector_index_type)
+        if required is None:
+            return
+        number = self.es.info()["version"]["number"]
+        version = tuple(int(part) for part in number.split("-")[0].split(".")[:2])
+        if version < required:
+            logger.warning(f"Elasticsearch {number} は {self.vector_index_type} に対応していないため hnsw を使います "
+                           f"({'.'.join(map(str, required))} 以降が必要)")
+            self.vector_index_type = "hnsw"
+
+    def index_meta(self) -> Dict[str, Any]:
+        """インデックスの _meta に書く、ベクトルの格納設定"""
+        # 古いクラスタで毎回「設定が変わった」と判定して作り直さないよう、実際に使う型で比べる
+        self.check_vector_index_type()
+        return {
+            "vector_index_type": self.vector_index_type,
+            "vector_dims": self.projection.dims if self.projection is not None else self.embedding_store.dim,
+            "projection": self.projection.fingerprint if self.projection is not None else None,
+        }
+
+    def current_index_meta(self, index_name: str) -> Dict[str, Any]:
+        # _meta を書く前に作ったインデックスは、削減なしの hnsw とみなす
+        defaults = {"vector_index_type": "hnsw", "vector_dims": self.embedding_store.dim, "projection": None}
+        return {**defaults, **index_meta(self.es, index_name)}
+
+    def prepare_projection(self, data: Union[pd.DataFrame, Iterable[pd.DataFrame]], index_name: str,
+                           refit: bool = False) -> None:
+        """vector_dims が指定されていれば、登録に使う PCA の射影を用意する
+
+        いまのインデックスが同じ次元数の射影を使っていればそれを使い続け (差分登録のまま)、
+        refit=True か射影が無ければ全件の埋め込みで学習し直す。埋め込みはディスクキャッシュに残るので、
+        続く登録でもう一度エンコードすることはない。
+        """
+        if not self.vector_dims:
+            self.projection = None
+            return
+        if not refit and self.es.indices.exists_alias(name=index_name):
+            fingerprint = self.current_index_meta(index_name)["projection"]
+            path = os.path.join(self.projection_dir, f"{fingerprint}.npz")
+            if fingerprint and os.path.exists(path):
+                projection = PcaProjection.load(path)
+                if projection.dims == self.vector_dims:
+                    self.projection = projection
+                    logger.info(f"既存の射影 {fingerprint} を使います")
+                    return
+
+        vectors = [self.embed_with_cache(chunk) for chunk in self.iter_prepared(data)]
+        self.projection = PcaProjection.fit(np.concatenate(vectors), self.vector_dims,
+                                            max_samples=self.projection_samples)
+        self.projection.save(self.projection_dir)
+        logger.info(f"PCA で {self.embedding_store.dim} -> {self.vector_dims} 次元に削減します "
+                    f"(射影 {self.projection.fingerprint}, 累積寄与率 {self.projection.explained_variance_ratio:.1%})")
+
+    def export_local_index(self, data: Union[pd.DataFrame, Iterable[pd.DataFrame]], directory: str) -> None:
+        """ES を使わない NumpyRetriever 用にベクトル行列とメタデータをチャンクごとに書き出す"""
+        writer = LocalIndexWriter(directory)
+        for chunk in self.iter_prepared(data):
+            embeddings = self.embed_with_cache(chunk)
+            meta = chunk.drop(columns=['combined_text', 'content_hash', '_id'])
+            meta = meta.astype(object).where(meta.notna(), None)
+            writer.add([self.compact_document(row) for row in meta.to_dict('records')], embeddings)
+        writer.commit()
+        logger.info(f"ローカルインデックスを {directory} に書き出しました ({len(writer)}件)")
+
+    def rebuild_index(self, chunks: Iterable[pd.DataFrame], alias: str) -> str:
+        """新しいバージョンのインデックスに全件登録してからエイリアスを切り替える
+
+        切り替えまでは既存のインデックスで検索を続けられる。
+        """
+        index_name = f"{alias}_v{time.strftime('%Y%m%d%H%M%S')}"
+        self.create_index(index_name=index_name, bulk_load=True)
+
+        staged = iter_pipeline(chunks, lambda chunk: (chunk, self.embed_with_cache(chunk)))
+        try:
+            result = self.bulk_index_documents(
+                (doc for chunk, embeddings in staged for doc in self.iter_documents(chunk, embeddings)),
+                index_name=index_name)
+        finally:
+            staged.close()
+        if result.failed:
+            # 欠けたインデックスには切り替えず、完全な古いバージョンも消さない
+            self.es.indices.delete(index=index_name)
+            raise RuntimeError(f"{len(result.failed)}件のドキュメントを登録できなかったため、"
+                               f"{index_name} を削除してエイリアス {alias} はそのままにしました")
+
+        self.finalize_index(index_name)
+        self.swap_alias(alias, index_name)
+        self.prune_versions(alias)
+        return index_name
+
+    def finalize_index(self, index_name: str) -> None:
+        logger.info(f"インデックス {index_name} を最適化中...")
+        self.es.indices.put_settings(index=index_name, settings={
+            "index": {"refresh_interval": None, "number_of_replicas": self.replicas}
+        })
+        self.es.indices.refresh(index=index_name)
+        # セグメントの統合は大きなインデックスでは数分かかるので、この呼び出しだけタイムアウトを延ばす
+        self.es.options(request_timeout=self.forcemerge_timeout).indices.forcemerge(
+            index=index_name, max_num_segments=1)
+
+    def index_versions(self, alias: str) -> List[str]:
+        # 名前にタイムスタンプが入っているので名前順 = 作成順
+        return sorted(self.es.indices.get(index=f"{alias}_v*", expand_wildcards="open").keys())
+
+    def swap_alias(self, alias: str, index_name: str) -> None:
+        actions = []
+        if self.es.indices.exists(index=alias) and not self.es.indices.exists_alias(name=alias):
+            # エイリアス導入前の実インデックスは切り替えと同時に削除する
+            actions.append({"remove_index": {"index": alias}})
+        elif self.es.indices.exists_alias(name=alias):
+            for current in self.es.indices.get_alias(name=alias):
+                actions.append({"remove": {"index": current, "alias": alias}})
+        actions.append({"add": {"index": index_name, "alias": alias}})
+        self.es.indices.update_aliases(actions=actions)
+        logger.info(f"エイリアス {alias} を {index_name} に切り替えました")
+
+    def rollback(self, alias: str) -> str:
+        """エイリアスを1つ前のバージョンに戻す"""
+        versions = self.index_versions(alias)
+        try:
+            current = set(self.es.indices.get_alias(name=alias))
+        except NotFoundError:
+            raise RuntimeError(f"エイリアス {alias} がないため戻せません") from None
+        older = [v for v in versions if v < min(current)]
+        if not older:
+            raise RuntimeError(f"{alias} に戻せる古いバージョンがありません")
+        self.swap_alias(alias, older[-1])
+        return older[-1]
+
+    def prune_versions(self, alias: str) -> None:
+        current = set(self.es.indices.get_alias(name=alias))
+        versions = self.index_versions(alias)
+        for index_name in versions[:-self.retention] if self.retention > 0 else versions:
+            if index_name not in current:
+                self.es.indices.delete(index=index_name)
+                logger.info(f"古いインデックス {index_name} を削除しました")
+
+    def create_index(self, index_name: str = "", bulk_load: bool = False) -> None:
+        meta = self.index_meta()
         index_settings = {
             "settings": {
                 "number_of_shards": 1,
-                "number_of_replicas": 0
+                "number_of_replicas": 0,
+                # 一括登録中はリフレッシュを止める
+                "refresh_interval": "-1" if bulk_load else None
             },
             "mappings": {
+                # 地方ごとのゲームの説明列 (description_red など) も全文検索の対象にする
+                "dynamic_templates": [{
+                    "descriptions": {
+                        "match": "description_*",
+                        "mapping": {"type": "text"}
+                    }
+                }],
                 "properties": {
                     "global_no": {"type": "keyword"},
                     "name_japanese": {"type": "text"},
                     "name_english": {"type": "text"},
                     "name_chinese": {"type": "text"}, 
                     "form": {"type": "keyword"},
+                    "region": {"type": "keyword"},
                     "types": {"type": "keyword"},
                     "abilities": {"type": "keyword"},
                     "stats_hp": {"type": "integer"},
@@ -132,60 +634,114 @@ class PokemonIngest:
                     "stats_speed": {"type": "integer"},
                     "description_scarlet": {"type": "text"},
                     "description_violet": {"type": "text"},
+                    "content_hash": {"type": "keyword"},
                     "combined_text_vector": {
                         "type": "dense_vector",
-                        "dims": 768,
+                        "dims": meta["vector_dims"],
                         "index": True,
                         "similarity": "cosine"
                     }
-                }
+                },
+                # 検索側はここを見て同じ射影をクエリに適用する
+                "_meta": meta
             }
         }
-
-        self.es.indices.delete(index=index_name, ignore_unavailable=True)
+        if self.vector_index_type != "hnsw":
+            # 対応していないクラスタでは index_meta() で hnsw に戻してある
+            index_settings["mappings"]["properties"]["combined_text_vector"]["index_options"] = {
+                "type": self.vector_index_type
+            }
 
         self.es.indices.create(index=index_name, body=index_settings)
         logger.info(f"インデックス {index_name} の作成が完了しました")
 
-    def bulk_index_documents(self, documents: List[Dict], 
-                           index_name: str = "test2", 
-                           batch_size: int = 100) -> None:
-
+    def bulk_index_documents(self, documents: Iterable[Dict], index_name: str = "test2") -> BulkResult:
         logger.info(f"インデックス {index_name} へのドキュメント一括登録開始")
-        
-        for i in tqdm(range(0, len(documents), batch_size), desc="インデックス進捗"):
-            batch = documents[i:i + batch_size]
-            bulk_data = []
-            
-            for doc in batch:
-                bulk_data.append({"index": {"_index": index_name}})
-                bulk_data.append(doc)
-            
-            try:
-                response = self.es.bulk(body=bulk_data)
-                if response.get('errors'):
-                    logger.error(f"バッチ {i//batch_size + 1} のインデックスでエラーが発生")
-            except Exception as e:
-                logger.error(f"バッチ {i//batch_size + 1} で例外が発生: {str(e)}")
-                
-        logger.info("ドキュメントのインデックスが完了しました")
+
+        def actions():
+            for doc in documents:
+                action = {"_index": index_name}
+                if '_id' in doc:
+                    action["_id"] = doc.pop('_id')
+                yield {"index": action}, doc
+
+        result = self.bulk_indexer.run(actions())
+        logger.info(f"ドキュメントのインデックスが完了しました ({result})")
+        return result
+
+    def bulk_index_stream(self, documents: Iterable[Dict], index_name: str) -> Optional[BulkResult]:
+        """bulk_index_documents と同じだが、ドキュメントが1件もなければ何もせず None を返す"""
+        documents = iter(documents)
+        first = next(documents, None)
+        if first is None:
+            return None
+        return self.bulk_index_documents(itertools.chain([first], documents), index_name=index_name)
+
+    def bulk_delete_documents(self, ids: List[str], index_name: str) -> BulkResult:
+        result = self.bulk_indexer.run(({"delete": {"_index": index_name, "_id": doc_id}}, None) for doc_id in ids)
+        logger.info(f"{len(ids)}件のドキュメントを削除しました ({result})")
+        return result
 
 def main():
+    parser = argparse.ArgumentParser(description="pokedex.db を Elasticsearch に登録する")
+    parser.add_argument('--full', action='store_true', help='新しいバージョンのインデックスを作って全件登録する')
+    parser.add_argument('--rollback', action='store_true', help='エイリアスを1つ前のバージョンに戻す')
+    args = parser.parse_args()
+
     DB_PATH = "pokedex.db"
     INDEX_NAME = "pk"
     ES_HOST = "http://elasticsearch:9200"
     MODEL_PATH = "paraphrase-multilingual-mpnet-base-v2"
+    BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '64'))
+    PROCESSES = int(os.getenv('INGEST_PROCESSES', '0'))
+    ENCODER_BACKEND = os.getenv('ENCODER_BACKEND', 'torch')
+    ENCODER_ONNX_DIR = os.getenv('ENCODER_ONNX_DIR', 'onnx_model')
+    ENCODER_THREADS = int(os.getenv('ENCODER_THREADS', '0'))
+    VECTOR_INDEX_TYPE = os.getenv('INDEX_VECTOR_TYPE', 'hnsw')
+    VECTOR_DIMS = int(os.getenv('INDEX_VECTOR_DIMS', '0'))  # 0 なら次元削減しない
+    PROJECTION_DIR = os.getenv('VECTOR_PROJECTION_DIR', 'projections')
+    REPLICAS = int(os.getenv('INDEX_REPLICAS', '0'))
+    RETENTION = int(os.getenv('INDEX_RETENTION', '3'))
+    FORCEMERGE_TIMEOUT = float(os.getenv('INDEX_FORCEMERGE_TIMEOUT', '3600'))
+    LOCAL_INDEX_DIR = os.getenv('LOCAL_INDEX_DIR', 'local_index')
+    # カンマ区切りで対象の地方図鑑テーブルを絞る (未指定なら全テーブル)
+    TABLES = [t.strip() for t in os.getenv('INGEST_TABLES', '').split(',') if t.strip()] or list(REGION_GAMES)
+    CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '500'))
+    BULK_THREADS = int(os.getenv('INGEST_BULK_THREADS', '4'))
+    BULK_DOCS = int(os.getenv('INGEST_BULK_DOCS', '200'))
+    BULK_BYTES = int(os.getenv('INGEST_BULK_BYTES', str(10 * 1024 * 1024)))
+    BULK_RETRIES = int(os.getenv('INGEST_BULK_RETRIES', '5'))
     
     try:
-        ingest = PokemonIngest(model_path=MODEL_PATH, es_host=ES_HOST)
+        ingest = PokemonIngest(model_path=MODEL_PATH, es_host=ES_HOST,
+                               encode_batch_size=BATCH_SIZE, encode_processes=PROCESSES,
+                               replicas=REPLICAS, retention=RETENTION,
+                               bulk_threads=BULK_THREADS, bulk_chunk_size=BULK_DOCS,
+                               bulk_max_bytes=BULK_BYTES, bulk_max_retries=BULK_RETRIES,
+                               encoder_backend=ENCODER_BACKEND, onnx_dir=ENCODER_ONNX_DIR,
+                               encoder_threads=ENCODER_THREADS, vector_index_type=VECTOR_INDEX_TYPE,
+                               vector_dims=VECTOR_DIMS, projection_dir=PROJECTION_DIR,
+                               forcemerge_timeout=FORCEMERGE_TIMEOUT)
 
-        df = ingest.prepare_data(DB_PATH)
- 
-        ingest.create_index(index_name=INDEX_NAME)
-        
-        processed_data = ingest.process_dataframe(df)
-        
-        ingest.bulk_index_documents(processed_data, index_name=INDEX_NAME)
+        if args.rollback:
+            logger.info(f"{INDEX_NAME} を {ingest.rollback(INDEX_NAME)} に戻しました")
+            touch_index_stamp()
+            return
+
+        def chunks():
+            return ingest.iter_data(DB_PATH, tables=TABLES, chunksize=CHUNK_SIZE)
+
+        # 射影の学習・登録・ローカルインデックスの書き出しで、エンコード用のプロセスプールを共有する
+        with ingest.encode_session():
+            ingest.prepare_projection(chunks(), index_name=INDEX_NAME, refit=args.full)
+            changed = ingest.sync_index(chunks(), index_name=INDEX_NAME, full=args.full)
+
+            # 2回目の読み出しでは埋め込みはすべてディスクキャッシュから取れる
+            ingest.export_local_index(chunks(), LOCAL_INDEX_DIR)
+
+        if changed:
+            # 検索側のセマンティックキャッシュを無効化する
+            touch_index_stamp()
         
         logger.info("全ての処理が完了しました")
         
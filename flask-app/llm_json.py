@@ -0,0 +1,332 @@
+"""LLM が出力した回答 JSON (pokemon_entries / summary) のパーサー
+
+    parser = AnswerParser()
+    for delta in stream:
+        for entry in parser.feed(delta):   # 閉じた要素から順に、検証済みのものを返す
+            ...
+    parser.close()                         # 途中で切れていれば開いている括弧を閉じる
+    answer = parser.answer()               # {"pokemon_entries": [...], "summary": ..., "complete": bool}
+
+受け取った文字は一度だけ走査し、値はその場で組み立てるので、トークンごとに呼んでも全体を再パースしない。
+LLM の出力によくある崩れは直して読む (直した種類は repairs に数える)。
+
+- 最初の '{' より前 (```json のコードフェンスや前置きの文) と、ルートが閉じた後は読み飛ばす
+- 文字列中の不正なエスケープ (\\_ など) はバックスラッシュを捨てる。文字列中の生の改行はそのまま
+- 末尾のカンマ、要素の間のカンマ抜けは無視する
+- 引用符のない値 (S など) は文字列、引用符のないキーはキーとして読む
+- 途中で切れた出力は close() で閉じ、そこまでの内容を返す
+"""
+import re
+
+ENTRIES_KEY = 'pokemon_entries'
+SUMMARY_KEY = 'summary'
+POWER_RATINGS = ('S', 'A', 'B', 'C', 'D')
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_LITERALS = {'true': True, 'false': False, 'null': None, 'True': True, 'False': False, 'None': None}
+_STRING_STOP = re.compile(r'["\\]')
+_BARE_STOP = re.compile(r'[\s,:{}\[\]"]')
+_NUMBER = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?\Z')
+_DIGITS = re.compile(r'\d+')
+_SURROGATE = re.compile('[\ud800-\udfff]')
+
+# 文字列やリテラルの外で出てくる区切り
+_WHITESPACE = ' \t\r\n'
+
+
+def _to_int(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        # "025" や "No.25" のような書き方
+        match = _DIGITS.search(value)
+        return int(match.group()) if match else None
+    return None
+
+
+def _to_text(value):
+    if isinstance(value, str):
+        return value.strip() or None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return None
+
+
+def validate_entry(value):
+    """pokemon_entries の1要素を検証して整える。図鑑番号か名前がなければ None"""
+    if not isinstance(value, dict):
+        return None
+    no = _to_int(value.get('no'))
+    name = _to_text(value.get('name'))
+    if no is None or name is None:
+        return None
+    score = value.get('relevance_score')
+    if isinstance(score, str):
+        score = _to_int(score)
+    if isinstance(score, bool) or not isinstance(score, (int, float)):
+        score = None
+    else:
+        score = min(100, max(0, score))
+    rating = _to_text(value.get('power_rating'))
+    rating = rating[0].upper() if rating and rating[0].upper() in POWER_RATINGS else None
+    return {
+        'no': no,
+        'name': name,
+        'relevance_score': score,
+        'power_rating': rating,
+        'relevance_analysis': _to_text(value.get('relevance_analysis')),
+        'background_story': _to_text(value.get('background_story')),
+    }
+
+
+def validate_summary(value):
+    if not isinstance(value, dict):
+        return None
+    most = value.get('most_relevant_pokemon')
+    if not isinstance(most, dict):
+        return None
+    name = _to_text(most.get('name'))
+    no = _to_int(most.get('no'))
+    if name is None and no is None:
+        return None
+    return {'most_relevant_pokemon': {'no': no, 'name': name, 'explanation': _to_text(most.get('explanation'))}}
+
+
+class _Frame:
+    __slots__ = ('value', 'key', 'entries')
+
+    def __init__(self, value, entries=False):
+        self.value = value
+        # dict のときの、値を待っているキー
+        self.key = None
+        # ルートの pokemon_entries の配列か
+        self.entries = entries
+
+
+class AnswerParser:
+    def __init__(self):
+        self.root = None
+        self.entries = []
+        self.dropped = 0
+        self.repairs = {}
+        self.complete = False
+        self._stack = []
+        self._started = False
+        self._string = None
+        self._string_is_key = False
+        self._escape = None
+        self._bare = None
+        self._comma = False
+
+    def _repair(self, kind):
+        self.repairs[kind] = self.repairs.get(kind, 0) + 1
+
+    def feed(self, chunk):
+        """新しく閉じて検証を通った pokemon_entries の要素を返す"""
+        emitted = []
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self.complete:
+                break
+            if not self._started:
+                start = chunk.find('{', i)
+                if start < 0:
+                    break
+                if chunk[i:start].strip():
+                    self._repair('preamble')
+                self._started = True
+                i = start
+            if self._string is not None:
+                i = self._read_string(chunk, i)
+                continue
+            if self._bare is not None:
+                i = self._read_bare(chunk, i)
+                continue
+
+            ch = chunk[i]
+            i += 1
+            if ch in _WHITESPACE or ch == ':':
+                continue
+            if ch == ',':
+                self._comma = True
+            elif ch == '"':
+                frame = self._stack[-1] if self._stack else None
+                self._string_is_key = frame is not None and isinstance(frame.value, dict) and frame.key is None
+                self._string = []
+            elif ch == '{' or ch == '[':
+                self._open({} if ch == '{' else [])
+            elif ch == '}' or ch == ']':
+                self._close(ch, emitted)
+            else:
+                self._bare = [ch]
+        return emitted
+
+    def _read_string(self, chunk, i):
+        parts = self._string
+        n = len(chunk)
+        while i < n:
+            if self._escape is not None:
+                i = self._read_escape(chunk, i)
+                continue
+            match = _STRING_STOP.search(chunk, i)
+            if match is None:
+                parts.append(chunk[i:])
+                return n
+            stop = match.start()
+            if stop > i:
+                parts.append(chunk[i:stop])
+            i = stop + 1
+            if chunk[stop] == '"':
+                self._string = None
+                self._finish_string(''.join(parts))
+                return i
+            self._escape = ''
+        return n
+
+    def _read_escape(self, chunk, i):
+        if self._escape == '':
+            ch = chunk[i]
+            if ch == 'u':
+                self._escape = 'u'
+                return i + 1
+            self._escape = None
+            if ch in _ESCAPES:
+                self._string.append(_ESCAPES[ch])
+            else:
+                # \_ のような不正なエスケープ: バックスラッシュを捨てる
+                self._repair('backslash')
+                self._string.append(ch)
+            return i + 1
+        # \uXXXX
+        need = 5 - len(self._escape)
+        self._escape += chunk[i:i + need]
+        if len(self._escape) == 5:
+            try:
+                self._string.append(chr(int(self._escape[1:], 16)))
+            except ValueError:
+                self._repair('backslash')
+                self._string.append(self._escape)
+            self._escape = None
+        return min(len(chunk), i + need)
+
+    def _read_bare(self, chunk, i):
+        match = _BARE_STOP.search(chunk, i)
+        if match is None:
+            self._bare.append(chunk[i:])
+            return len(chunk)
+        self._bare.append(chunk[i:match.start()])
+        self._finish_bare()
+        return match.start()
+
+    def _finish_bare(self):
+        word = ''.join(self._bare)
+        self._bare = None
+        if word in _LITERALS:
+            self._add(_LITERALS[word])
+            return
+        if _NUMBER.match(word):
+            self._add(float(word) if any(c in word for c in '.eE') else int(word))
+            return
+        frame = self._stack[-1] if self._stack else None
+        self._repair('unquoted')
+        word = word.strip("'")
+        if frame is not None and isinstance(frame.value, dict) and frame.key is None:
+            frame.key = word
+        else:
+            self._add(word)
+
+    def _finish_string(self, text):
+        if _SURROGATE.search(text):
+            # \ud83d\ude00 のようにサロゲートペアで書かれた文字を1文字に戻す
+            text = text.encode('utf-16', 'surrogatepass').decode('utf-16', 'replace')
+        if self._string_is_key:
+            self._stack[-1].key = text
+        else:
+            self._add(text)
+
+    def _add(self, value):
+        self._comma = False
+        if not self._stack:
+            return
+        frame = self._stack[-1]
+        if isinstance(frame.value, list):
+            frame.value.append(value)
+        elif frame.key is not None:
+            frame.value[frame.key] = value
+            frame.key = None
+        else:
+            # キーのない値 ({"a": 1, 2} など) は捨てる
+            self._repair('stray_value')
+
+    def _open(self, value):
+        if self.root is None:
+            self.root = value
+            self._stack.append(_Frame(value))
+            return
+        parent = self._stack[-1]
+        entries = (len(self._stack) == 1 and isinstance(value, list) and parent.key == ENTRIES_KEY)
+        self._add(value)
+        self._stack.append(_Frame(value, entries=entries))
+
+    def _close(self, ch, emitted):
+        if self._comma:
+            self._repair('trailing_comma')
+            self._comma = False
+        if not self._stack:
+            return
+        frame = self._stack.pop()
+        if isinstance(frame.value, dict) != (ch == '}'):
+            self._repair('bracket')
+        if frame.key is not None:
+            # 値のないキー
+            self._repair('missing_value')
+        if self._stack and self._stack[-1].entries and isinstance(frame.value, dict):
+            entry = validate_entry(frame.value)
+            if entry is None:
+                self.dropped += 1
+            else:
+                self.entries.append(entry)
+                emitted.append(entry)
+        if not self._stack:
+            self.complete = True
+
+    def close(self):
+        """途中で切れた出力を閉じる。閉じたことで検証を通った要素を返す"""
+        emitted = []
+        if self.complete or not self._stack:
+            return emitted
+        self._repair('truncated')
+        if self._string is not None:
+            if not self._string_is_key:
+                self._add(''.join(self._string))
+            self._string = None
+            self._escape = None
+        if self._bare is not None:
+            self._finish_bare()
+        self._comma = False
+        while self._stack:
+            self._close('}' if isinstance(self._stack[-1].value, dict) else ']', emitted)
+        # 閉じたのは修復であって、LLM が書き終えたわけではない
+        self.complete = False
+        return emitted
+
+    def answer(self):
+        summary = self.root.get(SUMMARY_KEY) if isinstance(self.root, dict) else None
+        return {
+            'pokemon_entries': list(self.entries),
+            'summary': validate_summary(summary),
+            'complete': self.complete,
+        }
+
+
+def parse_answer(text):
+    """回答全体を一度に読む。読めなくても例外にせず、読めたところまでを返す"""
+    parser = AnswerParser()
+    parser.feed(text or '')
+    parser.close()
+    return parser
@@ -0,0 +1,207 @@
+"""LLM (Groq) の呼び出しの流量制御
+
+    with scheduler.slot(estimated_tokens) as ticket:
+        answer, token_stats = call_llm()
+        ticket.used = token_stats['total_tokens']
+
+- 同時に実行する呼び出しを max_concurrency 件までにする
+- 1分あたりのトークン数を tokens_per_minute までにする (トークンバケット。0 なら制限しない)。
+  呼び出し前は見積もりで引き、終わったら実際の使用量との差を戻す
+- 枠が空くのを待てるのは queue_size 件まで。それを超えたら待たずに 429 で断る
+- 待ち時間の上限は queue_timeout 秒。間に合わないと分かった時点で 503 で断る
+- Groq 自体が 429 を返したら pause() で Retry-After の間は新しい呼び出しを止める
+
+待っている呼び出しは到着順に1件ずつ先頭から通す (トークンの多い呼び出しが後回しにされ続けない)。
+"""
+import asyncio
+import math
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from time import monotonic
+
+# asyncio 版が枠の空きを確かめる間隔
+ASYNC_POLL_SECONDS = 0.01
+
+
+class LlmOverloaded(Exception):
+    """LLM の枠が空かなかった。status は HTTP のステータス (429 / 503)、retry_after は秒数"""
+
+    def __init__(self, message, retry_after, status=503):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.status = status
+
+
+class _Ticket:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        # 実際に使ったトークン数 (呼び出し側が入れる)。None なら見積もりのまま
+        self.used = None
+        self.admitted = False
+
+
+class LlmScheduler:
+    def __init__(self, max_concurrency=8, tokens_per_minute=0, queue_size=32, queue_timeout=10.0,
+                 clock=monotonic):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._active = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = clock()
+        self._paused_until = 0.0
+        # 1回の呼び出しにかかる時間の移動平均 (Retry-After の見積もりに使う)
+        self._call_seconds = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.upstream_limited = 0
+
+    def after_fork(self):
+        # 枠と待ち行列はプロセスごと (fork 前の親プロセスの状態は引き継がない)
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._active = 0
+
+    def _refill(self, now):
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute,
+                               self._tokens + (now - self._refilled_at) * self.tokens_per_minute / 60)
+        self._refilled_at = now
+
+    def _retry_after(self, now, tokens=0):
+        """今から呼び出しを受け付けられそうになるまでの秒数の見積もり"""
+        waits = [self._paused_until - now,
+                 (len(self._waiting) + self._active) / self.max_concurrency * self._call_seconds]
+        if self.tokens_per_minute and tokens > self._tokens:
+            waits.append((tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return max(waits)
+
+    def _enter(self, tokens):
+        if self.tokens_per_minute:
+            # 1分の上限を超える見積もりはいつまでも通らないので上限に丸める
+            tokens = min(tokens, self.tokens_per_minute)
+        with self._cond:
+            now = self.clock()
+            self._refill(now)
+            ticket = _Ticket(tokens)
+            if (not self._waiting and self._active < self.max_concurrency and self._paused_until <= now
+                    and not (self.tokens_per_minute and tokens > self._tokens)):
+                # 空いていればそのまま通す。待ち行列の上限は待つ呼び出しにだけかける
+                self._admit(ticket)
+                return ticket
+            if len(self._waiting) >= self.queue_size:
+                self.rejected += 1
+                raise LlmOverloaded('LLMの待ち行列が一杯です', self._retry_after(now, tokens), status=429)
+            self._waiting.append(ticket)
+            return ticket
+
+    def _admit(self, ticket):
+        self._active += 1
+        self._tokens -= ticket.tokens
+        self.admitted += 1
+        ticket.admitted = True
+
+    def _poll(self, ticket, deadline):
+        """self._cond を持った状態で呼ぶ。通したら None、まだなら待つ秒数を返す。間に合わなければ例外"""
+        now = self.clock()
+        self._refill(now)
+        wait = None
+        if self._paused_until > now:
+            wait = self._paused_until - now
+        elif self._waiting[0] is not ticket or self._active >= self.max_concurrency:
+            wait = None
+        elif self.tokens_per_minute and ticket.tokens > self._tokens:
+            wait = (ticket.tokens - self._tokens) * 60 / self.tokens_per_minute
+        else:
+            self._waiting.popleft()
+            self._admit(ticket)
+            self._cond.notify_all()
+            return None
+
+        remaining = deadline - now
+        if remaining <= 0 or (wait is not None and wait > remaining):
+            self._waiting.remove(ticket)
+            self.timed_out += 1
+            self._cond.notify_all()
+            raise LlmOverloaded('LLMの呼び出しを待ちきれませんでした', self._retry_after(now, ticket.tokens))
+        return remaining if wait is None else wait
+
+    def _leave(self, ticket, started):
+        with self._cond:
+            self._active -= 1
+            if ticket.used is not None and self.tokens_per_minute:
+                self._tokens -= ticket.used - ticket.tokens
+            self._call_seconds = 0.8 * self._call_seconds + 0.2 * (self.clock() - started)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, tokens=0):
+        ticket = self._enter(tokens)
+        deadline = self.clock() + self.queue_timeout
+        with self._cond:
+            while not ticket.admitted:
+                wait = self._poll(ticket, deadline)
+                if wait is None:
+                    break
+                self._cond.wait(wait)
+        started = self.clock()
+        try:
+            yield ticket
+        finally:
+            self._leave(ticket, started)
+
+    @asynccontextmanager
+    async def async_slot(self, tokens=0):
+        """slot() の asyncio 版。イベントループを止めないよう、短い間隔で空きを確かめる"""
+        ticket = self._enter(tokens)
+        deadline = self.clock() + self.queue_timeout
+        try:
+            while not ticket.admitted:
+                with self._cond:
+                    wait = self._poll(ticket, deadline)
+                if wait is None:
+                    break
+                await asyncio.sleep(min(wait, ASYNC_POLL_SECONDS))
+        except asyncio.CancelledError:
+            # クライアントが切断した。先頭に残ると後ろの呼び出しが通れなくなる
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+            raise
+        started = self.clock()
+        try:
+            yield ticket
+        finally:
+            self._leave(ticket, started)
+
+    def pause(self, seconds):
+        """上流のレート制限に当たったので、seconds 秒は新しい呼び出しを通さない"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+            self.upstream_limited += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            now = self.clock()
+            self._refill(now)
+            return {
+                "active": self._active,
+                "waiting": len(self._waiting),
+                "max_concurrency": self.max_concurrency,
+                "queue_size": self.queue_size,
+                "tokens_per_minute": self.tokens_per_minute,
+                "tokens_available": round(self._tokens) if self.tokens_per_minute else None,
+                "paused_seconds": round(max(0.0, self._paused_until - now), 2),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "upstream_limited": self.upstream_limited,
+            }
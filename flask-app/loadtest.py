@@ -0,0 +1,120 @@
+"""同期版(スレッド)と asyncio 版の RAG パイプラインの同時実行スループットを比較する
+
+Elasticsearch と Groq は fakeservers.py のスタブに向けるので、外部サービスなしで実行できる。
+
+    python loadtest.py --requests 200 --concurrency 50 --threads 8
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+from elasticsearch import Elasticsearch
+from groq import Groq
+
+import async_rag
+import rag
+from cache import SemanticAnswerCache
+from evaluation import EvaluationStore, RelevanceEvaluator
+from fakeservers import FakeElasticsearch, FakeGroq, FakeServers
+
+
+class DummyEncoder:
+    """モデルをダウンロードできない環境向けの、テキストのハッシュから作る固定ベクトル"""
+
+    def encode(self, text, **kwargs):
+        # SentenceTransformer と同じく、リストを渡されたら (件数, 次元) の行列を返す
+        if not isinstance(text, str):
+            return np.stack([self.encode(t) for t in text]) if text else np.empty((0, 768), dtype=np.float32)
+        seed = int.from_bytes(hashlib.sha1(text.encode()).digest()[:4], 'little')
+        return np.random.default_rng(seed).standard_normal(768).astype(np.float32)
+
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) * 1000 if values else 0.0
+
+
+def summarize(name, latencies, errors, elapsed):
+    print(f'{name:>6}: {len(latencies) / elapsed:8.1f} req/s  '
+          f'p50={percentile(latencies, 50):7.1f}ms  p95={percentile(latencies, 95):7.1f}ms  '
+          f'p99={percentile(latencies, 99):7.1f}ms  errors={errors}')
+
+
+def build_engine(model, servers):
+    return rag.VectorSearchEngine(
+        model=model,
+        es_client=Elasticsearch([servers.es_url], connections_per_node=rag.ES_CONNECTIONS),
+        groq=Groq(api_key='fake', base_url=servers.llm_url),
+        answer_cache=SemanticAnswerCache(max_size=0),
+        evaluator=RelevanceEvaluator(None, EvaluationStore(os.path.join(tempfile.mkdtemp(), 'eval.db')),
+                                     workers=0, sample_rate=0.0),
+    )
+
+
+def run_sync(engine, queries, threads):
+    def timed(query):
+        t0 = perf_counter()
+        result = engine.rag(query)
+        return perf_counter() - t0, isinstance(result.get('search_results'), list)
+
+    t0 = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(timed, queries))
+    elapsed = perf_counter() - t0
+    latencies = [t for t, ok in results if ok]
+    summarize('sync', latencies, len(results) - len(latencies), elapsed)
+
+
+async def run_async(engine, servers, queries, concurrency):
+    async_engine = async_rag.AsyncVectorSearchEngine(
+        engine,
+        es_client=async_rag.create_async_es_client([servers.es_url]),
+        groq=async_rag.create_async_groq_client(base_url=servers.llm_url, api_key='fake'),
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(query):
+        async with semaphore:
+            t0 = perf_counter()
+            result = await async_engine.rag(query)
+            return perf_counter() - t0, isinstance(result.get('search_results'), list)
+
+    t0 = perf_counter()
+    results = await asyncio.gather(*(timed(q) for q in queries))
+    elapsed = perf_counter() - t0
+    await async_engine.close()
+    latencies = [t for t, ok in results if ok]
+    summarize('async', latencies, len(results) - len(latencies), elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50, help='asyncio版の同時リクエスト数')
+    parser.add_argument('--threads', type=int, default=8, help='同期版のワーカースレッド数')
+    parser.add_argument('--es-latency', type=float, default=0.02)
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--dummy-encoder', action='store_true', help='SentenceTransformerを読み込まない')
+    args = parser.parse_args()
+
+    if args.dummy_encoder:
+        model = DummyEncoder()
+    else:
+        model = rag.create_encoder()
+
+    # 埋め込みキャッシュが効かないよう、すべて異なるクエリにする
+    queries = [f'ほのおタイプのポケモン {i}' for i in range(args.requests)]
+
+    with FakeServers(FakeElasticsearch(latency=args.es_latency), FakeGroq(latency=args.llm_latency),
+                     process=True) as servers:
+        print(f'requests={args.requests} es_latency={args.es_latency}s llm_latency={args.llm_latency}s')
+        run_sync(build_engine(model, servers), queries, args.threads)
+        asyncio.run(run_async(build_engine(model, servers), servers, queries, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,188 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context
 from flask_cors import CORS
-from sentence_transformers import SentenceTransformer
-from elasticsearch import Elasticsearch
 import os
 import rag
+import json
 import logging
+import threading
+import observability
+import suggest
+from llm_scheduler import LlmOverloaded
+from singleflight import CoalesceTimeout
 
-# 初始化ES客户端和模型
-es_client = Elasticsearch([os.getenv('ES_HOST', 'http://elasticsearch:9200')])
-model = SentenceTransformer('paraphrase-multilingual-mpnet-base-v2')
-app = Flask(__name__)
-CORS(app)  # Allows all origins by default
-@app.route('/')
+observability.configure_logging()
+logger = logging.getLogger(__name__)
+
+api = Blueprint('api', __name__)
+
+
+def build_engine():
+    # 初始化ES客户端和模型 (プロセス全体で共有)
+    es_client = rag.create_es_client()
+    model = rag.create_encoder()
+    groq_client = rag.create_groq_client()
+    engine = rag.VectorSearchEngine(model=model, es_client=es_client, groq=groq_client)
+    observability.register_engine(engine)
+    return engine
+
+
+def create_app(engine=None, names=None):
+    """engine を渡さなければ ES クライアントとモデルを読み込んで作る (flask run はこれを呼ぶ)
+
+    ベンチマークではスタブサーバーに向けたエンジンを、gunicorn (wsgi.py) では fork 前に作ったエンジンを渡す。
+    names (入力補完の索引) を渡さなければ pokedex.db から作る。
+    """
+    if engine is None:
+        engine = build_engine()
+        threading.Thread(target=engine.warmup, daemon=True).start()
+    if names is None:
+        names = suggest.load_name_index(rag.POKEDEX_DB_PATH)
+
+    app = Flask(__name__)
+    CORS(app)  # Allows all origins by default
+    app.config['ENGINE'] = engine
+    app.config['NAMES'] = names
+    app.register_blueprint(api)
+    return app
+
+
+def get_engine():
+    return current_app.config['ENGINE']
+
+@api.route('/')
 def hello():
     """Return a friendly HTTP greeting."""
     print("I am inside hello world")
     return 'Hello World! CD'
 
-@app.route('/echo/<name>')
+@api.route('/echo/<name>')
 def echo(name):
     print(f"This was placed in the url: new-{name}")
     val = {"new-name": name}
     return jsonify(val)
 
-@app.route('/api/search', methods=['POST'])
+@api.route('/api/ready')
+def ready():
+    if not get_engine().ready:
+        return jsonify({'status': 'warming_up'}), 503
+    return jsonify({'status': 'ready'})
+
+@api.route('/metrics')
+def metrics():
+    body, content_type = observability.metrics_response()
+    return Response(body, content_type=content_type)
+
+def debug_requested(data):
+    # {"debug": true} または ?debug=1 で段階ごとの処理時間を返す
+    return bool(data.get('debug')) or request.args.get('debug') in ('1', 'true')
+
+@api.route('/api/suggest')
+def suggest_names():
+    # 入力中の文字列からポケモン名の候補を返す。ES や LLM には問い合わせない
+    names = current_app.config['NAMES']
+    if names is None:
+        return jsonify({'error': 'suggest index not available'}), 503
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', '10'))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    return jsonify({'query': query, 'suggestions': names.search(query, limit)})
+
+@api.route('/api/cache/stats')
+def cache_stats():
+    engine = get_engine()
+    return jsonify({
+        'embedding': engine.embedding_cache.stats(),
+        'answer': engine.answer_cache.stats(),
+        'evaluation': engine.evaluator.stats(),
+        'coalescing': engine.singleflight.stats(),
+        'llm': engine.llm_scheduler.stats(),
+    })
+
+@api.route('/api/eval/<request_id>')
+def get_evaluation(request_id):
+    result = get_engine().evaluator.lookup(request_id)
+    if result is None:
+        return jsonify({'error': 'evaluation not found'}), 404
+    return jsonify(result)
+
+@api.route('/api/search', methods=['POST'])
 def search():
     try:
-        print('Search starting')
         data = request.get_json()
-        print(f'Request data: {data}')
         
-        engine = rag.VectorSearchEngine()
         query = data.get('query', '')
-        print(f'Search query: {query}')
-        result = engine.rag(query)
-        print(f'Search result: {result}')
+        result = get_engine().rag(query, debug=debug_requested(data))
         
-        return jsonify(result)
+        response = jsonify(result)
+        if result.get('degraded'):
+            # 検索結果だけの応答。LLM の回答が欲しければ後で再試行してもらう
+            response.headers['Retry-After'] = str(result['retry_after'])
+        return response
+    except LlmOverloaded as e:
+        logger.warning(str(e))
+        return jsonify({'error': str(e), 'retry_after': e.retry_after}), e.status, {'Retry-After': str(e.retry_after)}
+    except CoalesceTimeout as e:
+        logger.warning(str(e))
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
-        print(f'Error: {str(e)}')
+        logger.exception(f'Error: {str(e)}')
+        observability.count_error('request')
         return jsonify({'error': str(e)}), 500
 
+MAX_BATCH_QUERIES = int(os.getenv('MAX_BATCH_QUERIES', '64'))
+MAX_BATCH_TOP_K = int(os.getenv('MAX_BATCH_TOP_K', '50'))
+
+@api.route('/api/search/batch', methods=['POST'])
+def search_batch():
+    data = request.get_json(silent=True) or {}
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries:
+        return jsonify({'error': 'queries must be a non-empty list'}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({'error': f'too many queries (max {MAX_BATCH_QUERIES})'}), 400
+    try:
+        top_k = int(data.get('top_k', 5))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'top_k must be an integer'}), 400
+    top_k = max(1, min(top_k, MAX_BATCH_TOP_K))
+    logger.info('batch search', extra={'queries': len(queries), 'top_k': top_k})
+    return jsonify({'results': get_engine().search_many(queries, top_k=top_k)})
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@api.route('/api/search/stream', methods=['GET', 'POST'])
+def search_stream():
+    # EventSource(GET)とfetch(POST)の両方に対応
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+    else:
+        data = {}
+    query = data.get('query', request.args.get('query', ''))
+    debug = debug_requested(data)
+    engine = get_engine()
+
+    def generate():
+        try:
+            for event, data in engine.rag_stream(query, debug=debug):
+                yield sse_event(event, data)
+        except LlmOverloaded as e:
+            logger.warning(str(e))
+            yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+        except Exception as e:
+            logger.exception(f'Error: {str(e)}')
+            observability.count_error('request')
+            yield sse_event('error', {'error': str(e)})
+        yield sse_event('done', {})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=8080, debug=True)
+    # 本番は gunicorn -c gunicorn.conf.py wsgi:app で起動する
+    create_app().run(host='127.0.0.1', port=8080, debug=os.getenv('FLASK_DEBUG') == '1')
@@ -0,0 +1,201 @@
+"""段階ごとの処理時間の計測、Prometheus のメトリクス、構造化ログ
+
+    with span('encode'):
+        ...
+
+span() は rag_stage_seconds ヒストグラムに記録し、リクエスト中 (request_timer() の中) なら
+そのリクエストのタイミングにも追加する。現在のリクエストは contextvars で持つので、
+スレッドごとの Flask のリクエストでも asyncio のタスクでも引数で渡さずに済む。
+"""
+import contextvars
+import json
+import logging
+import os
+from contextlib import contextmanager
+from time import perf_counter
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+# LLM の生成は数十秒かかることがあるので上限を広めにとる
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram('rag_stage_seconds', 'RAGパイプラインの段階ごとの処理時間', ['stage'], buckets=BUCKETS)
+STAGE_ERRORS = Counter('rag_stage_errors_total', '段階ごとのエラー数', ['stage'])
+LLM_TOKENS = Counter('rag_llm_tokens_total', 'LLMのトークン数', ['call', 'kind'])
+# kind は llm_json.AnswerParser の repairs のキー (backslash / trailing_comma / truncated など)
+LLM_JSON_REPAIRS = Counter('rag_llm_json_repairs_total', 'LLMの回答JSONを修復した回数', ['kind'])
+# executed: パイプラインを実行した / coalesced: 実行中の同じクエリの結果を受け取った (上流の呼び出しを省いた)
+# timeout: 実行中の処理を待ちきれなかった
+COALESCED = Counter('rag_coalesced_requests_total', '同じクエリの相乗りの結果ごとのリクエスト数', ['result'])
+# degraded: LLM の枠が空かず検索結果だけを返した / rejected: 429・503 で断った
+LLM_OVERLOAD = Counter('rag_llm_overload_total', 'LLMの枠が空かなかったリクエスト数', ['result'])
+# structured: 検索条件だけの質問として図鑑の表から答えた / rag: 埋め込み検索と LLM で答えた
+QUERY_ROUTES = Counter('rag_query_routes_total', '質問の答え方ごとのリクエスト数', ['route'])
+
+_current = contextvars.ContextVar('rag_request_timer', default=None)
+
+
+class RequestTimer:
+    """1リクエストの段階ごとの処理時間 (同じ段階が複数回あれば合計する)"""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.spans = {}
+
+    def add(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def as_dict(self):
+        timings = {stage: round(seconds * 1000, 2) for stage, seconds in self.spans.items()}
+        timings['total'] = round((perf_counter() - self.started) * 1000, 2)
+        return {'timings_ms': timings}
+
+
+@contextmanager
+def request_timer():
+    timer = RequestTimer()
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        STAGE_SECONDS.labels('total').observe(perf_counter() - timer.started)
+        _current.reset(token)
+
+
+def current_timer():
+    return _current.get()
+
+
+@contextmanager
+def span(stage):
+    t0 = perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        record(stage, perf_counter() - t0)
+
+
+def record(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timer = _current.get()
+    if timer is not None:
+        timer.add(stage, seconds)
+
+
+def count_error(stage):
+    STAGE_ERRORS.labels(stage).inc()
+
+
+def count_overload(result):
+    LLM_OVERLOAD.labels(result).inc()
+
+
+def count_json_repairs(repairs):
+    for kind, count in repairs.items():
+        LLM_JSON_REPAIRS.labels(kind).inc(count)
+
+
+def count_coalesced(result):
+    COALESCED.labels(result).inc()
+
+
+def count_route(route):
+    QUERY_ROUTES.labels(route).inc()
+
+
+def count_tokens(call, token_stats):
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if token_stats and token_stats.get(kind):
+            LLM_TOKENS.labels(call, kind[:-len('_tokens')]).inc(token_stats[kind])
+
+
+class EngineCollector:
+    """キャッシュと評価ワーカーがすでに数えている値を、収集時に読んでメトリクスにする"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def collect(self):
+        hits = CounterMetricFamily('rag_cache_hits', 'キャッシュのヒット数', labels=['cache'])
+        misses = CounterMetricFamily('rag_cache_misses', 'キャッシュのミス数', labels=['cache'])
+        evictions = CounterMetricFamily('rag_cache_evictions', 'キャッシュから追い出した数', labels=['cache'])
+        size = GaugeMetricFamily('rag_cache_size', 'キャッシュの件数', labels=['cache'])
+        for name, cache in (('embedding', self.engine.embedding_cache), ('answer', self.engine.answer_cache)):
+            stats = cache.stats()
+            hits.add_metric([name], stats['hits'])
+            misses.add_metric([name], stats['misses'])
+            evictions.add_metric([name], stats['evictions'])
+            size.add_metric([name], stats['size'])
+        yield from (hits, misses, evictions, size)
+
+        stats = self.engine.evaluator.stats()
+        evaluations = CounterMetricFamily('rag_evaluations', '関連性評価の件数', labels=['status'])
+        for status in ('submitted', 'skipped', 'dropped', 'completed', 'failed'):
+            evaluations.add_metric([status], stats[status])
+        yield evaluations
+        yield GaugeMetricFamily('rag_evaluation_queue', '評価待ちの件数', value=stats['queued'])
+
+        stats = self.engine.llm_scheduler.stats()
+        yield GaugeMetricFamily('rag_llm_active', '実行中のLLM呼び出し数', value=stats['active'])
+        yield GaugeMetricFamily('rag_llm_waiting', 'LLMの枠を待っている呼び出し数', value=stats['waiting'])
+
+
+def register_engine(engine, registry=REGISTRY):
+    registry.register(EngineCollector(engine))
+
+
+def metrics_response():
+    """(本文, Content-Type)
+
+    gunicorn の複数ワーカーで動かすとき (PROMETHEUS_MULTIPROC_DIR を設定したとき) は、
+    全ワーカーのヒストグラム・カウンターを合算して返す。キャッシュの統計 (EngineCollector) は
+    ワーカーごとの値なので、その場合は /api/cache/stats を見ること。
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
+
+
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1JSONのログ。logger.info(..., extra={...}) の項目もそのまま出す"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update({k: v for k, v in vars(record).items() if k not in _RECORD_FIELDS})
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def configure_logging(fmt=LOG_FORMAT, level=LOG_LEVEL):
+    handler = logging.StreamHandler()
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
@@ -0,0 +1,136 @@
+"""タイプ・特性・種族値で絞り込むための、図鑑データの列指向の表
+
+pokedex.db の地方図鑑テーブルを (全国図鑑番号, フォルム) ごとに1行にまとめ、種族値を numpy の列に持つ。
+同じポケモンが複数の地方図鑑にあるときは、新しいゲームの行 (regions.REGION_GAMES の順で先のもの) を使う。
+行は Elasticsearch の _source と同じ形の dict なので、そのまま VectorSearchEngine.format_sources に渡せる。
+
+    table = load_pokemon_table('pokedex.db')
+    sources, matched = table.query(analyzer.analyze('素早さ120以上のほのおタイプ'), limit=10)
+"""
+import logging
+import os
+import sqlite3
+
+import numpy as np
+
+from query_analyzer import STATS
+from regions import REGION_GAMES
+
+logger = logging.getLogger(__name__)
+
+BASE_STATS = STATS[:-1]
+# 種族値が入っていない行の値
+MISSING = -1
+
+_COMPARE = {
+    'ge': np.greater_equal, 'gt': np.greater, 'le': np.less_equal, 'lt': np.less, 'eq': np.equal,
+}
+
+
+class PokemonTable:
+    def __init__(self, sources):
+        """sources: Elasticsearch の _source と同じ形の dict (1行1件)"""
+        self.sources = sources
+        self.global_nos = np.array([int(source['global_no']) for source in sources], dtype=np.int32)
+        stats = np.array([[MISSING if source[f'stats_{stat}'] is None else source[f'stats_{stat}']
+                           for stat in BASE_STATS] for source in sources], dtype=np.int16).reshape(-1, len(BASE_STATS))
+        total = np.where((stats >= 0).all(axis=1), stats.sum(axis=1), MISSING)
+        # 列ごとに連続したメモリに置く (1つの種族値だけを見る比較とソートが速い)
+        self.columns = {stat: np.ascontiguousarray(stats[:, i]) for i, stat in enumerate(BASE_STATS)}
+        self.columns['total'] = total.astype(np.int16)
+        self._type_masks = self._masks(source['types'] for source in sources)
+        self._ability_masks = self._masks(source['abilities'] for source in sources)
+
+    def _masks(self, values):
+        masks = {}
+        for i, names in enumerate(values):
+            for name in names:
+                masks.setdefault(name, np.zeros(len(self.sources), dtype=bool))[i] = True
+        return masks
+
+    def __len__(self):
+        return len(self.sources)
+
+    @property
+    def abilities(self):
+        return list(self._ability_masks)
+
+    @classmethod
+    def from_db(cls, db_path):
+        with sqlite3.connect(f'file:{db_path}?mode=ro', uri=True) as conn:
+            conn.row_factory = sqlite3.Row
+            names = {}
+            for row in conn.execute('SELECT id, form, jpn, eng, chs FROM pokedex ORDER BY form != \'\''):
+                # 通常の姿の名前。メガシンカなどはフォルム名 (= 日本語名) でも引けるようにする
+                names.setdefault(row['id'], row)
+                names.setdefault((row['id'], row['jpn']), row)
+
+            sources = []
+            seen = set()
+            for region, games in REGION_GAMES.items():
+                for row in conn.execute(f'SELECT * FROM {region}'):
+                    key = (row['globalNo'], row['form'] or '')
+                    if key in seen or row['globalNo'] is None:
+                        continue
+                    seen.add(key)
+                    name = names.get((row['globalNo'], row['form'])) or names.get(row['globalNo'])
+                    sources.append(cls.source(row, name, region, games))
+        return cls(sources)
+
+    @staticmethod
+    def source(row, name, region, games):
+        source = {
+            'name_japanese': name['jpn'] if name else '',
+            'name_english': name['eng'] if name else '',
+            'name_chinese': name['chs'] if name else '',
+            'global_no': str(row['globalNo']),
+            'form': row['form'] or '',
+            'region': region,
+            'types': [t for t in (row['type1'], row['type2']) if t],
+            'abilities': [a for a in (row['ability1'], row['ability2'], row['dream_ability']) if a],
+            **{f'stats_{stat}': row[stat] if row[stat] != '' else None for stat in BASE_STATS},
+        }
+        for game in games:
+            source[f'description_{game}'] = row[game] or None
+        return source
+
+    def query(self, structured, limit=10):
+        """条件に合う行を並べて (上位 limit 件の source のリスト, 条件に合うポケモンの数) を返す
+
+        フォルム違いなど同じ全国図鑑番号の行は、並べたときに最も上の1件にまとめる (ES の collapse と同じ)。
+        """
+        mask = np.ones(len(self.sources), dtype=bool)
+        for name in structured.types:
+            mask &= self._type_masks.get(name, False)
+        for name in structured.abilities:
+            mask &= self._ability_masks.get(name, False)
+        for stat, op, value in structured.filters:
+            column = self.columns[stat]
+            mask &= (column != MISSING) & _COMPARE[op](column, value)
+
+        if structured.sort is not None:
+            stat, order = structured.sort
+            column = self.columns[stat]
+            mask &= column != MISSING
+            rows = np.flatnonzero(mask)
+            values = column[rows].astype(np.int32)
+            # 同じ値なら図鑑番号順
+            rows = rows[np.lexsort((self.global_nos[rows], -values if order == 'desc' else values))]
+        else:
+            rows = np.flatnonzero(mask)
+            rows = rows[np.argsort(self.global_nos[rows], kind='stable')]
+
+        numbers = self.global_nos[rows]
+        _, first = np.unique(numbers, return_index=True)
+        rows = rows[np.sort(first)]
+        return [self.sources[i] for i in rows[:limit]], len(rows)
+
+
+def load_pokemon_table(db_path):
+    """pokedex.db がなければ None (検索条件だけの質問も RAG で答える)"""
+    if not os.path.exists(db_path):
+        logger.warning(f'{db_path} がないため検索条件による回答は無効です')
+        return None
+    table = PokemonTable.from_db(db_path)
+    logger.info(f'図鑑の表を作成しました: {len(table)} 行')
+    return table
@@ -0,0 +1,117 @@
+"""文書ベクトルの次元削減 (PCA)
+
+injest.py が登録時に文書ベクトルで学習して projections/<fingerprint>.npz に保存し、
+インデックスの _meta.projection に fingerprint を書いておく。
+検索側はエイリアスが指すインデックスの _meta を読み、同じ射影をクエリベクトルに適用する。
+インデックスのバージョンごとに射影を残すので、ロールバックしても検索と食い違わない。
+"""
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from cache import INDEX_STAMP_PATH, read_index_stamp
+
+logger = logging.getLogger(__name__)
+
+
+class PcaProjection:
+    def __init__(self, mean, components, explained_variance_ratio=None):
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32)
+        # (元の次元, 削減後の次元)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.explained_variance_ratio = explained_variance_ratio
+        self.fingerprint = hashlib.sha1(self.mean.tobytes() + self.components.tobytes()).hexdigest()[:12]
+
+    @property
+    def dims(self):
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(cls, vectors, dims, max_samples=20000, seed=0):
+        """vectors (件数, 元の次元) で学習する。件数が多ければ max_samples 件を無作為に使う"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not 0 < dims < vectors.shape[1]:
+            raise ValueError(f'dims は 1 以上 {vectors.shape[1]} 未満にしてください: {dims}')
+        if len(vectors) > max_samples:
+            vectors = vectors[np.random.default_rng(seed).choice(len(vectors), max_samples, replace=False)]
+        if len(vectors) < dims:
+            raise ValueError(f'PCAの学習には {dims} 件以上のベクトルが必要です ({len(vectors)}件)')
+        mean = vectors.mean(axis=0)
+        _, singular, vt = np.linalg.svd((vectors - mean).astype(np.float64), full_matrices=False)
+        variance = singular ** 2
+        ratio = float(variance[:dims].sum() / variance.sum())
+        return cls(mean, vt[:dims].T, explained_variance_ratio=ratio)
+
+    def transform(self, vectors):
+        """(元の次元,) または (件数, 元の次元) を削減後の次元の float32 にする"""
+        return (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components
+
+    def path(self, directory):
+        return os.path.join(directory, f'{self.fingerprint}.npz')
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = self.path(directory)
+        np.savez(path, mean=self.mean, components=self.components,
+                 explained_variance_ratio=np.float64(self.explained_variance_ratio or 0.0))
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['mean'], data['components'], float(data['explained_variance_ratio']) or None)
+
+
+def index_meta(es_client, index_name):
+    """エイリアスまたはインデックスのマッピングの _meta (無ければ空の dict)"""
+    mappings = es_client.indices.get_mapping(index=index_name)
+    for mapping in mappings.values():
+        return mapping.get('mappings', {}).get('_meta', {})
+    return {}
+
+
+class ProjectionResolver:
+    """検索のたびにクエリベクトルへ、いま検索しているインデックスと同じ射影を適用する
+
+    _meta を読み直すのは起動後の最初の検索と、injest.py がインデックスのスタンプを更新したときだけ。
+    """
+
+    def __init__(self, es_client, index_name, directory='projections', stamp_path=INDEX_STAMP_PATH):
+        self.es_client = es_client
+        self.index_name = index_name
+        self.directory = directory
+        self.stamp_path = stamp_path
+        self._lock = threading.Lock()
+        self._resolved = False
+        self._stamp = None
+        self._projection = None
+
+    def after_fork(self, es_client):
+        self.es_client = es_client
+        self._lock = threading.Lock()
+
+    def stale(self):
+        """次の current() で _meta を読み直すかどうか (非同期の検索はこれを見てイベントループの外で読み直す)"""
+        return not self._resolved or read_index_stamp(self.stamp_path) != self._stamp
+
+    def current(self):
+        stamp = read_index_stamp(self.stamp_path)
+        if self._resolved and stamp == self._stamp:
+            return self._projection
+        with self._lock:
+            if not self._resolved or stamp != self._stamp:
+                fingerprint = index_meta(self.es_client, self.index_name).get('projection')
+                self._projection = PcaProjection.load(
+                    os.path.join(self.directory, f'{fingerprint}.npz')) if fingerprint else None
+                self._stamp = stamp
+                self._resolved = True
+                if fingerprint:
+                    logger.info(f'クエリに次元削減を適用します ({fingerprint}, {self._projection.dims}次元)')
+            return self._projection
+
+    def project(self, query_vector):
+        projection = self.current()
+        return query_vector if projection is None else projection.transform(query_vector)
@@ -0,0 +1,339 @@
+"""タイプ・特性・種族値の条件だけでできている質問を、検索条件に読み替える
+
+    analyzer = QueryAnalyzer(abilities=table.abilities)
+    structured = analyzer.analyze('素早さ120以上のほのおタイプ')
+    # types=['ほのお'], filters=[('speed', 'ge', 120)]
+    analyzer.analyze('fastest electric')       # types=['でんき'], sort=('speed', 'desc')
+    analyzer.analyze('HP over 100')            # filters=[('hp', 'gt', 100)]
+    analyzer.analyze('夜に人の魂を奪うポケモン')  # None (RAG で答える)
+
+質問を先頭から語彙の最長一致で区切り、すべての語が分かったときだけ StructuredQuery を返す。
+分からない語 (ポケモンの名前や説明の言葉など) が1つでもあれば None にして、埋め込み検索と LLM に任せる。
+タイプだけの質問 ("ほのおタイプのポケモン") も、並べ方が決まらないので None にする。
+タイプ相性の質問 ("ほのおタイプに弱いポケモン") も、種族値では答えられないので None にする。
+"""
+import re
+
+from cache import normalize_query
+from suggest import to_katakana
+
+STATS = ('hp', 'attack', 'defense', 'special_attack', 'special_defense', 'speed', 'total')
+STAT_LABELS = {
+    'hp': 'HP', 'attack': 'こうげき', 'defense': 'ぼうぎょ', 'special_attack': 'とくこう',
+    'special_defense': 'とくぼう', 'speed': 'すばやさ', 'total': '合計',
+}
+OPERATORS = {'ge': '以上', 'gt': 'より上', 'le': '以下', 'lt': '未満', 'eq': 'ちょうど'}
+
+# 図鑑データと同じ書き方のタイプ名 -> 英語名と漢字の書き方
+TYPES = {
+    'ノーマル': ('normal',), 'ほのお': ('fire', '炎'), 'みず': ('water', '水'), 'でんき': ('electric', '電気'),
+    'くさ': ('grass', '草'), 'こおり': ('ice', '氷'), 'かくとう': ('fighting', '格闘'), 'どく': ('poison', '毒'),
+    'じめん': ('ground', '地面'), 'ひこう': ('flying', '飛行'), 'エスパー': ('psychic',), 'むし': ('bug', '虫'),
+    'いわ': ('rock', '岩'), 'ゴースト': ('ghost',), 'ドラゴン': ('dragon', '竜', '龍'), 'あく': ('dark', '悪'),
+    'はがね': ('steel', '鋼'), 'フェアリー': ('fairy', '妖精'),
+}
+STAT_WORDS = {
+    'hp': ('hp', 'ヒットポイント', '体力', 'たいりょく'),
+    'attack': ('攻撃', '攻撃力', 'こうげき', 'attack', 'atk'),
+    'defense': ('防御', '防御力', 'ぼうぎょ', 'defense', 'defence', 'def'),
+    'special_attack': ('特攻', '特殊攻撃', 'とくこう', 'special attack', 'sp attack', 'sp atk', 'sp. atk', 'spatk'),
+    'special_defense': ('特防', '特殊防御', 'とくぼう', 'special defense', 'special defence', 'sp defense',
+                        'sp def', 'sp. def', 'spdef'),
+    'speed': ('素早さ', 'すばやさ', '速さ', 'スピード', 'speed', 'spe'),
+    'total': ('合計', '種族値合計', '合計種族値', '総合', 'total', 'base stat total', 'bst'),
+}
+# 数値と組み合わせる比較
+COMPARATORS = {
+    'ge': ('以上', 'at least', 'or more', 'or higher', 'or above', '>=', '≥', '+'),
+    'gt': ('超', '超え', 'を超える', 'より上', 'より高い', 'より大きい', 'over', 'above', 'more than',
+           'greater than', 'higher than', '>'),
+    'le': ('以下', 'at most', 'or less', 'or lower', 'or below', '<=', '≤'),
+    'lt': ('未満', 'より下', 'より低い', 'より小さい', 'under', 'below', 'less than', 'lower than', '<'),
+    'eq': ('=', 'ちょうど', 'exactly'),
+}
+# 種族値と組み合わせる並べ方 (「攻撃が高い」「highest attack」)
+DIRECTIONS = {
+    'desc': ('高い', '高く', '高め', 'たかい', '最高', 'highest', 'high', 'best', 'most', 'max', 'top'),
+    'asc': ('低い', '低く', '低め', 'ひくい', '最低', 'lowest', 'low', 'worst', 'least', 'min'),
+}
+# それだけで種族値と並べ方が決まる語
+SUPERLATIVES = {
+    ('speed', 'desc'): ('速い', '速く', 'はやい', '素早い', 'すばやい', '最速', 'fastest', 'quickest', 'fast'),
+    ('speed', 'asc'): ('遅い', '遅く', 'おそい', '鈍足', 'slowest', 'slow'),
+    ('defense', 'desc'): ('硬い', 'かたい', '固い'),
+    ('total', 'desc'): ('強い', 'つよい', '最強', 'strongest'),
+    ('total', 'asc'): ('弱い', 'よわい', '最弱', 'weakest'),
+}
+# タイプと並ぶと相性の質問になる語 (「ほのおタイプに弱い」「strong against water」)
+# 「弱点」「weakness」は語彙に入れないので、それだけで RAG に回る
+RELATIONS = ('に', 'へ', 'への', 'に対して', 'against', 'to', 'vs', 'versus')
+# 並べる種族値だけを指す語 (「素早さ順」の「順」)
+ORDER_WORDS = ('順', '順番', 'ランキング', 'ranking', 'ranked by', 'sorted by', 'sort by', 'order by')
+FILLERS = (
+    'の', 'が', 'は', 'で', 'を', 'と', 'も', 'な', 'か', 'て', 'や', 'から',
+    'タイプ', 'ポケモン', '一番', 'いちばん', '最も', 'もっとも', 'とても', '特性', 'とくせい', '種族値', 'しゅぞくち',
+    '値', '持つ', '持ち', '持っている', 'もつ', 'もち', 'いる', 'ある', 'です', 'ですか', 'どれ', 'だれ', '誰',
+    '何', 'なに', 'どの', 'どんな', '一覧', 'リスト', '全部', 'すべて', '全て', '教えて', 'おしえて', '探して',
+    'ください', '見せて', 'たち', '達',
+    'type', 'types', 'pokemon', 'pokémon', 'pokemons', 'with', 'and', 'of', 'a', 'an', 'the', 'which', 'what',
+    'who', 'is', 'are', 'has', 'have', 'having', 'show', 'me', 'list', 'all', 'find', 'give', 'in', 'that',
+    'ability', 'abilities', 'stat', 'stats', 'base', 'value', 'one', 'ones', 'for', 'by',
+    ' ', '?', '!', '、', '。', ',', '.', '・', '/', '&', '(', ')', '「', '」', '-',
+)
+# 上位の件数 ("top 5" / "上位5" / "5匹")
+_LIMIT = re.compile(r'(?:top|上位|トップ) ?(\d{1,3})(?: ?(?:匹|体(?!力)|件))?|(\d{1,3}) ?(?:匹|体(?!力)|件)')
+_NUMBER = re.compile(r'\d{1,4}')
+_FILLER = ('filler',)
+
+
+def _kana_variants(word):
+    katakana = to_katakana(word)
+    hiragana = ''.join(chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in katakana)
+    return {word, katakana, hiragana}
+
+
+def _letter(ch):
+    return ch.isascii() and ch.isalpha()
+
+
+class StructuredQuery:
+    def __init__(self, types=(), abilities=(), filters=(), sort=None, limit=None):
+        self.types = list(types)
+        self.abilities = list(abilities)
+        # (種族値, 比較, 値) のリスト。比較は OPERATORS のキー
+        self.filters = list(filters)
+        # (種族値, 'desc' | 'asc') または None (図鑑番号順。特性だけの質問)
+        self.sort = sort
+        self.limit = limit
+
+    def __eq__(self, other):
+        return isinstance(other, StructuredQuery) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return f'StructuredQuery({self.as_dict()})'
+
+    def as_dict(self):
+        return {
+            'types': self.types,
+            'abilities': self.abilities,
+            'filters': [{'stat': stat, 'op': op, 'value': value} for stat, op, value in self.filters],
+            'sort': {'stat': self.sort[0], 'order': self.sort[1]} if self.sort else None,
+            'limit': self.limit,
+        }
+
+    def stats(self):
+        """条件と並べ方に使った種族値 (重複なし、出てきた順)"""
+        stats = [stat for stat, _, _ in self.filters] + ([self.sort[0]] if self.sort else [])
+        return list(dict.fromkeys(stats))
+
+    def describe(self):
+        """条件を日本語で並べた文字列 (例: ほのおタイプ・すばやさ120以上・すばやさの高い順)"""
+        parts = []
+        if self.types:
+            parts.append('/'.join(self.types) + 'タイプ')
+        parts += [f'特性{ability}' for ability in self.abilities]
+        for stat, op, value in self.filters:
+            parts.append(f'{STAT_LABELS[stat]}{value}' if op == 'eq' else f'{STAT_LABELS[stat]}{value}{OPERATORS[op]}')
+        if self.sort:
+            stat, order = self.sort
+            parts.append(f'{STAT_LABELS[stat]}の{"高い" if order == "desc" else "低い"}順')
+        return '・'.join(parts)
+
+    def explain(self, source):
+        """1件の結果が条件に当てはまる理由 (タイプと、条件に使った種族値)"""
+        parts = ['/'.join(source['types'])]
+        for stat in self.stats():
+            if stat == 'total':
+                value = sum(source[f'stats_{name}'] or 0 for name in STATS[:-1])
+            else:
+                value = source[f'stats_{stat}']
+            parts.append(f'{STAT_LABELS[stat]} {value}')
+        if self.abilities:
+            parts.append('特性 ' + '/'.join(source['abilities']))
+        return '・'.join(parts)
+
+
+class _Clause:
+    """種族値1つ分の条件 (「素早さ 120 以上」「攻撃が高い」)"""
+
+    def __init__(self, stat, direction=None):
+        # 数値や比較が種族値より先に出てきたときは、種族値が出てくるまで None
+        self.stat = stat
+        self.number = None
+        self.op = None
+        self.direction = direction
+
+
+class QueryAnalyzer:
+    def __init__(self, abilities=()):
+        """abilities: 図鑑データにある特性の名前 (この名前だけを特性として読む)"""
+        vocabulary = {}
+
+        def add(words, token):
+            for word in words:
+                for variant in _kana_variants(normalize_query(word)):
+                    # 先に登録した語 (タイプ・種族値) を優先する
+                    vocabulary.setdefault(variant, token)
+
+        for name, aliases in TYPES.items():
+            add((name,) + aliases, ('type', name))
+        for stat, words in STAT_WORDS.items():
+            add(words, ('stat', stat))
+        for key, words in SUPERLATIVES.items():
+            add(words, ('superlative', key))
+        for op, words in COMPARATORS.items():
+            add(words, ('op', op))
+        for direction, words in DIRECTIONS.items():
+            add(words, ('direction', direction))
+        add(ORDER_WORDS, ('order',))
+        for ability in abilities:
+            if ability:
+                add((ability,), ('ability', ability))
+        # 助詞は「ノ」「ガ」のようなカタカナ語の一部と紛れないよう、書かれたとおりにだけ読む
+        for word in RELATIONS:
+            vocabulary.setdefault(normalize_query(word) or word, ('relation',))
+        for word in FILLERS:
+            vocabulary.setdefault(normalize_query(word) or word, _FILLER)
+
+        self._vocabulary = vocabulary
+        self._max_length = max(len(word) for word in vocabulary)
+
+    def tokenize(self, query):
+        """語のリストを返す。分からない語があれば None"""
+        text = normalize_query(query)
+        tokens = []
+        i = 0
+        n = len(text)
+        while i < n:
+            match = _LIMIT.match(text, i)
+            if match is None or (match.end() < n and _letter(text[match.end()])):
+                match = _NUMBER.match(text, i)
+                if match is not None:
+                    tokens.append(('number', int(match.group())))
+                    i = match.end()
+                    continue
+            else:
+                tokens.append(('limit', int(match.group(1) or match.group(2))))
+                i = match.end()
+                continue
+
+            for length in range(min(self._max_length, n - i), 0, -1):
+                word = text[i:i + length]
+                token = self._vocabulary.get(word)
+                if token is None:
+                    continue
+                # 英単語は単語の途中で切らない ("theme" を "the" + "me" と読まない)
+                if _letter(word[0]) and i > 0 and _letter(text[i - 1]):
+                    continue
+                if _letter(word[-1]) and i + length < n and _letter(text[i + length]):
+                    continue
+                break
+            else:
+                return None
+            if token is not _FILLER:
+                tokens.append(token)
+            i += length
+        return tokens
+
+    def analyze(self, query):
+        """検索条件だけでできている質問なら StructuredQuery、そうでなければ None"""
+        tokens = self.tokenize(query)
+        if not tokens:
+            return None
+        # 「ほのおタイプに弱い」「weak to fire」はタイプ相性の質問で、種族値では答えられない
+        kinds = [token[0] for token in tokens]
+        for before, after in zip(kinds, kinds[1:]):
+            if 'relation' in (before, after) and 'type' in (before, after):
+                return None
+
+        types, abilities, filters = [], [], []
+        sorts = []
+        bare_stats = []
+        limit = None
+        ordered = False
+        clause = None
+        # 種族値より前に出てきた並べ方 ("highest attack")
+        direction = None
+
+        def finish(clause):
+            if clause is None:
+                return True
+            if clause.stat is None:
+                return False
+            if clause.number is not None:
+                filters.append((clause.stat, clause.op or 'eq', clause.number))
+                if clause.direction is not None:
+                    sorts.append((clause.stat, clause.direction))
+            elif clause.op is not None:
+                return False
+            elif clause.direction is not None:
+                sorts.append((clause.stat, clause.direction))
+            else:
+                bare_stats.append(clause.stat)
+            return True
+
+        for kind, *value in tokens:
+            value = value[0] if value else None
+            if kind == 'relation':
+                continue
+            elif kind == 'type':
+                if value not in types:
+                    types.append(value)
+            elif kind == 'ability':
+                if value not in abilities:
+                    abilities.append(value)
+            elif kind == 'stat':
+                if clause is not None and clause.stat is None:
+                    # 「120以上の素早さ」「over 100 attack」: 先に出てきた数値と比較に種族値を付ける
+                    clause.stat = value
+                else:
+                    if not finish(clause):
+                        return None
+                    clause = _Clause(value, direction)
+                    direction = None
+            elif kind in ('number', 'op'):
+                if clause is None:
+                    clause = _Clause(None)
+                if kind == 'number':
+                    if clause.number is not None:
+                        return None
+                    clause.number = value
+                else:
+                    if clause.op is not None:
+                        return None
+                    clause.op = value
+            elif kind == 'direction':
+                # 「攻撃が高い」は直前の種族値に、「highest attack」は次の種族値に付ける
+                if clause is not None and clause.direction is None and clause.number is None and clause.op is None:
+                    clause.direction = value
+                elif direction is None:
+                    direction = value
+                else:
+                    return None
+            elif kind == 'superlative':
+                if not finish(clause):
+                    return None
+                clause = None
+                sorts.append(value)
+            elif kind == 'order':
+                ordered = True
+            elif kind == 'limit':
+                if limit is not None:
+                    return None
+                limit = value
+
+        if not finish(clause) or direction is not None:
+            return None
+        if ordered and not sorts and len(bare_stats) == 1:
+            # 「素早さ順」
+            sorts.append((bare_stats.pop(), 'desc'))
+        # 条件のない種族値が残る、並べ方が2つある (「防御が高くて遅い」) などは RAG に任せる
+        if bare_stats or len(sorts) > 1 or len(types) > 2 or len(abilities) > 1:
+            return None
+        if not (filters or sorts or abilities):
+            return None
+        if not sorts and filters:
+            # 並べ方の指定がなければ最初の条件の種族値で並べる (「HP100以上」なら HP の高い順)
+            stat, op, _ = filters[0]
+            sorts.append((stat, 'asc' if op in ('le', 'lt') else 'desc'))
+        return StructuredQuery(types, abilities, filters, sorts[0] if sorts else None, limit)
@@ -1,22 +1,141 @@
 import pandas as pd
 
-from sentence_transformers import SentenceTransformer
 from elasticsearch import Elasticsearch
 import numpy as np
 import os
 import logging
-from time import time
-from groq import Groq
+from time import perf_counter, time
+from groq import Groq, RateLimitError
 import json
 import re
+import threading
+import uuid
+from cache import EmbeddingCache, SemanticAnswerCache, normalize_query
+from llm_json import AnswerParser, parse_answer
+from evaluation import EvaluationStore, RelevanceEvaluator
+from retrievers import create_retriever
+from context_builder import ContextBuilder, estimate_tokens
+from llm_scheduler import LlmOverloaded, LlmScheduler
+from pokemon_table import load_pokemon_table
+from projection import ProjectionResolver
+from query_analyzer import QueryAnalyzer
+import encoders
+from observability import (count_coalesced, count_error, count_json_repairs, count_overload, count_route, count_tokens,
+                           record, request_timer, span)
+from singleflight import CoalesceTimeout, SingleFlight
+
+logger = logging.getLogger(__name__)
+
+ES_HOST = os.getenv('ES_HOST', 'http://elasticsearch:9200')
+MODEL_NAME = os.getenv('MODEL_NAME', 'paraphrase-multilingual-mpnet-base-v2')
+INDEX_NAME = 'pk'
+# 1プロセスで共有するクライアントの接続プールサイズ
+ES_CONNECTIONS = int(os.getenv('ES_CONNECTIONS', '16'))
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '1024'))
+EMBEDDING_CACHE_TTL = float(os.getenv('EMBEDDING_CACHE_TTL', '3600'))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '256'))
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+EVAL_DB_PATH = os.getenv('EVAL_DB_PATH', 'evaluations.db')
+EVAL_WORKERS = int(os.getenv('EVAL_WORKERS', '2'))
+EVAL_QUEUE_SIZE = int(os.getenv('EVAL_QUEUE_SIZE', '100'))
+EVAL_SAMPLE_RATE = float(os.getenv('EVAL_SAMPLE_RATE', '1.0'))
+# 同じクエリ (正規化後) の処理が実行中なら、その結果を最大この秒数待って受け取る。0 なら相乗りしない
+COALESCE_TIMEOUT = float(os.getenv('COALESCE_TIMEOUT', '60'))
+# Groq の呼び出しの流量制御 (llm_scheduler.py)。LLM_TOKENS_PER_MINUTE は契約の上限に合わせる (0 なら制限しない)
+# どちらもプロセスごとの値なので、gunicorn ではワーカー数で割った値を設定する
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '0'))
+LLM_QUEUE_SIZE = int(os.getenv('LLM_QUEUE_SIZE', '32'))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '10'))
+# 呼び出し前に見積もる出力トークン数 (実際の使用量は呼び出し後に精算する)
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv('LLM_EXPECTED_COMPLETION_TOKENS', '1000'))
+# 1 なら LLM の枠が空かないとき、エラーにせず検索結果だけを返す ("degraded": true)
+LLM_DEGRADED_MODE = os.getenv('LLM_DEGRADED_MODE', '1') == '1'
+# es: Elasticsearch の kNN のみ / hybrid: BM25 + kNN を RRF で融合
+# numpy: injest.py が書き出したローカルインデックス
+# hybrid は bench_retrieval.py で本番のインデックスに対する recall@5 と遅延を確かめてから既定にする
+RETRIEVER_BACKEND = os.getenv('RETRIEVER_BACKEND', 'es')
+HYBRID_NUM_CANDIDATES = int(os.getenv('HYBRID_NUM_CANDIDATES', '50'))
+# RRF に渡す各ランキングの件数
+HYBRID_WINDOW_SIZE = int(os.getenv('HYBRID_WINDOW_SIZE', '20'))
+HYBRID_BM25_WEIGHT = float(os.getenv('HYBRID_BM25_WEIGHT', '1.0'))
+HYBRID_KNN_WEIGHT = float(os.getenv('HYBRID_KNN_WEIGHT', '1.0'))
+HYBRID_RANK_CONSTANT = int(os.getenv('HYBRID_RANK_CONSTANT', '60'))
+# compact: 表形式でトークン予算内に収める / full: entry_template を全件並べる従来の形式
+PROMPT_CONTEXT_FORMAT = os.getenv('PROMPT_CONTEXT_FORMAT', 'compact')
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '1200'))
+LOCAL_INDEX_DIR = os.getenv('LOCAL_INDEX_DIR', 'local_index')
+# クエリのエンコーダー: torch / onnx / onnx-int8 (onnx は encoders.py export で書き出しておく)
+ENCODER_BACKEND = os.getenv('ENCODER_BACKEND', 'torch')
+ENCODER_ONNX_DIR = os.getenv('ENCODER_ONNX_DIR', 'onnx_model')
+ENCODER_THREADS = int(os.getenv('ENCODER_THREADS', '0'))  # 0 ならライブラリの既定値
+# 入力補完と、検索条件だけで答えられる質問の表を作る図鑑データ
+POKEDEX_DB_PATH = os.getenv('POKEDEX_DB_PATH', 'pokedex.db')
+# 1 なら「素早さ120以上のほのおタイプ」のような質問は埋め込み・LLM を通さず図鑑の表から答える
+STRUCTURED_QUERIES = os.getenv('STRUCTURED_QUERIES', '1') == '1'
+STRUCTURED_QUERY_LIMIT = int(os.getenv('STRUCTURED_QUERY_LIMIT', '10'))
+# 「上位200匹」のように件数を指定されたときの上限
+STRUCTURED_QUERY_MAX_LIMIT = 100
+# injest.py が次元削減したインデックスの射影行列の保存先 (どの射影を使うかはインデックスの _meta で決まる)
+VECTOR_PROJECTION_DIR = os.getenv('VECTOR_PROJECTION_DIR', 'projections')
+
+
+def hybrid_options():
+    return {
+        'num_candidates': HYBRID_NUM_CANDIDATES,
+        'window_size': HYBRID_WINDOW_SIZE,
+        'bm25_weight': HYBRID_BM25_WEIGHT,
+        'knn_weight': HYBRID_KNN_WEIGHT,
+        'rank_constant': HYBRID_RANK_CONSTANT,
+    }
+
+
+def create_es_client():
+    return Elasticsearch([ES_HOST], connections_per_node=ES_CONNECTIONS)
+
+
+def create_encoder():
+    return encoders.create_encoder(ENCODER_BACKEND, MODEL_NAME, onnx_dir=ENCODER_ONNX_DIR,
+                                   threads=ENCODER_THREADS)
+
+
+def create_groq_client():
+    return Groq(api_key=os.getenv('KEY_groq'))
 
 
 class VectorSearchEngine:
-    def __init__(self):
-        self.es_client = Elasticsearch([os.getenv('ES_HOST', 'http://elasticsearch:9200')])
-        self.model = SentenceTransformer('paraphrase-multilingual-mpnet-base-v2')
-        self.groq = Groq(api_key=os.getenv('KEY_groq'))
+    def __init__(self, model=None, es_client=None, groq=None, embedding_cache=None, answer_cache=None,
+                 evaluator=None, retriever=None, pokemon_table=None):
+        # 共有のエンコーダー・クライアントが渡された場合はそれを使う
+        self.es_client = es_client if es_client is not None else create_es_client()
+        self.model = model if model is not None else create_encoder()
+        self.groq = groq if groq is not None else create_groq_client()
+        self.retriever = retriever if retriever is not None else create_retriever(
+            RETRIEVER_BACKEND, es_client=self.es_client, index_name=INDEX_NAME, local_index_dir=LOCAL_INDEX_DIR,
+            projection=ProjectionResolver(self.es_client, INDEX_NAME, VECTOR_PROJECTION_DIR), **hybrid_options())
         self.llm_model = 'llama-3.2-90b-vision-preview'
+        self._encode_lock = threading.Lock()
+        self.embedding_cache = embedding_cache if embedding_cache is not None else EmbeddingCache(
+            max_size=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL)
+        self.answer_cache = answer_cache if answer_cache is not None else SemanticAnswerCache(
+            max_size=ANSWER_CACHE_SIZE, threshold=ANSWER_CACHE_THRESHOLD)
+        # 関連性評価は監視用なので、リクエストとは別のワーカーで実行する
+        self.evaluator = evaluator if evaluator is not None else RelevanceEvaluator(
+            self.evaluate_relevance, EvaluationStore(EVAL_DB_PATH), workers=EVAL_WORKERS,
+            queue_size=EVAL_QUEUE_SIZE, sample_rate=EVAL_SAMPLE_RATE)
+        self.singleflight = SingleFlight(timeout=COALESCE_TIMEOUT)
+        self.llm_scheduler = LlmScheduler(
+            max_concurrency=LLM_MAX_CONCURRENCY, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+            queue_size=LLM_QUEUE_SIZE, queue_timeout=LLM_QUEUE_TIMEOUT)
+        self.degraded_mode = LLM_DEGRADED_MODE
+        # 検索条件だけでできている質問を答える図鑑の表 (pokedex.db がなければ None で、すべて RAG で答える)
+        if pokemon_table is None and STRUCTURED_QUERIES:
+            pokemon_table = load_pokemon_table(POKEDEX_DB_PATH)
+        self.pokemon_table = pokemon_table
+        self.query_analyzer = QueryAnalyzer(pokemon_table.abilities) if pokemon_table is not None else None
+        self.ready = False
+        self.context_format = PROMPT_CONTEXT_FORMAT
+        self.context_builder = ContextBuilder(token_budget=PROMPT_TOKEN_BUDGET)
         
         self.prompt_template = """
             あなたはポケモンマスターアナリストであり、ポケモン怪談専門の小説家です。
@@ -101,85 +220,202 @@ class VectorSearchEngine:
             
         """.strip()
             
-            
+
+    def encode(self, text):
+        # トークナイザーは並行呼び出しに対応していないため直列化する
+        with self._encode_lock, span('encode'):
+            return self.model.encode(text)
+
+    def encode_query(self, query):
+        # 同じクエリはキャッシュ済みのfloat32ベクトルを返し、エンコーダーを通さない
+        return self.embedding_cache.get_or_compute(query, self.encode)
+
+    def after_fork(self, encoder_threads=ENCODER_THREADS, eval_workers=EVAL_WORKERS, es_client=None, groq=None):
+        """gunicorn の preload で、モデルを読み込んだ親プロセスから fork したワーカーで呼ぶ
+
+        モデルの重みは親と共有したまま、fork で引き継げないスレッド・ロック・接続だけを作り直す。
+        ES と Groq のクライアントは渡さなければ create_es_client() / create_groq_client() で作り直す。
+        """
+        self._encode_lock = threading.Lock()
+        self.es_client = es_client if es_client is not None else create_es_client()
+        self.groq = groq if groq is not None else create_groq_client()
+        if hasattr(self.retriever, 'after_fork'):
+            self.retriever.after_fork(self.es_client)
+        for component in (self.embedding_cache, self.answer_cache, self.singleflight, self.llm_scheduler):
+            component.after_fork()
+        if hasattr(self.model, 'after_fork'):
+            self.model.after_fork(threads=encoder_threads)
+        self.evaluator.after_fork(eval_workers)
+
+    def warmup(self):
+        self.encode('ウォームアップ')
+        self.ready = True
+
     def search(self, query, top_k=5):
         try:
-            print(f'Search query: {query}, top_k: {top_k}')
+            logger.debug('search', extra={'query': query, 'top_k': top_k})
             
-            query_vector = self.model.encode(query).tolist()
-            vector_dim = len(query_vector)
-            print(f"Query vector dimension: {vector_dim}")
-            search_body = {
-                "knn": {
-                    "field": "combined_text_vector",
-                    "query_vector": query_vector,
-                    "k": top_k,
-                    "num_candidates": 100
-                },
-                "collapse": {
-                    "field": "global_no"  
-                },
-                "_source": {
-                    "excludes": ["combined_text_vector"]
-                }
-            }
+            query_vector = self.encode_query(query)
 
-            results = self.es_client.search(
-                    index="pk",
-                    body=search_body
-                )
-
-            return [{
-                'nameEn': hit['_source']['name_english'],
-                'nameCn': hit['_source']['name_chinese'],
-                'nameJa': hit['_source']['name_japanese'],
-                'types': hit['_source']['types'],
-                'abilities': hit['_source']['abilities'],
-                'no': hit['_source']['global_no'],
-                'description': hit['_source']['description_scarlet'],
-                'descriptionViolet': hit['_source']['description_violet'],
-                'form': hit['_source']['form'],
-                'stats': {
-                    'hp': hit['_source']['stats_hp'],
-                    'attack': hit['_source']['stats_attack'],
-                    'defense': hit['_source']['stats_defense'],
-                    'specialAttack': hit['_source']['stats_special_attack'],
-                    'specialDefense': hit['_source']['stats_special_defense'],
-                    'speed': hit['_source']['stats_speed']
-                }
-            } for hit in results['hits']['hits']]
+            with span('retrieve'):
+                sources = self.retriever.search(query_vector, top_k, query_text=query)
+            return self.format_sources(sources)
 
         except Exception as e:
+            logger.warning(f'検索に失敗しました: {e}', extra={'query': query})
             return str(e)
 
-    def build_prompt(self, query, search_results):
+    def search_many(self, queries, top_k=5):
+        """複数クエリを1回のバッチエンコードと1回の検索リクエストで検索する
+
+        結果はクエリごとに {"query", "results"} または {"query", "error"} を返す。
+        """
+        results = [{"query": query} for query in queries]
+        valid = [i for i, query in enumerate(queries) if isinstance(query, str) and query.strip()]
+        for i in set(range(len(queries))) - set(valid):
+            results[i]["error"] = "empty query"
+        if not valid:
+            return results
+
+        try:
+            vectors = self.embedding_cache.get_or_compute_many(
+                [queries[i] for i in valid], self.encode)
+            with span('retrieve'):
+                responses = self.retriever.search_many(vectors, top_k, [queries[i] for i in valid])
+        except Exception as e:
+            for i in valid:
+                results[i]["error"] = str(e)
+            return results
+
+        for i, response in zip(valid, responses):
+            if isinstance(response, Exception):
+                results[i]["error"] = str(response)
+            else:
+                results[i]["results"] = self.format_sources(response)
+        return results
+
+    def format_hits(self, results):
+        return self.format_sources(hit['_source'] for hit in results['hits']['hits'])
+
+    @staticmethod
+    def descriptions(source):
+        # description_<ゲーム> の列をドキュメントの列順 (地方ごとのゲーム順) のまま取り出す
+        return {key[len('description_'):]: value for key, value in source.items()
+                if key.startswith('description_') and value}
+
+    def format_sources(self, sources):
+        return [self.format_source(source) for source in sources]
+
+    def format_source(self, source):
+        descriptions = self.descriptions(source)
+        texts = list(descriptions.values())
+        return {
+            'nameEn': source['name_english'],
+            'nameCn': source['name_chinese'],
+            'nameJa': source['name_japanese'],
+            'types': source['types'],
+            'abilities': source['abilities'],
+            'no': source['global_no'],
+            # 2つのゲームの説明を返していた頃の項目名をそのまま使う
+            'description': texts[0] if texts else None,
+            'descriptionViolet': texts[1] if len(texts) > 1 else None,
+            'descriptions': descriptions,
+            'region': source.get('region'),
+            'form': source['form'],
+            'stats': {
+                'hp': source['stats_hp'],
+                'attack': source['stats_attack'],
+                'defense': source['stats_defense'],
+                'specialAttack': source['stats_special_attack'],
+                'specialDefense': source['stats_special_defense'],
+                'speed': source['stats_speed']
+            }
+        }
+
+    def full_context(self, search_results):
         context = ""
 
         for doc in search_results:
             context = context + self.entry_template.format(**doc) + "\n\n"
 
-        prompt = self.prompt_template.format(question=query, context=context).strip()
+        return context
+
+    def build_prompt(self, query, search_results):
+        with span('build_prompt'):
+            if self.context_format == 'full':
+                context = self.full_context(search_results)
+            else:
+                context, _ = self.context_builder.build(search_results)
+
+            prompt = self.prompt_template.format(question=query, context=context).strip()
         return prompt
 
 
     def llm(self, prompt):
-        response = self.groq.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model= self.llm_model,
-        )
-        answer = response.choices[0].message.content
-        token_stats = {
-            "prompt_tokens": response.usage.prompt_tokens,
-            "completion_tokens": response.usage.completion_tokens, 
-            "total_tokens": response.usage.total_tokens
-        }
+        with self.llm_scheduler.slot(self.estimate_llm_tokens(prompt)) as ticket:
+            try:
+                response = self.groq.chat.completions.create(
+                    messages=[{"role": "user", "content": prompt}],
+                    model= self.llm_model,
+                )
+            except RateLimitError as e:
+                raise self.upstream_limited(e)
+            answer = response.choices[0].message.content
+            token_stats = {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens, 
+                "total_tokens": response.usage.total_tokens
+            }
+            ticket.used = token_stats["total_tokens"]
         return answer, token_stats
 
+    @staticmethod
+    def estimate_llm_tokens(prompt):
+        return estimate_tokens(prompt) + LLM_EXPECTED_COMPLETION_TOKENS
+
+    def upstream_limited(self, error):
+        """Groq のレート制限 (SDK の再試行でも通らなかった 429) を、後続の呼び出しも止める LlmOverloaded にする"""
+        try:
+            retry_after = float(error.response.headers.get('retry-after', 1))
+        except (TypeError, ValueError):
+            retry_after = 1.0
+        self.llm_scheduler.pause(retry_after)
+        return LlmOverloaded(f'Groq のレート制限に達しました: {error}', retry_after, status=429)
+
+    def llm_stream(self, prompt):
+        # (テキスト差分, トークン統計) を順に返す。統計は最後のチャンクでのみ埋まる
+        # 枠はストリームを読み終わる (またはクライアントが切断する) まで持ち続ける
+        with self.llm_scheduler.slot(self.estimate_llm_tokens(prompt)) as ticket:
+            try:
+                stream = self.groq.chat.completions.create(
+                    messages=[{"role": "user", "content": prompt}],
+                    model=self.llm_model,
+                    stream=True,
+                    # groq SDK の create() には stream_options の引数がないので本文に直接入れる
+                    extra_body={"stream_options": {"include_usage": True}},
+                )
+            except RateLimitError as e:
+                raise self.upstream_limited(e)
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                usage = chunk.usage or getattr(getattr(chunk, 'x_groq', None), 'usage', None)
+                token_stats = None
+                if usage is not None:
+                    token_stats = {
+                        "prompt_tokens": usage.prompt_tokens,
+                        "completion_tokens": usage.completion_tokens,
+                        "total_tokens": usage.total_tokens
+                    }
+                    ticket.used = token_stats["total_tokens"]
+                if delta or token_stats:
+                    yield delta or '', token_stats
+
     def evaluate_relevance(self, question, answer):
         prompt = self.evaluation_prompt_template.format(question=question, answer=answer)
-        evaluation, token_stats = self.llm(prompt)
-        print(f'Evaluation prompt: {prompt}')
-        print(f'Evaluation result: {evaluation}')
+        with span('evaluate'):
+            evaluation, token_stats = self.llm(prompt)
+        count_tokens('evaluation', token_stats)
+        logger.debug('evaluation', extra={'question': question, 'evaluation': evaluation})
 
         try:
             json_eval = json.loads(evaluation)
@@ -188,48 +424,302 @@ class VectorSearchEngine:
             result = {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
             return result, token_stats
 
-    def rag(self, query):
+    def rag(self, query, debug=False):
+        """debug=True なら段階ごとの処理時間を "debug" に入れて返す
+
+        同じクエリが実行中なら、その結果を受け取る ("coalesced": true)。
+        その場合の debug の処理時間は待っていた時間 (total) だけになる。
+        """
+        with request_timer() as timer:
+            try:
+                answer_data, shared = self.singleflight.do(normalize_query(query), lambda: self.run_rag(query))
+            except CoalesceTimeout:
+                count_coalesced('timeout')
+                raise
+            return self.with_debug(self.shared_answer(answer_data, shared), timer, debug)
+
+    @staticmethod
+    def shared_answer(answer_data, shared):
+        count_coalesced('coalesced' if shared else 'executed')
+        if not shared:
+            return answer_data
+        logger.info('rag coalesced', extra={'request_id': answer_data["request_id"]})
+        return {**answer_data, "coalesced": True}
+
+    def run_rag(self, query):
         t0 = time()
-        print(f'Starting RAG pipeline for query: {query}')
+        logger.info('rag', extra={'query': query})
+
+        structured = self.analyze_query(query)
+        if structured is not None:
+            return self.structured_answer(structured, t0)
 
         search_results = self.search(query)
-        
+
+        query_vector = self.encode_query(query)
+        cached = self.cached_answer(query_vector, search_results, t0)
+        if cached is not None:
+            return cached
+
         prompt = self.build_prompt(query, search_results)
-        
-        answer, token_stats = self.llm(prompt)
 
-        answer_json = self.process_json_text(answer)
-        relevance, rel_token_stats = self.evaluate_relevance(query, answer)
+        try:
+            with span('llm'):
+                answer, token_stats = self.llm(prompt)
+        except LlmOverloaded as e:
+            return self.overloaded_answer(e, search_results, t0)
+
+        with span('parse'):
+            parser = parse_answer(answer)
+        answer_json = self.parsed_answer(parser)
+
+        return self.finish_answer(query, query_vector, search_results, answer, answer_json, token_stats, t0)
+
+    def analyze_query(self, query):
+        """タイプ・特性・種族値の条件だけでできている質問なら StructuredQuery、そうでなければ None"""
+        if self.query_analyzer is None:
+            return None
+        with span('analyze'):
+            structured = self.query_analyzer.analyze(query)
+        count_route('rag' if structured is None else 'structured')
+        return structured
+
+    def structured_answer(self, structured, t0):
+        """埋め込み・ES・LLM を通さず、図鑑の表を条件で絞り込んで並べた結果を返す
+
+        pokemon_entries と summary は LLM の回答と同じ形にする (relevance_score と power_rating は None)。
+        """
+        limit = max(1, min(structured.limit or STRUCTURED_QUERY_LIMIT, STRUCTURED_QUERY_MAX_LIMIT))
+        with span('structured'):
+            sources, matched = self.pokemon_table.query(structured, limit)
+        search_results = self.format_sources(sources)
+        description = structured.describe()
+        entries = [{
+            "no": int(source['global_no']),
+            "name": source['name_japanese'],
+            "relevance_score": None,
+            "power_rating": None,
+            "relevance_analysis": structured.explain(source),
+            "background_story": None,
+        } for source in sources]
+        summary = None
+        if entries:
+            summary = {"most_relevant_pokemon": {
+                "no": entries[0]["no"],
+                "name": entries[0]["name"],
+                "explanation": f'{description}の条件に当てはまるポケモンは{matched}匹です',
+            }}
+
+        took = time() - t0
+        logger.info('rag answered by structured query', extra={
+            'conditions': description, 'matched': matched, 'response_time': took})
+        # LLM を呼んでいないのでキャッシュにも評価にも回さない
+        return {
+            "request_id": None,
+            "answer": None,
+            "model_used": None,
+            "response_time": took,
+            "relevance": "SKIPPED",
+            "relevance_explanation": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "total_tokens": None,
+            "eval_prompt_tokens": None,
+            "eval_completion_tokens": None,
+            "eval_total_tokens": None,
+            "pokemon_entries": entries,
+            "summary": summary,
+            "search_results": search_results,
+            "cached": False,
+            "coalesced": False,
+            "degraded": False,
+            "structured": {**structured.as_dict(), "description": description, "matched": matched},
+        }
+
+    def overloaded_answer(self, error, search_results, t0):
+        """LLM の枠が空かなかった。degraded_mode なら検索結果だけを返し、そうでなければ例外をそのまま投げる"""
+        if not self.degraded_mode:
+            count_overload('rejected')
+            raise error
+        count_overload('degraded')
+        logger.warning('rag degraded', extra={'reason': str(error), 'retry_after': error.retry_after})
+        # キャッシュにも評価にも回さない
+        return {
+            "request_id": None,
+            "answer": None,
+            "model_used": None,
+            "response_time": time() - t0,
+            "relevance": "SKIPPED",
+            "relevance_explanation": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "total_tokens": None,
+            "eval_prompt_tokens": None,
+            "eval_completion_tokens": None,
+            "eval_total_tokens": None,
+            "pokemon_entries": None,
+            "summary": None,
+            "search_results": search_results,
+            "cached": False,
+            "coalesced": False,
+            "degraded": True,
+            "retry_after": error.retry_after,
+            "structured": None,
+        }
+
+    @staticmethod
+    def with_debug(answer_data, timer, debug):
+        # キャッシュに入れた dict は書き換えない
+        return {**answer_data, "debug": timer.as_dict()} if debug else answer_data
+
+    def cached_answer(self, query_vector, search_results, t0):
+        # 近い質問で検索結果も同じなら、LLMを呼ばずにキャッシュ済みの回答を返す
+        with span('answer_cache'):
+            cached = self.answer_cache.lookup(query_vector, search_results)
+        if cached is None:
+            return None
+        logger.info('rag answered from cache', extra={'request_id': cached["request_id"]})
+        return {
+            **cached,
+            **self._relevance_fields(cached["request_id"]),
+            "response_time": time() - t0,
+            "search_results": search_results,
+            "cached": True,
+        }
+
+    def finish_answer(self, query, query_vector, search_results, answer, answer_json, token_stats, t0):
+        request_id = uuid.uuid4().hex
+        eval_status = self.evaluator.submit(request_id, query, answer)
         
         took = time() - t0
 
-        answer_data = {
+        answer_data = self.build_answer_data(
+            answer, answer_json, token_stats, request_id, eval_status, search_results, took)
+
+        # 途中で切れた回答や1件も読めなかった回答はキャッシュしない
+        if answer_json["complete"] and answer_json["pokemon_entries"]:
+            self.answer_cache.put(query_vector, search_results, answer_data)
+
+        count_tokens('answer', token_stats)
+        logger.info('rag finished', extra={
+            'request_id': request_id, 'response_time': took, 'parsed': answer_json["complete"],
+            'prompt_tokens': token_stats["prompt_tokens"], 'completion_tokens': token_stats["completion_tokens"]})
+    
+        return answer_data
+
+    def build_answer_data(self, answer, answer_json, token_stats, request_id, eval_status,
+                          search_results, took):
+        # 評価結果は後から /api/eval/<request_id> で取得する
+        return {
+            "request_id": request_id,
             "answer": answer,
             "model_used": self.llm_model,
             "response_time": took,
-            "relevance": relevance.get("Relevance", "UNKNOWN"),
-            "relevance_explanation": relevance.get("relevance_explanation", "Failed to parse evaluation"),
+            "relevance": eval_status,
+            "relevance_explanation": None,
             "prompt_tokens": token_stats["prompt_tokens"],
             "completion_tokens": token_stats["completion_tokens"], 
             "total_tokens": token_stats["total_tokens"],
-            "eval_prompt_tokens": rel_token_stats["prompt_tokens"],
-            "eval_completion_tokens": rel_token_stats["completion_tokens"],
-            "eval_total_tokens": rel_token_stats["total_tokens"],
+            "eval_prompt_tokens": None,
+            "eval_completion_tokens": None,
+            "eval_total_tokens": None,
             "pokemon_entries": answer_json.get("pokemon_entries"),
             "summary": answer_json.get("summary"),
             "search_results": search_results,
+            "cached": False,
+            "coalesced": False,
+            "degraded": False,
+            "structured": None,
         }
-    
-        return answer_data
 
-    def process_json_text(self, input_str):
-        cleaned_str = input_str.strip('[]')
-        
-        cleaned_str = cleaned_str.strip("'")  
-        
-        try:
-            json_obj = json.loads(cleaned_str)
-            return json_obj
-        except json.JSONDecodeError as e:
-            print(f"error: {e}")
-            return None
\ No newline at end of file
+    def _relevance_fields(self, request_id):
+        # キャッシュ元のリクエストの評価が終わっていればその結果を載せる
+        result = self.evaluator.lookup(request_id)
+        if result is None or result["status"] != "done":
+            return {}
+        return {
+            "relevance": result["relevance"],
+            "relevance_explanation": result["relevance_explanation"],
+            "eval_prompt_tokens": result["eval_prompt_tokens"],
+            "eval_completion_tokens": result["eval_completion_tokens"],
+            "eval_total_tokens": result["eval_total_tokens"],
+        }
+
+    def rag_stream(self, query, debug=False):
+        """rag() と同じ処理を (イベント名, データ) の形で段階的に返す"""
+        with request_timer() as timer:
+            t0 = time()
+            logger.info('rag_stream', extra={'query': query})
+
+            structured = self.analyze_query(query)
+            if structured is not None:
+                answer_data = self.structured_answer(structured, t0)
+                yield 'search_results', answer_data["search_results"]
+                for entry in answer_data["pokemon_entries"]:
+                    yield 'entry', entry
+                yield 'summary', answer_data["summary"]
+                yield 'stats', self._stream_stats(self.with_debug(answer_data, timer, debug))
+                return
+
+            search_results = self.search(query)
+            yield 'search_results', search_results
+
+            query_vector = self.encode_query(query)
+            cached = self.cached_answer(query_vector, search_results, t0)
+            if cached is not None:
+                for entry in cached.get("pokemon_entries") or []:
+                    yield 'entry', entry
+                yield 'summary', cached.get("summary")
+                yield 'stats', self._stream_stats(self.with_debug(cached, timer, debug))
+                return
+
+            prompt = self.build_prompt(query, search_results)
+
+            parser = AnswerParser()
+            chunks = []
+            token_stats = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            llm_started = perf_counter()
+            try:
+                with span('llm'):
+                    for delta, usage in self.llm_stream(prompt):
+                        if not chunks:
+                            record('llm_first_token', perf_counter() - llm_started)
+                        chunks.append(delta)
+                        if usage is not None:
+                            token_stats = usage
+                        for entry in parser.feed(delta):
+                            yield 'entry', entry
+            except LlmOverloaded as e:
+                # 枠が空かなかった (検索結果は送信済み)
+                degraded = self.overloaded_answer(e, search_results, t0)
+                yield 'stats', self._stream_stats(self.with_debug(degraded, timer, debug))
+                return
+
+            # 途中で切れていれば、閉じた時点で検証を通った要素を送る
+            for entry in parser.close():
+                yield 'entry', entry
+            answer = ''.join(chunks)
+            answer_json = self.parsed_answer(parser)
+            yield 'summary', answer_json["summary"]
+
+            answer_data = self.finish_answer(
+                query, query_vector, search_results, answer, answer_json, token_stats, t0)
+            yield 'stats', self._stream_stats(self.with_debug(answer_data, timer, debug))
+
+    @staticmethod
+    def _stream_stats(answer_data):
+        # 逐次送信済みの項目を除いた残り
+        return {k: v for k, v in answer_data.items()
+                if k not in ("answer", "pokemon_entries", "summary", "search_results")}
+
+    def parsed_answer(self, parser):
+        """読み終えた AnswerParser から回答を取り出し、修復や取りこぼしを記録する"""
+        answer_json = parser.answer()
+        count_json_repairs(parser.repairs)
+        if not answer_json["pokemon_entries"]:
+            count_error('parse')
+        if parser.repairs or parser.dropped:
+            logger.warning('LLMの回答を修復して読みました', extra={
+                'repairs': parser.repairs, 'dropped_entries': parser.dropped,
+                'entries': len(answer_json["pokemon_entries"]), 'complete': answer_json["complete"]})
+        return answer_json
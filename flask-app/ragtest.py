@@ -1,117 +1,171 @@
+"""VectorSearchEngine を fakeservers.py のスタブ (ES / Groq) に向けて通しで動かすテスト
+
+    python ragtest.py
+"""
 import unittest
-from unittest.mock import Mock, patch
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
 from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
-from dotenv import load_dotenv
-import os
-from vector_search import VectorSearchEngine # Add this import
+from groq import Groq
+
+from cache import SemanticAnswerCache
+from fakeservers import FakeElasticsearch, FakeGroq, FakeServers, fake_answer
+from llm_scheduler import LlmOverloaded, LlmScheduler
+from loadtest import DummyEncoder, build_engine
+from main import create_app
+from suggest import NameIndex
+
 
 class TestVectorSearchEngine(unittest.TestCase):
-    def setUp(self):
-        load_dotenv()
-        self.base_url = 'http://localhost:8080'
-        self.key_groq = os.getenv('KEY_groq')
-        
-        with patch('elasticsearch.Elasticsearch'), \
-             patch('sentence_transformers.SentenceTransformer'):
-            self.engine = VectorSearchEngine()
-            self.engine.es_client = Mock()
-            self.engine.model = Mock()
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = FakeServers(FakeElasticsearch(latency=0), FakeGroq(latency=0, entries=3)).start()
+        cls.engine = build_engine(DummyEncoder(), cls.servers)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servers.stop()
 
     def test_search(self):
-        self.engine.model.encode.return_value = np.array([0.1, 0.2, 0.3])
-        mock_hits = {
-            'hits': {
-                'hits': [{
-                    '_source': {
-                        'name_english': 'Pikachu',
-                        'name_chinese': '皮卡丘',
-                        'types': ['Electric'],
-                        'abilities': ['Static'],
-                        'global_no': '025',
-                        'description_scarlet': 'Mouse Pokemon'
-                    }
-                }]
-            }
-        }
-        self.engine.es_client.search.return_value = mock_hits
-
-        results = self.engine.search("electric pokemon")
-        
-        self.assertEqual(len(results), 1)
-        self.assertEqual(results[0]['nameEn'], 'Pikachu')
-        self.engine.es_client.search.assert_called_once()
+        results = self.engine.search("ほのおタイプのポケモン", top_k=3)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['nameEn'], 'Pokemon1')
+        self.assertEqual(results[0]['stats']['hp'], 51)
 
     def test_build_prompt(self):
-        query = "Who is Pikachu?"
-        search_results = [{
-            'nameEn': 'Pikachu',
-            'nameCn': '皮卡丘',
-            'types': ['Electric'],
-            'abilities': ['Static'],
-            'number': '025',
-            'description': 'Mouse Pokemon'
-        }]
-
-        prompt = self.engine.build_prompt(query, search_results)
-        self.assertIn('Pikachu', prompt)
-        self.assertIn('Mouse Pokemon', prompt)
-        self.assertIn(query, prompt)
+        query = "ほのおタイプのポケモン"
+        prompt = self.engine.build_prompt(query, self.engine.search(query, top_k=2))
 
-    @patch('builtins.client')
-    def test_llm(self, mock_client):
-        mock_response = Mock()
-        mock_response.choices = [Mock(message=Mock(content="Test response"))]
-        mock_response.usage = Mock(
-            prompt_tokens=10,
-            completion_tokens=5,
-            total_tokens=15
-        )
-        mock_client.chat.completions.create.return_value = mock_response
+        self.assertIn('ポケモン1', prompt)
+        self.assertIn('ポケモン1の説明文。', prompt)
+        self.assertIn(query, prompt)
 
+    def test_llm(self):
         answer, token_stats = self.engine.llm("test prompt")
-        
-        self.assertEqual(answer, "Test response")
-        self.assertEqual(token_stats['total_tokens'], 15)
-
-    def test_evaluate_relevance(self):
-        with patch.object(self.engine, 'llm') as mock_llm:
-            mock_llm.return_value = ('{"Relevance": "RELEVANT", "Explanation": "Test"}', {
-                "prompt_tokens": 10,
-                "completion_tokens": 5,
-                "total_tokens": 15
-            })
-
-            result, tokens = self.engine.evaluate_relevance(
-                "test question",
-                "test answer"
-            )
-
-            self.assertEqual(result["Relevance"], "RELEVANT")
-            self.assertEqual(tokens["total_tokens"], 15)
+
+        self.assertIn('pokemon_entries', answer)
+        self.assertEqual(token_stats['completion_tokens'], 400)
 
     def test_rag(self):
-        with patch.object(self.engine, 'search') as mock_search, \
-             patch.object(self.engine, 'llm') as mock_llm, \
-             patch.object(self.engine, 'evaluate_relevance') as mock_eval:
-            
-            mock_search.return_value = [{"nameEn": "Pikachu"}]
-            mock_llm.return_value = ("Test answer", {
-                "prompt_tokens": 10,
-                "completion_tokens": 5,
-                "total_tokens": 15
-            })
-            mock_eval.return_value = (
-                {"Relevance": "RELEVANT", "Explanation": "Test"},
-                {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8}
-            )
-
-            result = self.engine.rag("test query")
-
-            self.assertIn("answer", result)
-            self.assertIn("relevance", result)
-            self.assertIn("total_tokens", result)
+        result = self.engine.rag("ほのおタイプのポケモン", debug=True)
+
+        self.assertEqual(len(result['pokemon_entries']), 3)
+        self.assertIsInstance(result['search_results'], list)
+        self.assertIn('llm', result['debug']['timings_ms'])
+
+    def test_search_many_reports_errors_per_query(self):
+        with FakeServers(FakeElasticsearch(latency=0, msearch_errors={1}), FakeGroq(latency=0)) as servers:
+            engine = build_engine(DummyEncoder(), servers)
+            results = engine.search_many(['ほのお', 'みず', '', 'でんき'], top_k=2)
+
+        self.assertEqual([len(result.get('results', [])) for result in results], [2, 0, 0, 2])
+        self.assertEqual(results[1]['error'], 'all shards failed')
+        self.assertEqual(results[2]['error'], 'empty query')
+        self.assertEqual(results[3]['results'][0]['nameEn'], 'Pokemon1')
+
+    def test_batch_endpoint(self):
+        client = create_app(engine=self.engine, names=NameIndex([])).test_client()
+
+        response = client.post('/api/search/batch', json={'queries': ['ほのお', 'みず'], 'top_k': -3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([len(result['results']) for result in response.get_json()['results']], [1, 1])
+
+        response = client.post('/api/search/batch', json={'queries': ['ほのお'], 'top_k': 'five'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {'error': 'top_k must be an integer'})
+
+    def test_after_fork_recreates_clients_and_locks(self):
+        engine = build_engine(DummyEncoder(), self.servers)
+        locks = [engine.embedding_cache._lock, engine.answer_cache._lock, engine.singleflight._lock,
+                 engine.llm_scheduler._cond, engine.retriever.projection._lock]
+        es_client = Elasticsearch([self.servers.es_url])
+        groq = Groq(api_key='fake', base_url=self.servers.llm_url)
+
+        engine.after_fork(eval_workers=0, es_client=es_client, groq=groq)
+
+        self.assertIs(engine.es_client, es_client)
+        self.assertIs(engine.groq, groq)
+        self.assertIs(engine.retriever.es_client, es_client)
+        self.assertIs(engine.retriever.projection.es_client, es_client)
+        new_locks = [engine.embedding_cache._lock, engine.answer_cache._lock, engine.singleflight._lock,
+                     engine.llm_scheduler._cond, engine.retriever.projection._lock]
+        self.assertFalse(any(old is new for old, new in zip(locks, new_locks)))
+        self.assertEqual(len(engine.search('ほのお', top_k=2)), 2)
+
+    def test_identical_concurrent_queries_coalesced(self):
+        llm = FakeGroq(latency=0.3, entries=3)
+        with FakeServers(FakeElasticsearch(latency=0), llm) as servers:
+            engine = build_engine(DummyEncoder(), servers)
+            # 正規化すると同じになるクエリ
+            queries = ['Fire タイプ', 'ＦＩＲＥ　タイプ', ' fire  タイプ'] * 2
+            with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+                results = list(pool.map(engine.rag, queries))
+
+        self.assertEqual(llm.requests, 1)
+        self.assertEqual(len({result['request_id'] for result in results}), 1)
+        self.assertEqual(sum(result['coalesced'] for result in results), len(queries) - 1)
+        self.assertEqual(engine.singleflight.stats()['coalesced'], len(queries) - 1)
+
+    def test_malformed_answer_returns_partial_entries(self):
+        engine = build_engine(DummyEncoder(), self.servers)
+        engine.answer_cache = SemanticAnswerCache(max_size=8)
+        truncated = '```json\n' + fake_answer(3)[:-60]
+        engine.llm = lambda prompt: (truncated, {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2})
+
+        result = engine.rag("でんきタイプ")
+
+        self.assertEqual([entry['no'] for entry in result['pokemon_entries']], [1, 2, 3])
+        self.assertIsNone(result['summary'])
+        # 途中で切れた回答はキャッシュしない
+        self.assertEqual(engine.answer_cache.stats()['size'], 0)
+
+    def test_degraded_when_llm_saturated(self):
+        engine = build_engine(DummyEncoder(), self.servers)
+        # 枠は1つで待ち行列はない。その枠を別の呼び出しが使っている間は一杯
+        engine.llm_scheduler = LlmScheduler(max_concurrency=1, queue_size=0)
+
+        with engine.llm_scheduler.slot():
+            result = engine.rag("みずタイプ")
+
+            self.assertTrue(result['degraded'])
+            self.assertIsNone(result['pokemon_entries'])
+            self.assertEqual(len(result['search_results']), 5)
+            self.assertGreaterEqual(result['retry_after'], 1)
+
+            engine.degraded_mode = False
+            with self.assertRaises(LlmOverloaded) as cm:
+                engine.rag("くさタイプ")
+            self.assertEqual(cm.exception.status, 429)
+
+        # 枠が空けば同じ設定でも通る
+        self.assertIsNotNone(engine.rag("ほのおタイプ")['pokemon_entries'])
+
+    def test_structured_query_skips_embedding_and_llm(self):
+        es = FakeElasticsearch(latency=0)
+        llm = FakeGroq(latency=0, entries=3)
+        with FakeServers(es, llm) as servers:
+            engine = build_engine(DummyEncoder(), servers)
+            result = engine.rag('素早さ100以上のほのおタイプ', debug=True)
+            events = list(engine.rag_stream('fastest electric'))
+
+        self.assertEqual((es.requests, llm.requests), (0, 0))
+        self.assertEqual(engine.embedding_cache.stats()['size'], 0)
+        self.assertEqual(result['structured']['filters'], [{'stat': 'speed', 'op': 'ge', 'value': 100}])
+        self.assertTrue(result['search_results'])
+        for pokemon in result['search_results']:
+            self.assertIn('ほのお', pokemon['types'])
+            self.assertGreaterEqual(pokemon['stats']['speed'], 100)
+        self.assertEqual([e['no'] for e in result['pokemon_entries']], [int(p['no']) for p in result['search_results']])
+        self.assertEqual(result['summary']['most_relevant_pokemon']['no'], result['pokemon_entries'][0]['no'])
+        self.assertIn('structured', result['debug']['timings_ms'])
+
+        names = [name for name, _ in events]
+        self.assertEqual(names[0], 'search_results')
+        self.assertEqual(names[-2:], ['summary', 'stats'])
+        speeds = [pokemon['stats']['speed'] for pokemon in events[0][1]]
+        self.assertEqual(speeds, sorted(speeds, reverse=True))
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,27 @@
+"""pokedex.db の地方図鑑テーブル (injest.py と pokemon_table.py で共有する)
+
+並びは新しいゲームが先。
+"""
+
+# 地方図鑑テーブル -> そのテーブルにある図鑑説明の列 (ゲームごと)
+# 説明文は description_<ゲーム> の列にそろえる
+REGION_GAMES = {
+    'paldea': ['scarlet', 'violet'],
+    'kitakami': ['scarlet', 'violet'],
+    'blueberry': ['scarlet', 'violet'],
+    'hisui': ['legendsarceus'],
+    'galar': ['sword', 'shield'],
+    'isle_of_armor': ['sword', 'shield'],
+    'crown_tundra': ['sword', 'shield'],
+    'alola_usum': ['ultrasun', 'ultramoon'],
+    'alola_sm': ['sun', 'moon'],
+    'central_kalos': ['x', 'y'],
+    'coast_kalos': ['x', 'y'],
+    'mountain_kalos': ['x', 'y'],
+    'unova_b2w2': ['black2', 'white2'],
+    'unova_bw': ['black', 'white'],
+    'sinnoh': ['diamond', 'pearl', 'platinum'],
+    'hoenn': ['ruby', 'sapphire', 'emerald'],
+    'johto': ['gold', 'silver', 'crystal'],
+    'kanto': ['red', 'green', 'blue', 'pikachu'],
+}
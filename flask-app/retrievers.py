@@ -0,0 +1,335 @@
+"""search() の裏側で使う検索バックエンド
+
+どのバックエンドも、クエリベクトル(と元のクエリ文字列)から Elasticsearch の _source と同じ形の dict のリストを返す。
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VECTORS_FILE = 'vectors.f32'
+METADATA_FILE = 'metadata.json'
+# 公開中のバージョンのディレクトリ名を書いたファイル
+CURRENT_FILE = 'CURRENT'
+
+
+class ElasticsearchRetriever:
+    """projection (projection.ProjectionResolver) を渡すと、インデックスと同じ次元削減をクエリにも適用する"""
+
+    def __init__(self, es_client, index_name='pk', num_candidates=100, projection=None):
+        self.es_client = es_client
+        self.index_name = index_name
+        self.num_candidates = num_candidates
+        self.projection = projection
+
+    def after_fork(self, es_client):
+        """fork したワーカープロセスで作り直したクライアントに差し替える"""
+        self.es_client = es_client
+        if self.projection is not None:
+            self.projection.after_fork(es_client)
+
+    def query_vector(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.projection is not None:
+            vector = self.projection.project(vector)
+        return vector.tolist()
+
+    def build_search_body(self, query_vector, top_k):
+        return {
+            "knn": {
+                "field": "combined_text_vector",
+                "query_vector": query_vector,
+                "k": top_k,
+                "num_candidates": self.num_candidates
+            },
+            "collapse": {
+                "field": "global_no"
+            },
+            "_source": {
+                "excludes": ["combined_text_vector"]
+            }
+        }
+
+    @staticmethod
+    def sources(results):
+        return [hit['_source'] for hit in results['hits']['hits']]
+
+    @staticmethod
+    def response_error(response):
+        error = response['error']
+        return RuntimeError(error.get('reason', str(error)) if isinstance(error, dict) else str(error))
+
+    def build_msearch(self, query_vectors, top_k, query_texts=None):
+        searches = []
+        for vector in query_vectors:
+            searches.append({"index": self.index_name})
+            searches.append(self.build_search_body(self.query_vector(vector), top_k))
+        return searches
+
+    def parse_msearch(self, responses, top_k):
+        """_msearch の応答をクエリごとの結果のリストか例外にする"""
+        return [self.response_error(r) if 'error' in r else self.sources(r) for r in responses]
+
+    def search(self, query_vector, top_k, query_text=None):
+        results = self.es_client.search(
+            index=self.index_name,
+            body=self.build_search_body(self.query_vector(query_vector), top_k)
+        )
+        return self.sources(results)
+
+    def search_many(self, query_vectors, top_k, query_texts=None):
+        """1回の _msearch で検索し、クエリごとに結果のリストか例外を返す"""
+        searches = self.build_msearch(query_vectors, top_k, query_texts)
+        responses = self.es_client.msearch(searches=searches)['responses']
+        return self.parse_msearch(responses, top_k)
+
+
+class HybridElasticsearchRetriever(ElasticsearchRetriever):
+    """BM25 (multi_match) と kNN の2つの順位を Reciprocal Rank Fusion でまとめる
+
+    ES 8.4 には rank/rrf が無いので、2つの検索を1回の _msearch で送り、融合はクライアント側で行う。
+    名前の完全一致は BM25 側で拾えるので、kNN の num_candidates は小さくてよい。
+    """
+
+    TEXT_FIELDS = ["name_japanese^3", "name_english^3", "name_chinese^3", "description_*"]
+
+    def __init__(self, es_client, index_name='pk', num_candidates=50, window_size=20,
+                 bm25_weight=1.0, knn_weight=1.0, rank_constant=60, projection=None):
+        super().__init__(es_client, index_name=index_name, num_candidates=num_candidates, projection=projection)
+        self.window_size = window_size
+        self.bm25_weight = bm25_weight
+        self.knn_weight = knn_weight
+        self.rank_constant = rank_constant
+
+    def build_text_body(self, query_text, size):
+        return {
+            "query": {
+                "multi_match": {
+                    "query": query_text,
+                    "fields": self.TEXT_FIELDS
+                }
+            },
+            "size": size,
+            "collapse": {
+                "field": "global_no"
+            },
+            "_source": {
+                "excludes": ["combined_text_vector"]
+            }
+        }
+
+    def build_msearch(self, query_vectors, top_k, query_texts=None):
+        # クエリごとに kNN と BM25 の2本を並べる。テキストが無ければ BM25 は size=0 で送る
+        query_texts = query_texts or [None] * len(query_vectors)
+        window = max(top_k, self.window_size)
+        searches = []
+        for vector, text in zip(query_vectors, query_texts):
+            searches.append({"index": self.index_name})
+            searches.append(self.build_search_body(self.query_vector(vector), min(window, self.num_candidates)))
+            searches.append({"index": self.index_name})
+            searches.append(self.build_text_body(text or "", window if text else 0))
+        return searches
+
+    def fuse(self, rankings, top_k):
+        """[(重み, _sourceのリスト)] を RRF スコア順に並べ、global_no ごとに1件にする"""
+        scores = {}
+        sources = {}
+        for weight, ranking in rankings:
+            for rank, source in enumerate(ranking, start=1):
+                key = source.get('global_no')
+                scores[key] = scores.get(key, 0.0) + weight / (self.rank_constant + rank)
+                sources.setdefault(key, source)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return [sources[key] for key in ranked[:top_k]]
+
+    def parse_msearch(self, responses, top_k):
+        results = []
+        for knn, text in zip(responses[0::2], responses[1::2]):
+            if 'error' in knn:
+                results.append(self.response_error(knn))
+            elif 'error' in text:
+                # BM25 側だけ失敗した場合は kNN の結果で返す
+                logger.warning(f'BM25検索に失敗しました: {text["error"]}')
+                results.append(self.sources(knn)[:top_k])
+            else:
+                results.append(self.fuse([(self.knn_weight, self.sources(knn)),
+                                          (self.bm25_weight, self.sources(text))], top_k))
+        return results
+
+    def search(self, query_vector, top_k, query_text=None):
+        result = self.search_many([query_vector], top_k, [query_text])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class NumpyRetriever:
+    """injest.py が書き出した float32 行列をメモリマップして、プロセス内で検索する
+
+    ベクトルは書き出し時に正規化済みなので、内積がそのままコサイン類似度になる。
+    query_text は使わず、ベクトルだけで検索する。
+    LocalIndexWriter が新しいバージョンを公開したら、次の検索の前に読み直す。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pointer_path = os.path.join(directory, CURRENT_FILE)
+        self._lock = threading.Lock()
+        self._key = None
+        # (ベクトル, ドキュメント, global_no) の組。検索は1回だけ読んでから使うので、途中で差し替わっても食い違わない
+        self._index = None
+        self.reload_if_changed()
+
+    @property
+    def vectors(self):
+        return self._index[0]
+
+    @property
+    def documents(self):
+        return self._index[1]
+
+    def after_fork(self, es_client=None):
+        self._lock = threading.Lock()
+
+    def _current(self):
+        """(変更の検出に使うキー, 読むディレクトリ)。ポインタがない古い書き出しはディレクトリ直下を読む"""
+        try:
+            stat = os.stat(self.pointer_path)
+        except FileNotFoundError:
+            stat = os.stat(os.path.join(self.directory, METADATA_FILE))
+            return (stat.st_ino, stat.st_mtime_ns), self.directory
+        key = (stat.st_ino, stat.st_mtime_ns)
+        if key == self._key:
+            return key, None
+        with open(self.pointer_path, encoding='utf-8') as f:
+            return key, os.path.join(self.directory, f.read().strip())
+
+    def reload_if_changed(self):
+        key, path = self._current()
+        if key == self._key:
+            return
+        with self._lock:
+            if key == self._key:
+                return
+            with open(os.path.join(path, METADATA_FILE), encoding='utf-8') as f:
+                metadata = json.load(f)
+            vectors_path = os.path.join(path, VECTORS_FILE)
+            vectors = np.memmap(vectors_path, dtype=np.float32, mode='r')
+            dim = metadata['dim']
+            if vectors.size != metadata['count'] * dim:
+                raise ValueError(f'{vectors_path} の行数がメタデータと一致しません')
+            documents = metadata['documents']
+            self._index = (vectors.reshape(metadata['count'], dim), documents,
+                           [doc.get('global_no') for doc in documents])
+            self._key = key
+        logger.info(f'ローカルインデックスを読み込みました: {metadata["count"]}件 ({path})')
+
+    @staticmethod
+    def _top_k(scores, top_k, documents, global_nos):
+        # ESのknn(k=top_k)と同じく上位k件を取り、global_noごとに最上位の1件へまとめる
+        k = min(top_k, len(scores))
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        seen = set()
+        results = []
+        for idx in candidates:
+            global_no = global_nos[idx]
+            if global_no in seen:
+                continue
+            seen.add(global_no)
+            results.append(documents[idx])
+        return results
+
+    def _normalize(self, query_vectors):
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        norms = np.linalg.norm(query_vectors, axis=-1, keepdims=True)
+        return query_vectors / np.where(norms == 0, 1, norms)
+
+    def search(self, query_vector, top_k, query_text=None):
+        self.reload_if_changed()
+        vectors, documents, global_nos = self._index
+        return self._top_k(vectors @ self._normalize(query_vector), top_k, documents, global_nos)
+
+    def search_many(self, query_vectors, top_k, query_texts=None):
+        self.reload_if_changed()
+        vectors, documents, global_nos = self._index
+        scores = self._normalize(np.stack(query_vectors)) @ vectors.T
+        return [self._top_k(row, top_k, documents, global_nos) for row in scores]
+
+
+class LocalIndexWriter:
+    """NumpyRetriever 用のベクトルとメタデータをチャンクごとに追記する
+
+    書き出しは新しいバージョンのディレクトリに行い、commit() で CURRENT (どのバージョンを読むか) を
+    1回の rename で置き換える。ベクトルとメタデータは必ず同じバージョンの組で読まれ、
+    commit() までは既存のローカルインデックスをそのまま読める。
+    """
+
+    # 読み込み中のプロセスがあるかもしれないので、1つ前のバージョンまでは消さない
+    KEEP_VERSIONS = 2
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.version = f'v{time.time_ns()}-{os.getpid()}'
+        self.version_dir = os.path.join(directory, self.version)
+        os.makedirs(self.version_dir)
+        self._file = open(os.path.join(self.version_dir, VECTORS_FILE), 'wb')
+        self.documents = []
+        self.dim = 0
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, documents, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self._file.write(np.ascontiguousarray(vectors / np.where(norms == 0, 1, norms)).tobytes())
+        self.documents.extend(documents)
+        self.dim = vectors.shape[1]
+
+    def commit(self):
+        self._file.close()
+        with open(os.path.join(self.version_dir, METADATA_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'count': len(self.documents), 'dim': self.dim, 'documents': self.documents}, f,
+                      ensure_ascii=False)
+        pointer_path = os.path.join(self.directory, CURRENT_FILE)
+        with open(pointer_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.version)
+        os.replace(pointer_path + '.tmp', pointer_path)
+        self.prune()
+
+    def prune(self):
+        versions = sorted((name for name in os.listdir(self.directory)
+                           if name.startswith('v') and name[1:].split('-')[0].isdigit()
+                           and os.path.isdir(os.path.join(self.directory, name))),
+                          key=lambda name: int(name[1:].split('-')[0]))
+        for name in versions[:-self.KEEP_VERSIONS]:
+            if name != self.version:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+def export_local_index(directory, documents, vectors):
+    """NumpyRetriever 用に正規化済みベクトルとメタデータを書き出す"""
+    writer = LocalIndexWriter(directory)
+    writer.add(documents, vectors)
+    writer.commit()
+
+
+def create_retriever(backend, es_client=None, index_name='pk', local_index_dir='local_index', projection=None,
+                     **hybrid_options):
+    if backend == 'numpy':
+        return NumpyRetriever(local_index_dir)
+    if backend == 'es':
+        return ElasticsearchRetriever(es_client, index_name=index_name, projection=projection)
+    if backend == 'hybrid':
+        return HybridElasticsearchRetriever(es_client, index_name=index_name, projection=projection,
+                                            **hybrid_options)
+    raise ValueError(f'unknown retriever backend: {backend}')
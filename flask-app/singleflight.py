@@ -0,0 +1,121 @@
+"""同じキーの処理が実行中なら、新しく実行せずにその結果を待って受け取る (singleflight)
+
+    flight = SingleFlight(timeout=60)
+    result, shared = flight.do(normalize_query(query), lambda: pipeline(query))
+
+最初に来たリクエスト (リーダー) だけが fn を実行し、実行中に来た同じキーのリクエストは
+その完了を待って同じ結果を受け取る。リーダーが例外を出したら、待っていたリクエストにも同じ例外を投げる。
+結果は保持しない (終わった後に来たリクエストは新しく実行する)。保持するのは cache.py の役目。
+"""
+import asyncio
+import threading
+
+
+class CoalesceTimeout(TimeoutError):
+    """実行中の処理を待ちきれなかった"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """スレッドで処理するサーバー (Flask / gunicorn の gthread) 用
+
+    timeout は後から来たリクエストが待つ秒数の上限。0 以下なら相乗りせず毎回実行する。
+    """
+
+    def __init__(self, timeout=60.0):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def after_fork(self):
+        # 親プロセスの実行中の呼び出しとロックは子プロセスでは意味がない
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """(結果, 他のリクエストの実行結果を受け取ったか)"""
+        if self.timeout <= 0:
+            return fn(), False
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                with self._lock:
+                    self.failures += 1
+                raise
+            finally:
+                # 待っている側を起こす前に外し、この後に来たリクエストは新しく実行させる
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result, False
+
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise CoalesceTimeout(f'同じクエリの処理が {self.timeout} 秒以内に終わりませんでした')
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "timeout": self.timeout,
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "failures": self.failures,
+            }
+
+
+class AsyncSingleFlight(SingleFlight):
+    """asyncio 版 (async_app.py 用)。1つのイベントループの中だけで使う
+
+    実行はタスクにして shield で待つので、リーダーのクライアントが切断しても
+    相乗りしているリクエストの処理は止まらない。
+    """
+
+    async def do(self, key, fn):
+        if self.timeout <= 0:
+            return await fn(), False
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.executions += 1
+            return await asyncio.shield(task), False
+
+        self.coalesced += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout), True
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise CoalesceTimeout(f'同じクエリの処理が {self.timeout} 秒以内に終わりませんでした') from None
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
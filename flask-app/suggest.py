@@ -0,0 +1,118 @@
+"""ポケモン名の入力補完 (/api/suggest)
+
+pokedex.db の日本語・英語・中国語 (簡体字) の名前から、起動時に前方一致用の索引を作る。
+正規化したキーをソートした配列に持ち、二分探索で前方一致の範囲を取り出すだけなので、
+ES や LLM には問い合わせない。
+
+- 正規化: NFKC、大文字小文字の同一視、ひらがなはカタカナに寄せる、空白や記号 (・ . - ' :) は無視
+  ("ぴかちゅう" → ピカチュウ, "mr mime" → Mr. Mime)
+- 順位: 完全一致 → 通常の姿 (メガシンカなどのフォルムより前) → 名前の短い順 → 全国図鑑番号順
+"""
+import heapq
+import logging
+import os
+import sqlite3
+import unicodedata
+from bisect import bisect_left, bisect_right
+
+logger = logging.getLogger(__name__)
+
+# 補完の対象にする名前と、その言語
+NAME_FIELDS = (('name', 'ja'), ('name_english', 'en'), ('name_chinese', 'zh'))
+MAX_LIMIT = 20
+
+# ぁ-ゖ と ゝゞ をカタカナに
+_KATAKANA = {code: code + 0x60 for code in list(range(0x3041, 0x3097)) + [0x309D, 0x309E]}
+_IGNORED = {ord(c): None for c in ' \t・.-\'’:'}
+# 前方一致の範囲の上端に使う、どの文字よりも大きい文字
+_MAX_CHAR = '\U0010ffff'
+
+
+def to_katakana(text):
+    return text.translate(_KATAKANA)
+
+
+def normalize_name(text):
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    return to_katakana(text).translate(_IGNORED)
+
+
+class NameIndex:
+    def __init__(self, rows):
+        """rows: (全国図鑑番号, フォルム, 日本語名, 英語名, 中国語名) の並び"""
+        entries = []
+        seen = set()
+        # 通常の姿を先に登録し、地方のすがたなど名前が同じ行はまとめる
+        for no, form, jpn, eng, chs in sorted(rows, key=lambda r: (bool(r[1]), r[0])):
+            if not jpn or (no, jpn) in seen:
+                continue
+            seen.add((no, jpn))
+            entries.append({
+                'no': no,
+                'name': jpn,
+                'name_english': eng or None,
+                'name_chinese': chs or None,
+                'form': form or None,
+            })
+
+        keys = []
+        for i, entry in enumerate(entries):
+            for field, lang in NAME_FIELDS:
+                label = entry[field]
+                key = normalize_name(label)
+                if key:
+                    # 名前の長さは当たった言語の名前で比べる ("p" なら英語名の短い順)
+                    # 完全一致以外の順位は検索のたびに比べなくて済むよう整数にしておく
+                    order = (entry['form'] is not None, len(label), entry['no'])
+                    keys.append((key, order, i, lang, label))
+        keys.sort()
+        ranks = {order: rank for rank, order in enumerate(sorted({k[1] for k in keys}))}
+
+        self.entries = entries
+        self._keys = [k[0] for k in keys]
+        self._ranks = [ranks[k[1]] for k in keys]
+        self._postings = [(k[2], k[3], k[4]) for k in keys]
+
+    @classmethod
+    def from_db(cls, db_path):
+        with sqlite3.connect(f'file:{db_path}?mode=ro', uri=True) as conn:
+            rows = conn.execute('SELECT id, form, jpn, eng, chs FROM pokedex').fetchall()
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, query, limit=10):
+        key = normalize_name(query)
+        limit = max(1, min(limit, MAX_LIMIT))
+        if not key:
+            return []
+        lo = bisect_left(self._keys, key)
+        exact = bisect_right(self._keys, key, lo)
+        hi = bisect_right(self._keys, key + _MAX_CHAR, exact)
+        # 完全一致は範囲の先頭に並んでいる。同じポケモンが複数の言語で当たることがあるので
+        # 残りは多めに取ってから重複を除く
+        candidates = list(range(lo, exact))
+        candidates += heapq.nsmallest(limit * len(NAME_FIELDS), range(exact, hi), key=self._ranks.__getitem__)
+
+        results = []
+        seen = set()
+        for i in candidates:
+            entry_index, lang, label = self._postings[i]
+            if entry_index in seen:
+                continue
+            seen.add(entry_index)
+            results.append(dict(self.entries[entry_index], label=label, lang=lang))
+            if len(results) == limit:
+                break
+        return results
+
+
+def load_name_index(db_path):
+    """pokedex.db がなければ None (補完は使えないが、検索は動かす)"""
+    if not os.path.exists(db_path):
+        logger.warning(f'{db_path} がないため入力補完は無効です')
+        return None
+    index = NameIndex.from_db(db_path)
+    logger.info(f'入力補完の索引を作成しました: {len(index)} 件')
+    return index
@@ -0,0 +1,47 @@
+import unittest
+
+from benchmark import compare, summarize
+
+
+def stats(p50, p95, p99, throughput):
+    return {'count': 100, 'errors': 0, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'throughput': throughput}
+
+
+class TestSummarize(unittest.TestCase):
+    def test_percentiles_in_ms_and_throughput(self):
+        result = summarize([i / 1000 for i in range(1, 101)], elapsed=2.0)
+
+        self.assertEqual(result['count'], 100)
+        self.assertAlmostEqual(result['p50_ms'], 50.5)
+        self.assertAlmostEqual(result['p99_ms'], 99.01)
+        self.assertEqual(result['throughput'], 50.0)
+
+    def test_empty(self):
+        self.assertEqual(summarize([], errors=3), {'count': 0, 'errors': 3})
+
+
+class TestCompare(unittest.TestCase):
+    def test_flags_latency_and_throughput_regressions(self):
+        baseline = {'load.request': stats(100, 200, 300, 50)}
+        current = {'load.request': stats(105, 260, 300, 40)}
+
+        regressions = compare(baseline, current, threshold=0.1)
+
+        self.assertEqual([(name, metric) for name, metric, *_ in regressions],
+                         [('load.request', 'p95_ms'), ('load.request', 'throughput')])
+
+    def test_improvements_and_missing_entries_ignored(self):
+        baseline = {'micro.search': stats(20, 30, 40, 50), 'micro.old': stats(1, 1, 1, 1)}
+        current = {'micro.search': stats(10, 15, 20, 100), 'micro.new': stats(9, 9, 9, 9)}
+        self.assertEqual(compare(baseline, current), [])
+
+    def test_sub_millisecond_noise_ignored(self):
+        baseline = {'micro.parse': stats(0.02, 0.03, 0.05, 40000)}
+        current = {'micro.parse': stats(0.04, 0.09, 0.6, 20000)}
+
+        self.assertEqual(compare(baseline, current, threshold=0.1), [])
+        self.assertEqual(len(compare(baseline, current, threshold=0.1, min_delta_ms=0.01)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import unittest
+from unittest.mock import Mock
+
+from elastic_transport import JsonSerializer
+from elasticsearch import ConnectionError
+
+from bulk_indexer import BulkIndexer
+
+
+def make_es(responses):
+    es = Mock()
+    es.transport.serializers.get_serializer.return_value = JsonSerializer()
+    es.bulk.side_effect = responses
+    return es
+
+
+def item(doc_id, status=201, error=None):
+    info = {'_id': doc_id, 'status': status}
+    if error:
+        info['error'] = {'type': error, 'reason': f'{error} reason'}
+    return {'index': info}
+
+
+def actions(n):
+    return (({'index': {'_index': 'pk', '_id': str(i)}}, {'text': 'x' * 100}) for i in range(n))
+
+
+def sent_ids(call):
+    return [json.loads(line)['index']['_id'] for line in call.kwargs['operations'][0::2]]
+
+
+class TestBulkIndexer(unittest.TestCase):
+    def test_chunks_split_by_count_and_bytes(self):
+        indexer = BulkIndexer(make_es([]), chunk_size=3, max_chunk_bytes=10 ** 6)
+        self.assertEqual([len(c) for c in indexer.chunks(actions(7))], [3, 3, 1])
+
+        indexer = BulkIndexer(make_es([]), chunk_size=100, max_chunk_bytes=300)
+        self.assertEqual([len(c) for c in indexer.chunks(actions(5))], [2, 2, 1])
+
+    def test_retries_rejected_documents_and_reports_failures(self):
+        es = make_es([
+            {'errors': True, 'items': [item('0'), item('1', 429, 'es_rejected_execution_exception'),
+                                       item('2', 400, 'mapper_parsing_exception')]},
+            {'errors': False, 'items': [item('1')]},
+        ])
+        indexer = BulkIndexer(es, threads=1, initial_backoff=0)
+
+        result = indexer.run(actions(3))
+
+        self.assertEqual(sent_ids(es.bulk.call_args_list[1]), ['1'])
+        self.assertEqual(result.succeeded, 2)
+        self.assertEqual(result.failed, [{'_id': '2', 'op_type': 'index', 'status': 400,
+                                          'reason': 'mapper_parsing_exception: mapper_parsing_exception reason'}])
+
+    def test_connection_errors_retried_until_limit(self):
+        es = make_es(ConnectionError('down'))
+        indexer = BulkIndexer(es, threads=2, chunk_size=2, max_retries=2, initial_backoff=0)
+
+        result = indexer.run(actions(3))
+
+        self.assertEqual(es.bulk.call_count, 6)
+        self.assertEqual(sorted(f['_id'] for f in result.failed), ['0', '1', '2'])
+        self.assertEqual(result.succeeded, 0)
+
+    def test_delete_actions_have_no_body(self):
+        es = make_es([{'errors': False, 'items': [{'delete': {'_id': 'a', 'status': 200}}]}])
+
+        result = BulkIndexer(es).run([({'delete': {'_index': 'pk', '_id': 'a'}}, None)])
+
+        self.assertEqual(len(es.bulk.call_args.kwargs['operations']), 1)
+        self.assertEqual(result.succeeded, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+import numpy as np
+
+from cache import EmbeddingCache, SemanticAnswerCache, normalize_query, touch_index_stamp
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('  ＦＩＲＥ　 Pokemon '), 'fire pokemon')
+        self.assertEqual(normalize_query('ﾎﾉｵ'), normalize_query('ホノオ'))
+
+    def test_hit_skips_compute(self):
+        cache = EmbeddingCache(max_size=4, ttl=60)
+        compute = Mock(return_value=[0.1, 0.2, 0.3])
+
+        first = cache.get_or_compute('Fire', compute)
+        second = cache.get_or_compute(' fire ', compute)
+
+        compute.assert_called_once_with('fire')
+        self.assertEqual(first.dtype, np.float32)
+        self.assertIs(first, second)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_compute_many_batches_misses(self):
+        cache = EmbeddingCache(max_size=8, ttl=60)
+        cache.put('fire', [1.0, 0.0])
+        compute_batch = Mock(side_effect=lambda keys: [[float(len(k)), 1.0] for k in keys])
+
+        vectors = cache.get_or_compute_many(['Fire', 'water', 'WATER', 'grass'], compute_batch)
+
+        compute_batch.assert_called_once_with(['water', 'grass'])
+        self.assertEqual([v.tolist() for v in vectors], [[1.0, 0.0], [5.0, 1.0], [5.0, 1.0], [5.0, 1.0]])
+
+    def test_lru_eviction(self):
+        cache = EmbeddingCache(max_size=2, ttl=60)
+        cache.put('a', [1.0])
+        cache.put('b', [2.0])
+        cache.get('a')
+        cache.put('c', [3.0])
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl_expiry(self):
+        cache = EmbeddingCache(max_size=2, ttl=10)
+        with patch('cache.monotonic', return_value=100.0):
+            cache.put('a', [1.0])
+        with patch('cache.monotonic', return_value=111.0):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class TestSemanticAnswerCache(unittest.TestCase):
+    def setUp(self):
+        self.stamp_path = os.path.join(tempfile.mkdtemp(), '.index_version')
+        self.cache = SemanticAnswerCache(max_size=2, threshold=0.9, stamp_path=self.stamp_path)
+        self.results = [{'no': '25', 'form': ''}, {'no': '26', 'form': ''}]
+
+    def test_near_duplicate_hit(self):
+        self.cache.put([1.0, 0.0], self.results, {'answer': 'cached'})
+
+        hit = self.cache.lookup([0.99, 0.05], list(reversed(self.results)))
+
+        self.assertEqual(hit, {'answer': 'cached'})
+
+    def test_miss_on_distance_or_results(self):
+        self.cache.put([1.0, 0.0], self.results, {'answer': 'cached'})
+
+        self.assertIsNone(self.cache.lookup([0.0, 1.0], self.results))
+        self.assertIsNone(self.cache.lookup([1.0, 0.0], self.results[:1]))
+        self.assertIsNone(self.cache.lookup([1.0, 0.0], 'connection error'))
+
+    def test_size_bound(self):
+        self.cache.put([1.0, 0.0], self.results, {'answer': 'a'})
+        self.cache.put([0.0, 1.0], self.results, {'answer': 'b'})
+        self.cache.put([0.7, 0.7], self.results[:1], {'answer': 'c'})
+
+        self.assertIsNone(self.cache.lookup([1.0, 0.0], self.results))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidated_by_index_rebuild(self):
+        self.cache.put([1.0, 0.0], self.results, {'answer': 'cached'})
+
+        touch_index_stamp(self.stamp_path)
+
+        self.assertIsNone(self.cache.lookup([1.0, 0.0], self.results))
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
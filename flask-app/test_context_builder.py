@@ -0,0 +1,57 @@
+import unittest
+
+from context_builder import HEADER, ContextBuilder, estimate_tokens
+
+
+def doc(no, name, form='', description='説明', stats=True):
+    return {
+        'no': str(no), 'nameJa': name, 'nameEn': f'En{no}', 'form': form,
+        'types': ['ほのお', ''], 'abilities': ['もうか'],
+        'descriptions': {'scarlet': description, 'violet': description + 'V'},
+        'stats': {'hp': 1, 'attack': 2, 'defense': 3, 'specialAttack': 4, 'specialDefense': 5, 'speed': 6}
+        if stats else None,
+    }
+
+
+class TestEstimateTokens(unittest.TestCase):
+    def test_ascii_and_japanese(self):
+        self.assertEqual(estimate_tokens('abcdefgh'), 2)
+        self.assertEqual(estimate_tokens('ピカチュウ'), 5)
+        self.assertEqual(estimate_tokens('no|ピカ'), 3)
+
+
+class TestContextBuilder(unittest.TestCase):
+    def test_compact_row(self):
+        context, kept = ContextBuilder().build([doc(6, 'リザードン')])
+
+        self.assertEqual(context.split('\n'), [HEADER, '6|リザードン|ほのお|もうか|1/2/3/4/5/6|説明'])
+        self.assertEqual(kept, 1)
+
+    def test_drops_descriptions_repeated_across_forms(self):
+        context, _ = ContextBuilder().build([doc(6, 'リザードン'), doc(6, 'リザードン', form='メガシンカX')])
+
+        self.assertEqual(context.split('\n')[2], '6|リザードン(メガシンカX)|ほのお|もうか|1/2/3/4/5/6|')
+
+    def test_trims_lowest_ranked_entries_to_budget(self):
+        results = [doc(i, f'ポケモン{i}', description='長い説明' * 10) for i in range(10)]
+        builder = ContextBuilder(token_budget=200)
+
+        context, kept = builder.build(results)
+
+        self.assertLess(kept, 10)
+        self.assertLessEqual(estimate_tokens(context), 200)
+        self.assertEqual([line.split('|')[0] for line in context.split('\n')[1:]],
+                         [str(i) for i in range(kept)])
+
+    def test_first_entry_kept_even_over_budget(self):
+        _, kept = ContextBuilder(token_budget=1).build([doc(1, 'フシギダネ'), doc(2, 'フシギソウ')])
+        self.assertEqual(kept, 1)
+
+    def test_falls_back_to_english_name_and_legacy_fields(self):
+        context, _ = ContextBuilder().build([{'nameEn': 'Pikachu', 'no': '025', 'description': 'Mouse Pokemon'}])
+        self.assertIn('025|Pikachu|||', context)
+        self.assertIn('Mouse Pokemon', context)
+
+
+if __name__ == '__main__':
+    unittest.main()
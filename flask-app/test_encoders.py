@@ -0,0 +1,100 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from bench_prompt import QUERIES
+from encoders import OnnxEncoder, TorchEncoder, encoder_name, export_onnx, is_mean_pooling
+
+# torch の埋め込みとのコサイン類似度の下限
+FP32_MIN_COSINE = 0.9999
+INT8_MIN_COSINE = 0.98
+
+TEXTS = QUERIES + ['ピカチュウ' * 100, 'Pikachu']
+HAS_ONNX = all(importlib.util.find_spec(name) for name in ('onnxruntime', 'onnx'))
+
+
+def tiny_model(directory):
+    """ダウンロードせずに作れる、本番と同じ XLM-R + 平均プーリングの小さいモデル"""
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+    from tokenizers import Tokenizer, pre_tokenizers, processors
+    from tokenizers.models import WordLevel
+    from transformers import PreTrainedTokenizerFast, XLMRobertaConfig, XLMRobertaModel
+
+    chars = sorted(set(''.join(TEXTS)))
+    vocab = {token: i for i, token in enumerate(['<s>', '<pad>', '</s>', '<unk>'] + chars)}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split('', 'isolated')
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single='<s> $A </s>', special_tokens=[('<s>', 0), ('</s>', 2)])
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token='<s>', eos_token='</s>', pad_token='<pad>',
+                            unk_token='<unk>').save_pretrained(directory)
+    torch.manual_seed(0)
+    XLMRobertaModel(XLMRobertaConfig(vocab_size=len(vocab), hidden_size=64, num_hidden_layers=2,
+                                     num_attention_heads=4, intermediate_size=128, max_position_embeddings=40,
+                                     pad_token_id=1)).save_pretrained(directory)
+    transformer = models.Transformer(directory, max_seq_length=32)
+    model = SentenceTransformer(modules=[transformer, models.Pooling(64, 'mean')], device='cpu')
+    model.save(directory)
+    return directory
+
+
+def min_cosine(a, b):
+    return float(((a * b).sum(1) / np.linalg.norm(a, axis=1) / np.linalg.norm(b, axis=1)).min())
+
+
+@unittest.skipUnless(HAS_ONNX, 'onnxruntime / onnx がインストールされていない')
+class TestOnnxParity(unittest.TestCase):
+    """PARITY_MODEL に本番のモデル名を入れると、そのモデルでも同じ下限を確かめる"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        model_dir = os.getenv('PARITY_MODEL') or tiny_model(os.path.join(cls.tmp.name, 'model'))
+        cls.onnx_dir = export_onnx(model_dir, os.path.join(cls.tmp.name, 'onnx'))
+        cls.reference = TorchEncoder(model_dir).encode(TEXTS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_fp32_matches_torch(self):
+        vectors = OnnxEncoder(self.onnx_dir).encode(TEXTS, batch_size=4)
+        self.assertEqual(vectors.shape, self.reference.shape)
+        self.assertGreaterEqual(min_cosine(self.reference, vectors), FP32_MIN_COSINE)
+
+    def test_int8_drift_bounded(self):
+        vectors = OnnxEncoder(self.onnx_dir, quantized=True).encode(TEXTS)
+        self.assertGreaterEqual(min_cosine(self.reference, vectors), INT8_MIN_COSINE)
+
+    def test_single_text_and_empty_batch(self):
+        encoder = OnnxEncoder(self.onnx_dir, threads=1)
+        vector = encoder.encode(TEXTS[0])
+        self.assertEqual(vector.shape, self.reference[0].shape)
+        self.assertEqual(vector.dtype, np.float32)
+        self.assertEqual(encoder.encode([]).shape, (0, self.reference.shape[1]))
+
+    def test_after_fork_recreates_session(self):
+        encoder = OnnxEncoder(self.onnx_dir)
+        session = encoder.session
+        encoder.after_fork(threads=1)
+        self.assertIsNot(encoder.session, session)
+        np.testing.assert_allclose(encoder.encode(TEXTS[0]), self.reference[0], atol=1e-4)
+
+
+class TestHelpers(unittest.TestCase):
+    def test_encoder_name(self):
+        self.assertEqual(encoder_name('torch', 'models/mpnet/'), 'mpnet')
+        self.assertEqual(encoder_name('onnx-int8', 'mpnet'), 'mpnet-onnx-int8')
+
+    def test_mean_pooling_config_formats(self):
+        self.assertTrue(is_mean_pooling({'pooling_mode': 'mean'}))
+        self.assertTrue(is_mean_pooling({'pooling_mode_mean_tokens': True, 'pooling_mode_cls_token': False}))
+        self.assertFalse(is_mean_pooling({'pooling_mode_mean_tokens': True, 'pooling_mode_max_tokens': True}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from evaluation import EvaluationStore, RelevanceEvaluator
+
+TOKENS = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+
+
+class TestRelevanceEvaluator(unittest.TestCase):
+    def setUp(self):
+        self.store = EvaluationStore(os.path.join(tempfile.mkdtemp(), 'evaluations.db'))
+
+    def test_result_persisted(self):
+        done = threading.Event()
+
+        def evaluate(question, answer):
+            done.set()
+            return {"Relevance": "関連あり", "relevance_explanation": "ok"}, TOKENS
+
+        evaluator = RelevanceEvaluator(evaluate, self.store, workers=1)
+        self.assertEqual(evaluator.submit('req-1', 'q', 'a'), 'PENDING')
+        self.assertTrue(done.wait(5))
+        evaluator._queue.join()
+
+        result = evaluator.lookup('req-1')
+        self.assertEqual(result['status'], 'done')
+        self.assertEqual(result['relevance'], '関連あり')
+        self.assertEqual(result['eval_total_tokens'], 15)
+        self.assertIsNone(evaluator.lookup('unknown'))
+
+    def test_overflow_drops_instead_of_blocking(self):
+        evaluator = RelevanceEvaluator(None, self.store, workers=0, queue_size=1)
+
+        self.assertEqual(evaluator.submit('req-1', 'q', 'a'), 'PENDING')
+        self.assertEqual(evaluator.submit('req-2', 'q', 'a'), 'DROPPED')
+        self.assertEqual(evaluator.lookup('req-1')['status'], 'pending')
+        self.assertIsNone(evaluator.lookup('req-2'))
+        self.assertEqual(evaluator.stats()['dropped'], 1)
+
+    def test_pending_visible_from_other_process(self):
+        # 別のワーカープロセスに当たる、同じDBを開いた評価器からも評価待ちが見える
+        evaluator = RelevanceEvaluator(None, self.store, workers=0)
+        other = RelevanceEvaluator(None, EvaluationStore(self.store.db_path), workers=0)
+
+        evaluator.submit('req-1', 'q', 'a')
+
+        self.assertEqual(other.lookup('req-1'), {'request_id': 'req-1', 'status': 'pending'})
+
+    def test_failure_recorded(self):
+        def evaluate(question, answer):
+            raise RuntimeError('boom')
+
+        evaluator = RelevanceEvaluator(evaluate, self.store, workers=1)
+        evaluator.submit('req-1', 'q', 'a')
+        evaluator._queue.join()
+
+        self.assertEqual(evaluator.lookup('req-1')['status'], 'failed')
+        self.assertEqual(evaluator.stats()['failed'], 1)
+
+    def test_migrates_store_without_status(self):
+        db_path = os.path.join(tempfile.mkdtemp(), 'old.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute("""
+            CREATE TABLE evaluations (
+                request_id TEXT PRIMARY KEY, question TEXT, relevance TEXT, relevance_explanation TEXT,
+                eval_prompt_tokens INTEGER, eval_completion_tokens INTEGER, eval_total_tokens INTEGER,
+                created_at REAL, completed_at REAL
+            )
+        """)
+        conn.execute("INSERT INTO evaluations VALUES ('old', 'q', '関連あり', 'ok', 10, 5, 15, 0, 1)")
+        conn.commit()
+        conn.close()
+
+        evaluator = RelevanceEvaluator(None, EvaluationStore(db_path), workers=0)
+
+        self.assertEqual(evaluator.lookup('old')['status'], 'done')
+        evaluator.submit('new', 'q', 'a')
+        self.assertEqual(evaluator.lookup('new')['status'], 'pending')
+
+    def test_sampling(self):
+        evaluator = RelevanceEvaluator(None, self.store, workers=0, sample_rate=0.0)
+
+        self.assertEqual(evaluator.submit('req-1', 'q', 'a'), 'SKIPPED')
+        self.assertEqual(evaluator.stats()['skipped'], 1)
+
+    def test_workers_start_on_first_submit(self):
+        def workers():
+            return [t for t in threading.enumerate() if t.name.startswith('relevance-eval-')]
+
+        before = workers()
+        evaluator = RelevanceEvaluator(
+            lambda question, answer: ({"Relevance": "関連あり", "relevance_explanation": "ok"}, TOKENS),
+            self.store, workers=2)
+        # fork 前の親プロセスに当たる、作っただけの評価器はスレッドを持たない
+        self.assertEqual(workers(), before)
+
+        evaluator.submit('req-1', 'q', 'a')
+        self.assertEqual(len(workers()), len(before) + 2)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'fork が使えない')
+    def test_after_fork_restarts_workers(self):
+        # gunicorn の preload と同じく、親で作った評価器を fork した子プロセスで使う
+        evaluator = RelevanceEvaluator(
+            lambda question, answer: ({"Relevance": "関連あり", "relevance_explanation": "ok"}, TOKENS),
+            self.store, workers=0)
+        evaluator.submit('parent', 'q', 'a')
+
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                evaluator.after_fork(workers=1)
+                evaluator.submit('child', 'q', 'a')
+                evaluator._queue.join()
+                ok = evaluator.lookup('child')['status'] == 'done' and evaluator.stats()['submitted'] == 1
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(self.store.get('child')['relevance'], '関連あり')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,372 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pandas as pd
+from elastic_transport import ApiResponseMeta, HttpHeaders
+from elasticsearch import NotFoundError
+
+from bulk_indexer import BulkResult
+from embedding_store import EmbeddingStore
+from injest import PokemonIngest, iter_pipeline
+
+DIM = 4
+
+
+def fake_encode(texts, **kwargs):
+    return np.array([[len(t), 1.0, 0.0, 0.0] for t in texts], dtype=np.float32)
+
+
+def collect_into(indexed, failed=()):
+    """bulk_index_documents の代わり。ドキュメントを indexed にためて、_id が failed のものは失敗にする"""
+    def bulk_index_documents(docs, index_name):
+        result = BulkResult()
+        for doc in docs:
+            indexed.append(doc)
+            if doc.get('_id') in failed:
+                result.failed.append({'_id': doc['_id'], 'op_type': 'index', 'status': 400, 'reason': 'mapper_parsing_exception'})
+            else:
+                result.succeeded += 1
+        return result
+    return bulk_index_documents
+
+
+def make_df(descriptions):
+    return pd.DataFrame({
+        'name_japanese': ['ピカチュウ', 'ライチュウ', 'メガライチュウ'][:len(descriptions)],
+        'name_english': ['Pikachu', 'Raichu', 'MegaRaichu'][:len(descriptions)],
+        'name_chinese': ['皮卡丘', '雷丘', ''][:len(descriptions)],
+        'global_no': ['25', '26', '26'][:len(descriptions)],
+        'form': ['', '', ''][:len(descriptions)],
+        'stats_hp': [35, 60, 60][:len(descriptions)],
+        'description_scarlet': descriptions,
+    })
+
+
+class TestEmbeddingStore(unittest.TestCase):
+    def test_roundtrip_and_reopen(self):
+        directory = tempfile.mkdtemp()
+        store = EmbeddingStore(directory, dim=DIM)
+        store.add(['a', 'b', 'a'], np.eye(3, DIM, dtype=np.float32))
+
+        reopened = EmbeddingStore(directory, dim=DIM)
+        vectors = reopened.get_many(['b', 'a', 'missing'])
+
+        self.assertEqual(len(reopened), 2)
+        self.assertEqual(set(vectors), {'a', 'b'})
+        self.assertEqual(vectors['b'].tolist(), [0.0, 1.0, 0.0, 0.0])
+
+
+    def test_torn_row_truncated_before_append(self):
+        directory = tempfile.mkdtemp()
+        store = EmbeddingStore(directory, dim=DIM)
+        store.add(['a'], np.eye(1, DIM, dtype=np.float32))
+        # 2行目を書いている途中で止まった
+        with open(store.vectors_path, 'ab') as f:
+            f.write(b'\x00' * 6)
+
+        reopened = EmbeddingStore(directory, dim=DIM)
+        reopened.add(['b'], np.full((1, DIM), 2.0, dtype=np.float32))
+
+        self.assertEqual(os.path.getsize(store.vectors_path), 2 * 4 * DIM)
+        vectors = EmbeddingStore(directory, dim=DIM).get_many(['a', 'b'])
+        self.assertEqual(vectors['a'].tolist(), [1.0, 0.0, 0.0, 0.0])
+        self.assertEqual(vectors['b'].tolist(), [2.0] * DIM)
+
+
+class TestIncrementalIngest(unittest.TestCase):
+    def setUp(self):
+        with patch('injest.Elasticsearch'):
+            self.ingest = PokemonIngest(embedding_cache_dir=tempfile.mkdtemp(), embedding_dim=DIM)
+        self.ingest.model = Mock()
+        self.ingest.model.encode.side_effect = fake_encode
+        self.ingest.es.indices.exists.return_value = True
+        self.indexed = []
+        self.ingest.bulk_index_documents = Mock(side_effect=collect_into(self.indexed))
+        self.ingest.bulk_delete_documents = Mock()
+
+    def indexed_state(self, df):
+        docs = self.ingest.prepare_documents(df)
+        return dict(zip(docs['_id'], docs['content_hash']))
+
+    def test_noop_rerun_skips_encoder(self):
+        df = make_df(['でんき', 'でんき2', 'メガ'])
+        self.ingest.fetch_index_hashes = Mock(return_value=self.indexed_state(df))
+
+        self.assertFalse(self.ingest.sync_index(df, 'pk'))
+        self.ingest.model.encode.assert_not_called()
+        self.ingest.bulk_index_documents.assert_not_called()
+
+    def test_only_changed_rows_reindexed_and_removed_rows_deleted(self):
+        old = make_df(['でんき', 'でんき2', 'メガ'])
+        self.ingest.fetch_index_hashes = Mock(return_value=self.indexed_state(old))
+
+        self.assertTrue(self.ingest.sync_index(make_df(['でんき', '変更された説明']), 'pk'))
+
+        self.assertEqual([doc['_id'] for doc in self.indexed], ['26--Raichu'])
+        self.assertEqual(self.ingest.model.encode.call_args[0][0], [self.indexed[0]['combined_text']])
+        self.ingest.bulk_delete_documents.assert_called_once_with(['26--MegaRaichu'], index_name='pk')
+
+    def test_disk_cache_reused_for_full_rebuild(self):
+        df = make_df(['でんき', 'でんき2'])
+        self.ingest.embed_with_cache(self.ingest.prepare_documents(df))
+        self.ingest.model.encode.reset_mock()
+
+        self.ingest.sync_index(df, 'pk', full=True)
+
+        self.ingest.model.encode.assert_not_called()
+        self.ingest.es.indices.create.assert_called_once()
+        self.assertEqual(len(self.indexed), 2)
+        self.assertEqual(self.indexed[0]['combined_text_vector'], fake_encode([self.indexed[0]['combined_text']])[0].tolist())
+
+    def test_encode_session_reuses_one_process_pool(self):
+        self.ingest.encode_processes = 4
+        self.ingest.model.encode_multi_process.side_effect = lambda texts, processes, **kwargs: fake_encode(texts)
+        chunks = [make_df(['でんき']), make_df(['でんき', 'でんき2', 'メガ'])]
+
+        with self.ingest.encode_session():
+            self.ingest.sync_index(chunks, 'pk', full=True)
+
+        self.ingest.model.start_pool.assert_called_once_with(4)
+        pool = self.ingest.model.start_pool.return_value
+        self.assertEqual([c.kwargs['pool'] for c in self.ingest.model.encode_multi_process.call_args_list], [pool, pool])
+        self.ingest.model.stop_pool.assert_called_once_with(pool)
+        self.assertEqual(len(self.indexed), 3)
+
+    def test_failed_rebuild_keeps_alias(self):
+        self.ingest.bulk_index_documents = Mock(side_effect=collect_into(self.indexed, failed={'26--Raichu'}))
+        self.ingest.swap_alias = Mock()
+        self.ingest.prune_versions = Mock()
+
+        with self.assertRaises(RuntimeError):
+            self.ingest.sync_index(make_df(['でんき', 'でんき2']), 'pk', full=True)
+
+        self.ingest.swap_alias.assert_not_called()
+        self.ingest.prune_versions.assert_not_called()
+        created = self.ingest.es.indices.create.call_args[1]['index']
+        self.ingest.es.indices.delete.assert_called_once_with(index=created)
+
+    def test_failed_documents_fail_incremental_sync(self):
+        self.ingest.fetch_index_hashes = Mock(return_value={})
+        self.ingest.bulk_index_documents = Mock(side_effect=collect_into(self.indexed, failed={'26--Raichu'}))
+
+        with self.assertRaises(RuntimeError):
+            self.ingest.sync_index(make_df(['でんき', 'でんき2']), 'pk')
+        self.assertEqual(len(self.indexed), 2)
+
+
+class TestVectorStorage(unittest.TestCase):
+    def setUp(self):
+        with patch('injest.Elasticsearch'):
+            self.ingest = PokemonIngest(embedding_cache_dir=tempfile.mkdtemp(), embedding_dim=DIM,
+                                        vector_index_type='int8_hnsw', vector_dims=2,
+                                        projection_dir=tempfile.mkdtemp())
+        self.ingest.model = Mock()
+        self.ingest.model.encode.side_effect = lambda texts, **kwargs: np.random.default_rng(len(texts)).standard_normal(
+            (len(texts), DIM)).astype(np.float32)
+        self.ingest.es.info.return_value = {'version': {'number': '8.15.0'}}
+        self.ingest.es.indices.exists_alias.return_value = False
+        self.indexed = []
+        self.ingest.bulk_index_documents = Mock(side_effect=collect_into(self.indexed))
+
+    def test_reduced_quantized_index(self):
+        df = make_df(['でんき', 'でんき2', 'メガ'])
+        self.ingest.prepare_projection(df, 'pk')
+        self.ingest.sync_index(df, 'pk')
+
+        mapping = self.ingest.es.indices.create.call_args[1]['body']['mappings']
+        vector = mapping['properties']['combined_text_vector']
+        self.assertEqual(vector['dims'], 2)
+        self.assertEqual(vector['index_options'], {'type': 'int8_hnsw'})
+        self.assertEqual(mapping['_meta']['projection'], self.ingest.projection.fingerprint)
+        self.assertEqual([len(doc['combined_text_vector']) for doc in self.indexed], [2, 2, 2])
+
+    def test_settings_change_triggers_rebuild(self):
+        df = make_df(['でんき'])
+        self.ingest.es.indices.exists_alias.return_value = True
+        self.ingest.es.indices.get_mapping.return_value = {'pk_v1': {'mappings': {}}}
+        self.ingest.fetch_index_hashes = Mock(return_value={})
+
+        self.ingest.vector_dims = 0
+        self.ingest.prepare_projection(df, 'pk')
+        self.assertTrue(self.ingest.sync_index(df, 'pk'))
+
+        self.ingest.es.indices.create.assert_called_once()
+        self.ingest.fetch_index_hashes.assert_not_called()
+
+    def test_old_cluster_falls_back_to_hnsw(self):
+        # docker-compose の ES 8.4 は量子化した型を作れない
+        self.ingest.es.info.return_value = {'version': {'number': '8.4.3'}}
+        df = make_df(['でんき', 'でんき2', 'メガ'])
+        self.ingest.prepare_projection(df, 'pk')
+
+        with self.assertLogs('injest', level='WARNING'):
+            self.ingest.sync_index(df, 'pk')
+
+        mapping = self.ingest.es.indices.create.call_args[1]['body']['mappings']
+        self.assertNotIn('index_options', mapping['properties']['combined_text_vector'])
+        self.assertEqual(mapping['_meta']['vector_index_type'], 'hnsw')
+        self.ingest.es.info.assert_called_once()
+
+    def test_unknown_vector_index_type(self):
+        with patch('injest.Elasticsearch'), self.assertRaises(ValueError):
+            PokemonIngest(embedding_cache_dir=tempfile.mkdtemp(), vector_index_type='pq')
+
+
+REGION_COLUMNS = ('no INTEGER, globalNo INTEGER, form TEXT, type1 TEXT, type2 TEXT, hp INTEGER, attack INTEGER, '
+                  'defense INTEGER, special_attack INTEGER, special_defense INTEGER, speed INTEGER, '
+                  'ability1 TEXT, ability2 TEXT, dream_ability TEXT')
+
+
+def make_db():
+    path = os.path.join(tempfile.mkdtemp(), 'pokedex.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE pokedex (id INTEGER, form TEXT, region TEXT, jpn TEXT, eng TEXT, chs TEXT)')
+        conn.executemany('INSERT INTO pokedex VALUES (?, ?, ?, ?, ?, ?)', [
+            (25, '', '', 'ピカチュウ', 'Pikachu', '皮卡丘'), (26, '', '', 'ライチュウ', 'Raichu', '雷丘')])
+        conn.execute(f'CREATE TABLE kanto ({REGION_COLUMNS}, red TEXT, green TEXT, blue TEXT, pikachu TEXT)')
+        conn.execute(f'CREATE TABLE paldea ({REGION_COLUMNS}, scarlet TEXT, violet TEXT)')
+        stats = ('でんき', None, 35, 55, 40, 50, 50, 90, 'せいでんき', None, 'ひらいしん')
+        conn.executemany('INSERT INTO kanto VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            (25, 25, '') + stats + ('あか', 'あか', 'あお', None),
+            (26, 26, '') + stats + ('ライ', 'ライ', 'ライ', 'ライ'),
+        ])
+        conn.execute('INSERT INTO paldea VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (74, 25, '') + stats + ('スカーレット', 'バイオレット'))
+    return path
+
+
+class TestMultiTableIngest(unittest.TestCase):
+    def setUp(self):
+        with patch('injest.Elasticsearch'):
+            self.ingest = PokemonIngest(embedding_cache_dir=tempfile.mkdtemp(), embedding_dim=DIM)
+        self.ingest.model = Mock()
+        self.ingest.model.encode.side_effect = fake_encode
+        self.db_path = make_db()
+
+    def test_chunks_normalize_game_descriptions(self):
+        chunks = list(self.ingest.iter_data(self.db_path, tables=['kanto', 'paldea'], chunksize=1))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual([c for c in chunks[0].columns if c.startswith('description_')],
+                         ['description_red', 'description_green', 'description_blue', 'description_pikachu'])
+        self.assertEqual(chunks[2]['region'].tolist(), ['paldea'])
+        self.assertEqual(chunks[2]['description_scarlet'].tolist(), ['スカーレット'])
+
+    def test_combined_text_skips_missing_and_repeated_descriptions(self):
+        df = self.ingest.prepare_data(self.db_path, tables=['kanto', 'paldea'])
+        texts = self.ingest.combine_texts(df).tolist()
+
+        self.assertTrue(texts[0].endswith('あか あお'))
+        self.assertTrue(texts[1].endswith('ライ'))
+        self.assertNotIn('ライ ライ', texts[1])
+        self.assertNotIn('None', texts[2])
+        self.assertNotIn('kanto', texts[0])
+
+    def test_streaming_rebuild_indexes_every_region(self):
+        self.ingest.es.indices.exists_alias.return_value = False
+        self.ingest.es.indices.exists.return_value = False
+        indexed = []
+        self.ingest.bulk_index_documents = Mock(side_effect=collect_into(indexed))
+
+        chunks = self.ingest.iter_data(self.db_path, tables=['kanto', 'paldea'], chunksize=1)
+        self.ingest.sync_index(chunks, 'pk')
+
+        self.assertEqual([doc['_id'] for doc in indexed], ['kanto-25--Pikachu', 'kanto-26--Raichu', 'paldea-25--Pikachu'])
+        self.assertNotIn('description_scarlet', indexed[0])
+        self.assertEqual(indexed[2]['description_violet'], 'バイオレット')
+        # チャンクごとではなく、全チャンクで1回の一括登録
+        self.ingest.bulk_index_documents.assert_called_once()
+
+    def test_unknown_table(self):
+        with self.assertRaises(ValueError):
+            list(self.ingest.iter_data(self.db_path, tables=['pokedex']))
+
+
+class TestIterPipeline(unittest.TestCase):
+    def test_stages_run_in_order(self):
+        self.assertEqual(list(iter_pipeline(range(10), lambda x: x * 2)), [x * 2 for x in range(10)])
+
+    def test_consumer_error_stops_reader(self):
+        read = []
+
+        def source():
+            for i in range(1000):
+                read.append(i)
+                yield i
+
+        items = iter_pipeline(source(), lambda x: x, depth=2)
+        with self.assertRaises(RuntimeError):
+            try:
+                for _ in items:
+                    raise RuntimeError('bulk failed')
+            finally:
+                items.close()
+        self.assertLess(len(read), 1000)
+        self.assertEqual([t for t in threading.enumerate() if t.name.startswith('ingest-')], [])
+
+    def test_stage_error_is_raised(self):
+        def stage(x):
+            if x == 3:
+                raise ValueError('encode failed')
+            return x
+
+        with self.assertRaises(ValueError):
+            list(iter_pipeline(range(10), stage))
+
+
+class TestVersionedIndex(unittest.TestCase):
+    def setUp(self):
+        with patch('injest.Elasticsearch'):
+            self.ingest = PokemonIngest(embedding_cache_dir=tempfile.mkdtemp(), embedding_dim=DIM, retention=2)
+        self.es = self.ingest.es
+
+    def test_swap_replaces_legacy_concrete_index(self):
+        self.es.indices.exists.return_value = True
+        self.es.indices.exists_alias.return_value = False
+
+        self.ingest.swap_alias('pk', 'pk_v20240101000000')
+
+        self.es.indices.update_aliases.assert_called_once_with(actions=[
+            {"remove_index": {"index": "pk"}},
+            {"add": {"index": "pk_v20240101000000", "alias": "pk"}},
+        ])
+        self.es.indices.delete.assert_not_called()
+
+    def test_rollback(self):
+        self.es.indices.get.return_value = {'pk_v1': {}, 'pk_v2': {}}
+        self.es.indices.exists.return_value = True
+        self.es.indices.get_alias.return_value = {'pk_v2': {}}
+        self.assertEqual(self.ingest.rollback('pk'), 'pk_v1')
+
+        self.es.indices.get_alias.return_value = {'pk_v1': {}}
+        with self.assertRaises(RuntimeError):
+            self.ingest.rollback('pk')
+
+        self.es.indices.get_alias.side_effect = NotFoundError(
+            'alias [pk] missing', ApiResponseMeta(404, '1.1', HttpHeaders(), 0.0, None), {})
+        with self.assertRaisesRegex(RuntimeError, 'エイリアス pk がない'):
+            self.ingest.rollback('pk')
+
+    def test_forcemerge_waits_longer_than_default_timeout(self):
+        self.ingest.finalize_index('pk_v1')
+
+        self.es.options.assert_called_once_with(request_timeout=3600)
+        self.es.options.return_value.indices.forcemerge.assert_called_once_with(index='pk_v1', max_num_segments=1)
+
+    def test_prune_keeps_newest_versions_and_live_index(self):
+        versions = ['pk_v1', 'pk_v2', 'pk_v3', 'pk_v4']
+        self.es.indices.get.return_value = {v: {} for v in reversed(versions)}
+        self.es.indices.get_alias.return_value = {'pk_v1': {}}
+
+        self.ingest.prune_versions('pk')
+
+        self.assertEqual([c.kwargs['index'] for c in self.es.indices.delete.call_args_list], ['pk_v2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+from llm_json import AnswerParser, parse_answer
+
+ANSWER = """{
+    "pokemon_entries": [
+        {"no": 25, "name": "ピカチュウ", "relevance_analysis": "でんき {タイプ}", "power_rating": "B"},
+        {"no": 26, "name": "ライチュウ", "relevance_analysis": "\\"進化\\"後", "power_rating": "A"}
+    ],
+    "summary": {"most_relevant_pokemon": {"no": "25", "name": "ピカチュウ", "explanation": "x"}}
+}"""
+
+
+class TestAnswerParser(unittest.TestCase):
+    def feed_in_chunks(self, text, size):
+        parser = AnswerParser()
+        entries = []
+        for i in range(0, len(text), size):
+            entries.extend(parser.feed(text[i:i + size]))
+        entries.extend(parser.close())
+        return parser, entries
+
+    def test_entries_emitted_per_object(self):
+        parser = AnswerParser()
+        first_object_end = ANSWER.index('},') + 1
+
+        self.assertEqual(len(parser.feed(ANSWER[:first_object_end - 1])), 0)
+        self.assertEqual([e['no'] for e in parser.feed(ANSWER[first_object_end - 1:first_object_end])], [25])
+        self.assertEqual([e['no'] for e in parser.feed(ANSWER[first_object_end:])], [26])
+
+    def test_any_chunk_size(self):
+        for size in (1, 3, 7, 64, len(ANSWER)):
+            parser, entries = self.feed_in_chunks(ANSWER, size)
+            self.assertEqual([e['name'] for e in entries], ['ピカチュウ', 'ライチュウ'])
+            self.assertEqual(entries[1]['relevance_analysis'], '"進化"後')
+            self.assertEqual(parser.answer(), parse_answer(ANSWER).answer())
+
+    def test_summary_not_emitted(self):
+        parser, entries = self.feed_in_chunks(ANSWER.replace('"pokemon_entries": [', '"pokemon_entries": [\n'), 5)
+        self.assertEqual(len(entries), 2)
+        answer = parser.answer()
+        self.assertTrue(answer['complete'])
+        self.assertEqual(answer['summary']['most_relevant_pokemon'], {'no': 25, 'name': 'ピカチュウ', 'explanation': 'x'})
+
+    def test_common_defects_repaired(self):
+        text = ('```json\n{"pokemon_entries": [\n'
+                '  {"no": "025", "name": "ピカ\\_チュウ", "relevance_score": "80", "power_rating": S,},\n'
+                '  {"no": 26, "name": "ライチュウ", "relevance_analysis": "\\u3067\\u3093\\u304d"}\n'
+                '  {"name": "番号なし"},\n'
+                '],}\n```')
+
+        parser = parse_answer(text)
+        answer = parser.answer()
+
+        self.assertTrue(answer['complete'])
+        self.assertEqual([(e['no'], e['name']) for e in answer['pokemon_entries']],
+                         [(25, 'ピカ_チュウ'), (26, 'ライチュウ')])
+        self.assertEqual(answer['pokemon_entries'][0]['relevance_score'], 80)
+        self.assertEqual(answer['pokemon_entries'][0]['power_rating'], 'S')
+        self.assertEqual(answer['pokemon_entries'][1]['relevance_analysis'], 'でんき')
+        self.assertEqual(parser.dropped, 1)
+        for kind in ('preamble', 'backslash', 'unquoted', 'trailing_comma'):
+            self.assertIn(kind, parser.repairs)
+
+    def test_truncated_output_returns_partial_result(self):
+        cut = ANSWER.index('"power_rating": "A"')
+
+        parser, entries = self.feed_in_chunks(ANSWER[:cut], 4)
+        answer = parser.answer()
+
+        self.assertFalse(answer['complete'])
+        self.assertEqual([e['no'] for e in answer['pokemon_entries']], [25, 26])
+        self.assertIsNone(answer['pokemon_entries'][1]['power_rating'])
+        self.assertIsNone(answer['summary'])
+        self.assertEqual(parser.repairs, {'truncated': 1})
+
+    def test_not_json(self):
+        answer = parse_answer('申し訳ありませんが、お答えできません。').answer()
+        self.assertEqual(answer, {'pokemon_entries': [], 'summary': None, 'complete': False})
+
+
+if __name__ == '__main__':
+    unittest.main()
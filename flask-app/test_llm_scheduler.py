@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_scheduler import LlmOverloaded, LlmScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLlmScheduler(unittest.TestCase):
+    def test_concurrency_capped(self):
+        scheduler = LlmScheduler(max_concurrency=2, queue_size=10, queue_timeout=5)
+        release = threading.Event()
+        active = []
+        peak = []
+
+        def call():
+            with scheduler.slot():
+                active.append(1)
+                peak.append(len(active))
+                release.wait(0.05)
+                active.pop()
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            list(pool.map(lambda _: call(), range(6)))
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(scheduler.stats()['admitted'], 6)
+        self.assertEqual(scheduler.stats()['active'], 0)
+
+    def test_full_queue_rejected_with_429(self):
+        scheduler = LlmScheduler(max_concurrency=1, queue_size=0)
+
+        with scheduler.slot():
+            with self.assertRaises(LlmOverloaded) as cm:
+                with scheduler.slot():
+                    pass
+
+        self.assertEqual(cm.exception.status, 429)
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+        self.assertEqual(scheduler.stats()['rejected'], 1)
+
+    def test_free_slot_admitted_without_queue(self):
+        # 待ち行列がなくても、空いている枠にはそのまま入れる
+        scheduler = LlmScheduler(max_concurrency=2, queue_size=0)
+
+        with scheduler.slot(), scheduler.slot():
+            self.assertEqual(scheduler.stats()['active'], 2)
+
+        self.assertEqual((scheduler.stats()['admitted'], scheduler.stats()['rejected']), (2, 0))
+
+    def test_deadline_exceeded_with_503(self):
+        scheduler = LlmScheduler(max_concurrency=1, queue_size=4, queue_timeout=0.05)
+        with scheduler.slot():
+            with self.assertRaises(LlmOverloaded) as cm:
+                with scheduler.slot():
+                    pass
+
+        self.assertEqual(cm.exception.status, 503)
+        stats = scheduler.stats()
+        self.assertEqual((stats['timed_out'], stats['waiting'], stats['active']), (1, 0, 0))
+
+    def test_tokens_per_minute(self):
+        clock = FakeClock()
+        scheduler = LlmScheduler(tokens_per_minute=600, queue_timeout=30, clock=clock)
+
+        with scheduler.slot(500) as ticket:
+            ticket.used = 400
+        # 見積もりとの差 (100) は戻る: 残り 200
+        self.assertEqual(scheduler.stats()['tokens_available'], 200)
+
+        # 300 トークン貯まるには 10 秒かかるが、待てるのは 5 秒なのですぐ断る
+        scheduler.queue_timeout = 5
+        with self.assertRaises(LlmOverloaded) as cm:
+            with scheduler.slot(300):
+                pass
+        self.assertEqual(cm.exception.retry_after, 10)
+
+        clock.now = 10
+        with scheduler.slot(300):
+            pass
+        self.assertEqual(scheduler.stats()['tokens_available'], 0)
+
+    def test_pause_after_upstream_rate_limit(self):
+        clock = FakeClock()
+        scheduler = LlmScheduler(queue_timeout=1, clock=clock)
+        scheduler.pause(30)
+
+        with self.assertRaises(LlmOverloaded) as cm:
+            with scheduler.slot():
+                pass
+        self.assertEqual(cm.exception.retry_after, 30)
+
+        clock.now = 30
+        with scheduler.slot():
+            pass
+
+    def test_async_cancelled_waiter_leaves_queue(self):
+        scheduler = LlmScheduler(max_concurrency=1, queue_size=4, queue_timeout=5)
+
+        async def hold(started, release):
+            async with scheduler.async_slot():
+                started.set()
+                await release.wait()
+
+        async def wait_for_slot():
+            async with scheduler.async_slot():
+                pass
+
+        async def run():
+            started, release = asyncio.Event(), asyncio.Event()
+            holder = asyncio.ensure_future(hold(started, release))
+            await started.wait()
+            waiter = asyncio.ensure_future(wait_for_slot())
+            await asyncio.sleep(0.02)
+            self.assertEqual(scheduler.stats()['waiting'], 1)
+            waiter.cancel()
+            await asyncio.sleep(0.02)
+            self.assertEqual(scheduler.stats()['waiting'], 0)
+            release.set()
+            await holder
+            # 先頭に残っていないので次の呼び出しが通る
+            await asyncio.wait_for(wait_for_slot(), 1)
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
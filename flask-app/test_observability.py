@@ -0,0 +1,83 @@
+import json
+import logging
+import unittest
+from unittest.mock import Mock
+
+from prometheus_client import REGISTRY, CollectorRegistry
+
+import observability
+from observability import EngineCollector, JsonFormatter, current_timer, request_timer, span
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestSpans(unittest.TestCase):
+    def test_spans_recorded_into_current_request(self):
+        before = sample('rag_stage_seconds_count', stage='test_encode')
+
+        with request_timer() as timer:
+            with span('test_encode'):
+                pass
+            with span('test_encode'):
+                pass
+            debug = timer.as_dict()
+
+        self.assertEqual(set(debug['timings_ms']), {'test_encode', 'total'})
+        self.assertEqual(sample('rag_stage_seconds_count', stage='test_encode'), before + 2)
+        self.assertIsNone(current_timer())
+
+    def test_span_outside_request_only_observes_histogram(self):
+        before = sample('rag_stage_seconds_count', stage='test_background')
+        with span('test_background'):
+            pass
+        self.assertEqual(sample('rag_stage_seconds_count', stage='test_background'), before + 1)
+
+    def test_errors_counted_and_reraised(self):
+        before = sample('rag_stage_errors_total', stage='test_failing')
+        with self.assertRaises(ValueError):
+            with span('test_failing'):
+                raise ValueError('boom')
+        self.assertEqual(sample('rag_stage_errors_total', stage='test_failing'), before + 1)
+
+    def test_token_counter(self):
+        before = sample('rag_llm_tokens_total', call='test', kind='prompt')
+        observability.count_tokens('test', {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15})
+        self.assertEqual(sample('rag_llm_tokens_total', call='test', kind='prompt'), before + 10)
+
+
+class TestEngineCollector(unittest.TestCase):
+    def test_exports_cache_and_evaluator_stats(self):
+        engine = Mock()
+        engine.embedding_cache.stats.return_value = {'hits': 3, 'misses': 1, 'evictions': 0, 'size': 1}
+        engine.answer_cache.stats.return_value = {'hits': 0, 'misses': 2, 'evictions': 1, 'size': 2}
+        engine.evaluator.stats.return_value = {'queued': 4, 'submitted': 5, 'skipped': 0, 'dropped': 1,
+                                               'completed': 3, 'failed': 0}
+        engine.llm_scheduler.stats.return_value = {'active': 2, 'waiting': 5}
+        registry = CollectorRegistry()
+        registry.register(EngineCollector(engine))
+
+        self.assertEqual(registry.get_sample_value('rag_cache_hits_total', {'cache': 'embedding'}), 3)
+        self.assertEqual(registry.get_sample_value('rag_cache_misses_total', {'cache': 'answer'}), 2)
+        self.assertEqual(registry.get_sample_value('rag_evaluations_total', {'status': 'dropped'}), 1)
+        self.assertEqual(registry.get_sample_value('rag_evaluation_queue'), 4)
+        self.assertEqual(registry.get_sample_value('rag_llm_waiting'), 5)
+
+
+class TestJsonFormatter(unittest.TestCase):
+    def test_extra_fields_included(self):
+        record = logging.LogRecord('rag', logging.INFO, __file__, 1, 'rag finished', (), None)
+        record.request_id = 'abc'
+        record.prompt_tokens = 12
+
+        data = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual(data['message'], 'rag finished')
+        self.assertEqual(data['request_id'], 'abc')
+        self.assertEqual(data['prompt_tokens'], 12)
+        self.assertNotIn('args', data)
+
+
+if __name__ == '__main__':
+    unittest.main()
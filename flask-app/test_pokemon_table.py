@@ -0,0 +1,67 @@
+import os
+import unittest
+
+from pokemon_table import PokemonTable
+from query_analyzer import StructuredQuery
+
+STATS = ('hp', 'attack', 'defense', 'special_attack', 'special_defense', 'speed')
+
+
+def source(no, name, types, stats, form='', abilities=('もうか',)):
+    return {
+        'name_japanese': name, 'name_english': name, 'name_chinese': name, 'global_no': str(no), 'form': form,
+        'region': 'paldea', 'types': list(types), 'abilities': list(abilities),
+        **{f'stats_{stat}': value for stat, value in zip(STATS, stats)},
+    }
+
+
+SOURCES = [
+    source(6, 'リザードン', ['ほのお', 'ひこう'], (78, 84, 78, 109, 85, 100)),
+    source(6, 'メガリザードンY', ['ほのお', 'ひこう'], (78, 104, 78, 159, 115, 100), form='メガリザードンY'),
+    source(38, 'キュウコン', ['ほのお'], (73, 76, 75, 81, 100, 100)),
+    source(38, 'キュウコン', ['こおり', 'フェアリー'], (73, 67, 75, 81, 100, 109), form='アローラのすがた'),
+    source(101, 'マルマイン', ['でんき'], (60, 50, 70, 80, 80, 150), abilities=('ぼうおん',)),
+    source(135, 'サンダース', ['でんき'], (65, 65, 60, 110, 95, 130)),
+    source(500, 'エンブオー', ['ほのお', 'かくとう'], (110, 123, 65, 100, 65, 65)),
+]
+
+
+class TestPokemonTable(unittest.TestCase):
+    def setUp(self):
+        self.table = PokemonTable(SOURCES)
+
+    def names(self, structured, limit=10):
+        sources, matched = self.table.query(structured, limit)
+        return [(s['name_japanese'], s['form']) for s in sources], matched
+
+    def test_filter_by_type_and_stat(self):
+        self.assertEqual(self.names(StructuredQuery(types=['ほのお'], filters=[('speed', 'ge', 100)])),
+                         ([('リザードン', ''), ('キュウコン', '')], 2))
+        self.assertEqual(self.names(StructuredQuery(types=['ほのお', 'かくとう'])), ([('エンブオー', '')], 1))
+        self.assertEqual(self.names(StructuredQuery(abilities=['ぼうおん'])), ([('マルマイン', '')], 1))
+        self.assertEqual(self.names(StructuredQuery(types=['みず'], filters=[('hp', 'gt', 0)])), ([], 0))
+
+    def test_sort_collapses_forms(self):
+        # メガリザードンY とリザードンは同じ図鑑番号なので、上に来た方の1件だけ
+        names, matched = self.names(StructuredQuery(types=['ほのお'], sort=('special_attack', 'desc')), limit=2)
+        self.assertEqual(names, [('メガリザードンY', 'メガリザードンY'), ('エンブオー', '')])
+        self.assertEqual(matched, 3)
+
+        names, _ = self.names(StructuredQuery(sort=('speed', 'desc')), limit=3)
+        self.assertEqual(names, [('マルマイン', ''), ('サンダース', ''), ('キュウコン', 'アローラのすがた')])
+
+    def test_total(self):
+        # 合計: サンダース 525 / エンブオー 528 / リザードン 534 (メガリザードンY 634)
+        names, _ = self.names(StructuredQuery(filters=[('total', 'ge', 520)], sort=('total', 'asc')))
+        self.assertEqual(names, [('サンダース', ''), ('エンブオー', ''), ('リザードン', '')])
+
+    @unittest.skipUnless(os.path.exists('pokedex.db'), 'pokedex.db がない')
+    def test_from_db(self):
+        table = PokemonTable.from_db('pokedex.db')
+        sources, _ = table.query(StructuredQuery(types=['でんき'], sort=('speed', 'desc')), 1)
+        self.assertEqual(sources[0]['name_english'], 'Regieleki')
+        self.assertIn('いかく', table.abilities)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+import numpy as np
+
+from cache import touch_index_stamp
+from projection import PcaProjection, ProjectionResolver
+from retrievers import ElasticsearchRetriever
+
+
+def low_rank_vectors(n=200, dim=16, rank=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal((n, rank)) @ rng.standard_normal((rank, dim))).astype(np.float32)
+
+
+class TestPcaProjection(unittest.TestCase):
+    def test_fit_keeps_low_rank_structure(self):
+        vectors = low_rank_vectors()
+        projection = PcaProjection.fit(vectors, 3)
+
+        reduced = projection.transform(vectors)
+
+        self.assertEqual(reduced.shape, (200, 3))
+        self.assertEqual(reduced.dtype, np.float32)
+        self.assertGreater(projection.explained_variance_ratio, 0.999)
+        # 距離がほぼ保たれる
+        self.assertAlmostEqual(float(np.linalg.norm(reduced[0] - reduced[1])),
+                               float(np.linalg.norm(vectors[0] - vectors[1])), places=3)
+        self.assertEqual(projection.transform(vectors[0]).shape, (3,))
+
+    def test_save_and_load(self):
+        projection = PcaProjection.fit(low_rank_vectors(), 4)
+        path = projection.save(tempfile.mkdtemp())
+
+        loaded = PcaProjection.load(path)
+
+        self.assertEqual(os.path.basename(path), f'{projection.fingerprint}.npz')
+        self.assertEqual(loaded.fingerprint, projection.fingerprint)
+        self.assertAlmostEqual(loaded.explained_variance_ratio, projection.explained_variance_ratio)
+
+    def test_invalid_dims(self):
+        with self.assertRaises(ValueError):
+            PcaProjection.fit(low_rank_vectors(dim=8), 8)
+
+
+class TestProjectionResolver(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stamp = os.path.join(self.directory, '.index_version')
+        self.projection = PcaProjection.fit(low_rank_vectors(), 4)
+        self.projection.save(self.directory)
+        self.es = MagicMock()
+        self.es.indices.get_mapping.return_value = {
+            'pk_v1': {'mappings': {'_meta': {'projection': self.projection.fingerprint}}}}
+
+    def test_query_vector_projected_like_the_index(self):
+        resolver = ProjectionResolver(self.es, 'pk', self.directory, stamp_path=self.stamp)
+        retriever = ElasticsearchRetriever(self.es, projection=resolver)
+        vector = low_rank_vectors(n=1)[0]
+
+        body = retriever.build_msearch([vector, vector], 5)[1]
+
+        np.testing.assert_allclose(body['knn']['query_vector'], self.projection.transform(vector), rtol=1e-5)
+        self.es.indices.get_mapping.assert_called_once_with(index='pk')
+
+    def test_reresolves_after_index_stamp_changes(self):
+        resolver = ProjectionResolver(self.es, 'pk', self.directory, stamp_path=self.stamp)
+        self.assertEqual(resolver.current().fingerprint, self.projection.fingerprint)
+
+        # 削減なしのインデックスへロールバックした
+        self.es.indices.get_mapping.return_value = {'pk_v0': {'mappings': {}}}
+        touch_index_stamp(self.stamp)
+
+        self.assertIsNone(resolver.current())
+        vector = np.ones(16, dtype=np.float32)
+        self.assertIs(resolver.project(vector), vector)
+
+    def test_async_search_resolves_off_the_event_loop(self):
+        from async_rag import AsyncVectorSearchEngine
+
+        threads = []
+        mapping = self.es.indices.get_mapping.return_value
+        self.es.indices.get_mapping.side_effect = lambda **kwargs: threads.append(threading.current_thread()) or mapping
+        resolver = ProjectionResolver(self.es, 'pk', self.directory, stamp_path=self.stamp)
+        engine = Mock()
+        engine.encode_query.return_value = low_rank_vectors(n=1)[0]
+        engine.retriever = ElasticsearchRetriever(self.es, projection=resolver)
+        engine.format_sources = list
+        es_client = AsyncMock()
+        es_client.msearch.return_value = {'responses': [{'hits': {'hits': [{'_source': {'global_no': '1'}}]}}]}
+
+        async def search():
+            async_engine = AsyncVectorSearchEngine(engine, es_client=es_client, groq=Mock())
+            results = [await async_engine.search('ほのお'), await async_engine.search('みず')]
+            return results, threading.current_thread()
+
+        results, loop_thread = asyncio.run(search())
+
+        self.assertEqual(results, [[{'global_no': '1'}]] * 2)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], loop_thread)
+        self.assertFalse(resolver.stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
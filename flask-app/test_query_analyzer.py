@@ -0,0 +1,72 @@
+import unittest
+
+from query_analyzer import QueryAnalyzer, StructuredQuery
+
+
+class TestQueryAnalyzer(unittest.TestCase):
+    def setUp(self):
+        self.analyzer = QueryAnalyzer(abilities=['いかく', 'もうか', 'すいすい'])
+
+    def test_stat_comparison(self):
+        self.assertEqual(self.analyzer.analyze('素早さ120以上のほのおタイプ'),
+                         StructuredQuery(types=['ほのお'], filters=[('speed', 'ge', 120)], sort=('speed', 'desc')))
+        self.assertEqual(self.analyzer.analyze('HP over 100'),
+                         StructuredQuery(filters=[('hp', 'gt', 100)], sort=('hp', 'desc')))
+        self.assertEqual(self.analyzer.analyze('ghost type with sp. atk >= 130'),
+                         StructuredQuery(types=['ゴースト'], filters=[('special_attack', 'ge', 130)],
+                                         sort=('special_attack', 'desc')))
+        # 数値と比較が種族値より先。上限の条件なら低い順に並べる
+        self.assertEqual(self.analyzer.analyze('120未満のすばやさ'),
+                         StructuredQuery(filters=[('speed', 'lt', 120)], sort=('speed', 'asc')))
+
+    def test_sort(self):
+        self.assertEqual(self.analyzer.analyze('fastest electric'),
+                         StructuredQuery(types=['でんき'], sort=('speed', 'desc')))
+        self.assertEqual(self.analyzer.analyze('ほのおタイプで一番速いポケモンは？'),
+                         StructuredQuery(types=['ほのお'], sort=('speed', 'desc')))
+        self.assertEqual(self.analyzer.analyze('攻撃が100以上で特防が低いエスパー'),
+                         StructuredQuery(types=['エスパー'], filters=[('attack', 'ge', 100)],
+                                         sort=('special_defense', 'asc')))
+        self.assertEqual(self.analyzer.analyze('top 3 highest attack dragon'),
+                         StructuredQuery(types=['ドラゴン'], sort=('attack', 'desc'), limit=3))
+        self.assertEqual(self.analyzer.analyze('素早さ順'), StructuredQuery(sort=('speed', 'desc')))
+
+    def test_ability_and_kana(self):
+        self.assertEqual(self.analyzer.analyze('イカクを持つみずタイプ'),
+                         StructuredQuery(types=['みず'], abilities=['いかく']))
+        self.assertEqual(self.analyzer.analyze('ホノオ/ひこうで素早さ100'),
+                         StructuredQuery(types=['ほのお', 'ひこう'], filters=[('speed', 'eq', 100)], sort=('speed', 'desc')))
+
+    def test_ambiguous_queries_left_to_rag(self):
+        for query in ('夜になると人の魂を奪うと言われるポケモン',
+                      'ピカチュウより速いポケモン',
+                      'こおりタイプの伝説のポケモン',
+                      # タイプだけでは並べ方が決まらない
+                      'ほのおタイプのポケモン', 'Fire タイプ',
+                      # 並べ方が2つ
+                      '防御が高くて遅いはがねタイプ',
+                      # 種族値だけ・数値だけ
+                      '攻撃', 'speed over', '100以上',
+                      # 英単語の一部だけが語彙に当たる
+                      'theme', 'firefly',
+                      ''):
+            self.assertIsNone(self.analyzer.analyze(query), query)
+
+    def test_type_matchup_left_to_rag(self):
+        # 「強い」「弱い」はタイプと並ぶと合計種族値ではなくタイプ相性の意味になる
+        for query in ('ほのおタイプに弱いポケモン', 'みずタイプに強いポケモン', 'ドラゴンに強い',
+                      'ほのおへの弱点', 'でんきタイプに対して強いポケモン', 'みずタイプの弱点',
+                      'weak to fire', 'strongest against water', 'fire type weakness'):
+            self.assertIsNone(self.analyzer.analyze(query), query)
+        self.assertEqual(self.analyzer.analyze('最強のドラゴンタイプ'),
+                         StructuredQuery(types=['ドラゴン'], sort=('total', 'desc')))
+
+    def test_describe_and_explain(self):
+        structured = self.analyzer.analyze('素早さ100以上で攻撃が高いほのおタイプ')
+        self.assertEqual(structured.describe(), 'ほのおタイプ・すばやさ100以上・こうげきの高い順')
+        source = {'types': ['ほのお', 'ひこう'], 'abilities': ['もうか'], 'stats_speed': 100, 'stats_attack': 84}
+        self.assertEqual(structured.explain(source), 'ほのお/ひこう・すばやさ 100・こうげき 84')
+
+
+if __name__ == '__main__':
+    unittest.main()
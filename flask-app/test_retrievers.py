@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+import numpy as np
+
+from retrievers import (ElasticsearchRetriever, HybridElasticsearchRetriever, LocalIndexWriter, NumpyRetriever,
+                        create_retriever, export_local_index)
+
+DOCUMENTS = [
+    {'global_no': '25', 'name_english': 'Pikachu'},
+    {'global_no': '26', 'name_english': 'Raichu'},
+    {'global_no': '26', 'name_english': 'MegaRaichu'},
+    {'global_no': '1', 'name_english': 'Bulbasaur'},
+]
+VECTORS = np.array([
+    [1.0, 0.0, 0.0],
+    [0.0, 2.0, 0.0],
+    [0.0, 1.0, 0.1],
+    [0.0, 0.0, 1.0],
+], dtype=np.float32)
+
+
+class TestNumpyRetriever(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        export_local_index(self.directory, DOCUMENTS, VECTORS)
+        self.retriever = NumpyRetriever(self.directory)
+
+    def test_top_k_collapses_by_global_no(self):
+        results = self.retriever.search([0.1, 1.0, 0.0], top_k=3)
+
+        # k=3 の候補 (Raichu, MegaRaichu, Pikachu) を global_no でまとめる
+        self.assertEqual([doc['name_english'] for doc in results], ['Raichu', 'Pikachu'])
+
+    def test_search_many_matches_search(self):
+        queries = [np.array([1.0, 0.0, 0.0]), np.array([0.0, 0.0, 5.0])]
+
+        self.assertEqual(self.retriever.search_many(queries, top_k=2),
+                         [self.retriever.search(q, top_k=2) for q in queries])
+
+    def test_reloads_after_export(self):
+        export_local_index(self.directory, DOCUMENTS[:1], VECTORS[:1])
+
+        self.assertEqual(self.retriever.search([0.0, 1.0, 0.0], top_k=5), DOCUMENTS[:1])
+
+    def test_uncommitted_version_not_visible(self):
+        writer = LocalIndexWriter(self.directory)
+        writer.add(DOCUMENTS[:1], VECTORS[:1])
+        # ベクトルだけ書き終えた状態では、前のバージョンの組をそのまま読む
+        self.assertEqual(len(self.retriever.search([0.0, 0.0, 1.0], top_k=5)), 3)
+
+        writer.commit()
+        self.assertEqual(self.retriever.search([0.0, 0.0, 1.0], top_k=5), DOCUMENTS[:1])
+
+    def test_old_versions_pruned(self):
+        for _ in range(3):
+            export_local_index(self.directory, DOCUMENTS, VECTORS)
+
+        versions = [name for name in os.listdir(self.directory) if name.startswith('v')]
+        self.assertEqual(len(versions), LocalIndexWriter.KEEP_VERSIONS)
+        self.assertEqual(len(self.retriever.search([1.0, 0.0, 0.0], top_k=5)), 3)
+
+
+def hits(*names):
+    return {'hits': {'hits': [{'_source': {'global_no': name, 'name_english': name}} for name in names]}}
+
+
+class TestHybridRetriever(unittest.TestCase):
+    def setUp(self):
+        self.es_client = Mock()
+        self.retriever = HybridElasticsearchRetriever(self.es_client, num_candidates=30, window_size=10)
+
+    def test_msearch_pairs_knn_and_bm25(self):
+        self.es_client.msearch.return_value = {'responses': [hits('a', 'b'), hits('c')]}
+
+        self.retriever.search(np.zeros(3), 5, query_text='ピカチュウ')
+
+        searches = self.es_client.msearch.call_args.kwargs['searches']
+        self.assertEqual(len(searches), 4)
+        self.assertEqual(searches[1]['knn']['num_candidates'], 30)
+        self.assertEqual(searches[1]['knn']['k'], 10)
+        self.assertEqual(searches[3]['query']['multi_match']['query'], 'ピカチュウ')
+        self.assertEqual(searches[3]['size'], 10)
+
+    def test_rrf_prefers_documents_in_both_rankings(self):
+        self.es_client.msearch.return_value = {'responses': [hits('a', 'b', 'c'), hits('c', 'd')]}
+
+        results = self.retriever.search(np.zeros(3), 3, query_text='q')
+
+        self.assertEqual([doc['global_no'] for doc in results], ['c', 'a', 'b'])
+
+    def test_bm25_weight_can_dominate(self):
+        self.retriever.bm25_weight = 3.0
+        self.es_client.msearch.return_value = {'responses': [hits('a', 'b'), hits('d')]}
+
+        results = self.retriever.search(np.zeros(3), 2, query_text='q')
+
+        self.assertEqual([doc['global_no'] for doc in results], ['d', 'a'])
+
+    def test_bm25_error_falls_back_to_knn(self):
+        self.es_client.msearch.return_value = {'responses': [hits('a', 'b', 'c'), {'error': {'reason': 'x'}}]}
+
+        results = self.retriever.search(np.zeros(3), 2, query_text='q')
+
+        self.assertEqual([doc['global_no'] for doc in results], ['a', 'b'])
+
+
+class TestCreateRetriever(unittest.TestCase):
+    def test_es_backend_uses_knn_with_collapse(self):
+        es_client = Mock()
+        es_client.search.return_value = {'hits': {'hits': [{'_source': DOCUMENTS[0]}]}}
+        retriever = create_retriever('es', es_client=es_client)
+
+        self.assertEqual(retriever.search(np.zeros(3, dtype=np.float32), 5), DOCUMENTS[:1])
+        body = es_client.search.call_args.kwargs['body']
+        self.assertEqual(body['knn']['k'], 5)
+        self.assertEqual(body['collapse'], {'field': 'global_no'})
+        self.assertIsInstance(retriever, ElasticsearchRetriever)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            create_retriever('faiss')
+
+
+if __name__ == '__main__':
+    unittest.main()
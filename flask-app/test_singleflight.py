@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from singleflight import AsyncSingleFlight, CoalesceTimeout, SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight(timeout=5)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'answer': 42}
+
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            leader = pool.submit(flight.do, 'q', work)
+            self.assertTrue(started.wait(5))
+            followers = [pool.submit(flight.do, 'q', work) for _ in range(4)]
+            while flight.stats()['coalesced'] < 4:
+                time.sleep(0.001)
+            release.set()
+            results = [leader.result()] + [f.result() for f in followers]
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results[0], ({'answer': 42}, False))
+        self.assertTrue(all(result == ({'answer': 42}, True) for result in results[1:]))
+        self.assertEqual(flight.stats()['in_flight'], 0)
+        # 終わった後に来たリクエストは新しく実行する
+        self.assertEqual(flight.do('q', lambda: 'again'), ('again', False))
+
+    def test_error_propagates_to_followers(self):
+        flight = SingleFlight(timeout=5)
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('upstream down')
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            leader = pool.submit(flight.do, 'q', fail)
+            self.assertTrue(started.wait(5))
+            follower = pool.submit(flight.do, 'q', fail)
+            while flight.stats()['coalesced'] < 1:
+                time.sleep(0.001)
+            release.set()
+            for future in (leader, follower):
+                with self.assertRaises(ValueError):
+                    future.result()
+
+        self.assertEqual(flight.stats()['failures'], 1)
+
+    def test_follower_wait_is_bounded(self):
+        flight = SingleFlight(timeout=0.05)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'late'
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            leader = pool.submit(flight.do, 'q', slow)
+            self.assertTrue(started.wait(5))
+            with self.assertRaises(CoalesceTimeout):
+                flight.do('q', slow)
+            release.set()
+            self.assertEqual(leader.result(), ('late', False))
+
+        self.assertEqual(flight.stats()['timeouts'], 1)
+
+    def test_disabled(self):
+        flight = SingleFlight(timeout=0)
+        self.assertEqual(flight.do('q', lambda: 1), (1, False))
+        self.assertEqual(flight.stats()['executions'], 0)
+
+
+class TestAsyncSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        flight = AsyncSingleFlight(timeout=5)
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'answer'
+
+        async def run():
+            return await asyncio.gather(*(flight.do('q', work) for _ in range(5)))
+
+        results = asyncio.run(run())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True, True])
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+    def test_error_and_timeout(self):
+        flight = AsyncSingleFlight(timeout=0.05)
+
+        async def slow_failure():
+            await asyncio.sleep(0.2)
+            raise ValueError('upstream down')
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do('q', slow_failure))
+            await asyncio.sleep(0)
+            with self.assertRaises(CoalesceTimeout):
+                await flight.do('q', slow_failure)
+            with self.assertRaises(ValueError):
+                await leader
+
+        asyncio.run(run())
+        self.assertEqual(flight.stats()['timeouts'], 1)
+        self.assertEqual(flight.stats()['failures'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
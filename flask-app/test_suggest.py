@@ -0,0 +1,74 @@
+import os
+import unittest
+from unittest.mock import Mock
+
+from suggest import NameIndex, normalize_name
+
+ROWS = [
+    (6, '', 'リザードン', 'Charizard', '喷火龙'),
+    (6, 'メガシンカ', 'メガリザードンX', 'MegaCharizardX', ''),
+    (5, '', 'リザード', 'Charmeleon', '火恐龙'),
+    (25, '', 'ピカチュウ', 'Pikachu', '皮卡丘'),
+    (26, '', 'ライチュウ', 'Raichu', '雷丘'),
+    (26, 'アローラのすがた', 'ライチュウ', 'Raichu', '雷丘'),
+    (122, '', 'バリヤード', 'Mr. Mime', '魔墙人偶'),
+    (154, '', 'メガニウム', 'Meganium', '大竺葵'),
+]
+
+
+class TestNameIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = NameIndex(ROWS)
+
+    def labels(self, query, limit=10):
+        return [(e['no'], e['label']) for e in self.index.search(query, limit)]
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name('ぴかちゅう'), normalize_name('ピカチュウ'))
+        self.assertEqual(normalize_name('ﾋﾟｶﾁｭｳ'), normalize_name('ピカチュウ'))
+        self.assertEqual(normalize_name('MR. MIME'), normalize_name('mr mime'))
+
+    def test_prefix_in_each_language(self):
+        self.assertEqual(self.labels('ぴか'), [(25, 'ピカチュウ')])
+        self.assertEqual(self.labels('PIKA'), [(25, 'Pikachu')])
+        self.assertEqual(self.labels('皮卡'), [(25, '皮卡丘')])
+        self.assertEqual(self.labels('mr m'), [(122, 'Mr. Mime')])
+        self.assertEqual(self.labels('ヌ'), [])
+        self.assertEqual(self.labels('  '), [])
+
+    def test_ranking(self):
+        # 短い名前 → 図鑑番号の順
+        self.assertEqual(self.labels('リザ'), [(5, 'リザード'), (6, 'リザードン')])
+        # 完全一致が先
+        self.assertEqual(self.labels('リザードン')[0], (6, 'リザードン'))
+        # 通常の姿がフォルムより先
+        self.assertEqual(self.labels('メガ'), [(154, 'メガニウム'), (6, 'メガリザードンX')])
+        self.assertEqual(self.labels('リ', limit=1), [(5, 'リザード')])
+        # 名前の長さは当たった言語の名前で比べる (日本語名はリザードの方が短い)
+        self.assertEqual(self.labels('char'), [(6, 'Charizard'), (5, 'Charmeleon')])
+
+    def test_same_name_forms_merged(self):
+        results = self.index.search('らい')
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0]['form'])
+        self.assertEqual(results[0]['name_english'], 'Raichu')
+
+    @unittest.skipUnless(os.path.exists('pokedex.db'), 'pokedex.db がない')
+    def test_from_db(self):
+        index = NameIndex.from_db('pokedex.db')
+        self.assertEqual(index.search('ぴかちゅう', 1)[0]['no'], 25)
+        self.assertEqual(index.search('charizard', 1)[0]['name'], 'リザードン')
+
+    def test_endpoint(self):
+        from main import create_app
+
+        client = create_app(engine=Mock(), names=self.index).test_client()
+
+        response = client.get('/api/suggest', query_string={'q': 'ぴか'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['suggestions'][0]['name'], 'ピカチュウ')
+        self.assertEqual(client.get('/api/suggest?q=a&limit=x').status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,12 @@
+"""gunicorn のエントリーポイント
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+preload_app なので、このモジュールは fork 前に親プロセスで1度だけ読み込まれる。
+モデルの重みとローカルインデックスのメタデータはここで読み込み、ワーカーはそのページを共有する。
+親プロセスでは推論しない (ウォームアップは gunicorn.conf.py の post_fork でワーカーごとに行う)。
+"""
+import main
+
+engine = main.build_engine()
+app = main.create_app(engine)
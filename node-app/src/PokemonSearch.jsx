@@ -7,6 +7,7 @@ import PokemonDetailsCard from './PokemonDetailsCard';
 
 const DISPLAY_COUNT = 3;
 const API_ENDPOINT = 'http://localhost:8080/api/search';
+const SUGGEST_ENDPOINT = 'http://localhost:8080/api/suggest';
 
 const STYLES = {
   container: "min-h-screen bg-[#1a1f36]",
@@ -96,7 +97,7 @@ const SearchResults = ({ searchResponse }) => (
   </div>
 );
 
-const SearchBar = ({ search, isLoading, onSearch, onChange, onClear }) => (
+const SearchBar = ({ search, suggestions, isLoading, onSearch, onChange, onClear }) => (
   <div className={STYLES.searchContainer}>
     <div className="relative">
       <Input
@@ -104,7 +105,13 @@ const SearchBar = ({ search, isLoading, onSearch, onChange, onClear }) => (
         onChange={onChange}
         className={STYLES.searchInput}
         placeholder="ポケモンを検索..."
+        list="pokemon-suggestions"
       />
+      <datalist id="pokemon-suggestions">
+        {suggestions.map((item) => (
+          <option key={`${item.no}-${item.name}`} value={item.label} />
+        ))}
+      </datalist>
       {search && (
         <button onClick={onClear} className={STYLES.clearButton}>
           <X className="h-4 w-4" />
@@ -128,6 +135,7 @@ export default function PokemonSearch() {
   const [searchResponse, setSearchResponse] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
   const [currentIndex, setCurrentIndex] = useState(0);
+  const [suggestions, setSuggestions] = useState([]);
 
   const updateDisplayList = useCallback((newIndex) => {
     const listLength = pokemonList.length;
@@ -151,6 +159,21 @@ export default function PokemonSearch() {
     }
   }, [pokemonList, updateDisplayList]);
 
+  // 入力中のポケモン名の候補 (サーバー側のメモリ上の索引を引くだけなので毎回問い合わせる)
+  useEffect(() => {
+    const query = search.trim();
+    if (!query) {
+      setSuggestions([]);
+      return;
+    }
+    const controller = new AbortController();
+    fetch(`${SUGGEST_ENDPOINT}?q=${encodeURIComponent(query)}&limit=8`, { signal: controller.signal })
+      .then((response) => (response.ok ? response.json() : { suggestions: [] }))
+      .then((data) => setSuggestions(data.suggestions))
+      .catch(() => {});
+    return () => controller.abort();
+  }, [search]);
+
   const handleSearch = async () => {
     if (!search.trim()) return;
     setIsLoading(true);
@@ -240,6 +263,7 @@ export default function PokemonSearch() {
 
         <SearchBar
           search={search}
+          suggestions={suggestions}
           isLoading={isLoading}
           onSearch={handleSearch}
           onChange={(e) => setSearch(e.target.value)}